@@ -0,0 +1,263 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Local mirror of Launchpad bug tasks and bugs.
+
+Walking the bug tasks of a project through the Launchpad API costs one
+request per page of tasks plus one request per bug. The mirror keeps the
+fields the reports use in SQLite and, once a project has been synced,
+only fetches the tasks of the bugs modified since the previous sync.
+"""
+
+import collections
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+
+import pytz
+
+from reviewstats import utils
+
+LOG = logging.getLogger(__name__)
+
+
+BUGS_DB = '.reviewstats-bugs.sqlite'
+
+# Seconds to wait for other processes writing to the mirror.
+SQLITE_TIMEOUT = 60
+
+# Seconds subtracted from the start of a sync to get the modified_since of
+# the next one, so that bugs modified while syncing are not missed.
+SYNC_SLACK = 300
+
+# All the statuses of bug tasks, so that a task leaving the statuses a
+# report is interested in is updated in the mirror too.
+MIRROR_STATUSES = ('New', 'Incomplete', 'Opinion', 'Invalid', "Won't Fix",
+                   'Expired', 'Confirmed', 'Triaged', 'In Progress',
+                   'Fix Committed', 'Fix Released')
+
+TASK_FIELDS = ('self_link', 'bug_link', 'status', 'importance',
+               'milestone_link', 'date_created', 'date_left_new',
+               'date_closed')
+BUG_FIELDS = ('self_link', 'id', 'duplicate_of_link', 'tags')
+DATE_FIELDS = ('date_created', 'date_left_new', 'date_closed')
+
+BugTask = collections.namedtuple('BugTask', TASK_FIELDS)
+Bug = collections.namedtuple('Bug', BUG_FIELDS)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bug_tasks (
+    lp_project TEXT NOT NULL,
+    self_link TEXT NOT NULL,
+    bug_link TEXT NOT NULL,
+    status TEXT,
+    date_created TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (lp_project, self_link)
+);
+CREATE INDEX IF NOT EXISTS bug_tasks_bug_link ON bug_tasks (bug_link);
+CREATE TABLE IF NOT EXISTS bugs (
+    self_link TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS bug_sync_state (
+    lp_project TEXT PRIMARY KEY,
+    synced TEXT NOT NULL
+);
+"""
+
+
+def bug_id(bug_link):
+    """Return the id of a bug from its API link, without fetching it."""
+    return bug_link.rstrip('/').rsplit('/', 1)[-1]
+
+
+def _to_json(entry, fields):
+    data = {}
+    for field in fields:
+        value = getattr(entry, field, None)
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        elif field == 'tags':
+            value = list(value or [])
+        data[field] = value
+    return data
+
+
+def _task_from_json(data):
+    data = dict(data)
+    for field in DATE_FIELDS:
+        if data.get(field):
+            data[field] = datetime.datetime.fromisoformat(data[field])
+    return BugTask(**data)
+
+
+def _bug_from_json(data):
+    return Bug(**data)
+
+
+class BugStore(object):
+    """SQLite backed mirror of Launchpad bug tasks and bugs.
+
+    Tasks are keyed by (lp_project, self_link) and bugs by self_link. The
+    store may be shared between threads; access is serialized.
+    """
+
+    def __init__(self, path=BUGS_DB):
+        self.path = path
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   timeout=SQLITE_TIMEOUT)
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.executescript(SCHEMA)
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def get_synced(self, lp_project):
+        """Return when lp_project was last synced, or None."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT synced FROM bug_sync_state WHERE lp_project = ?',
+                (lp_project,)).fetchone()
+        if row is None:
+            return None
+        return datetime.datetime.fromisoformat(row[0])
+
+    def set_synced(self, lp_project, synced):
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO bug_sync_state '
+                    '(lp_project, synced) VALUES (?, ?)',
+                    (lp_project, synced.isoformat()))
+
+    def upsert_tasks(self, lp_project, tasks):
+        """Insert or replace the given Launchpad bug tasks."""
+        rows = []
+        for task in tasks:
+            data = _to_json(task, TASK_FIELDS)
+            rows.append((lp_project, data['self_link'], data['bug_link'],
+                         data['status'], data['date_created'],
+                         json.dumps(data, separators=(',', ':'))))
+        with self._lock:
+            with self._db:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO bug_tasks '
+                    '(lp_project, self_link, bug_link, status, date_created, '
+                    'data) VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def upsert_bugs(self, bugs):
+        """Insert or replace the given Launchpad bugs."""
+        rows = []
+        for bug in bugs:
+            data = _to_json(bug, BUG_FIELDS)
+            rows.append((data['self_link'],
+                         json.dumps(data, separators=(',', ':'))))
+        with self._lock:
+            with self._db:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO bugs (self_link, data) '
+                    'VALUES (?, ?)', rows)
+
+    def iter_tasks(self, lp_project, statuses=None, omit_duplicates=True):
+        """Yield (BugTask, Bug) tuples of the mirrored tasks of lp_project.
+
+        Tasks are yielded by creation date. Their bug is None if it is not
+        mirrored.
+
+        :param statuses: If given, only yield the tasks with these statuses.
+        :param omit_duplicates: Skip the tasks of the bugs marked as a
+            duplicate, like searchTasks does by default.
+        """
+        sql = ('SELECT t.data, b.data FROM bug_tasks t '
+               'LEFT JOIN bugs b ON b.self_link = t.bug_link '
+               'WHERE t.lp_project = ?')
+        args = [lp_project]
+        if statuses is not None:
+            statuses = list(statuses)
+            sql += ' AND t.status IN (%s)' % ', '.join('?' * len(statuses))
+            args += statuses
+        sql += ' ORDER BY t.date_created, t.self_link'
+        with self._lock:
+            rows = self._db.execute(sql, args).fetchall()
+        for task, bug in rows:
+            if bug is not None:
+                bug = _bug_from_json(json.loads(bug))
+                if omit_duplicates and bug.duplicate_of_link:
+                    continue
+            yield _task_from_json(json.loads(task)), bug
+
+
+def sync_project(launchpad, lp_project, cache):
+    """Bring the mirrored bug tasks of a Launchpad project up to date.
+
+    The first sync fetches all the tasks of the project, and their bugs.
+    The next ones only fetch the tasks of the bugs modified since. The tasks
+    of duplicate bugs are fetched too, so that a bug marked as a duplicate
+    after it was mirrored is updated; :meth:`BugStore.iter_tasks` skips
+    them.
+
+    :param launchpad: Logged in :class:`launchpadlib.launchpad.Launchpad`.
+    :param cache: :class:`BugStore` to update.
+    :return: the number of tasks fetched.
+    """
+    started = datetime.datetime.now(pytz.utc)
+    synced = cache.get_synced(lp_project)
+    kwargs = {}
+    if synced is not None:
+        kwargs['modified_since'] = synced.isoformat()
+    proj = launchpad.projects[lp_project]
+    tasks = []
+    bugs = {}
+    for task in proj.searchTasks(status=list(MIRROR_STATUSES),
+                                 omit_duplicates=False, order_by='id',
+                                 **kwargs):
+        tasks.append(task)
+        if task.bug_link not in bugs:
+            bugs[task.bug_link] = task.bug
+    cache.upsert_bugs(bugs.values())
+    cache.upsert_tasks(lp_project, tasks)
+    cache.set_synced(lp_project,
+                     started - datetime.timedelta(seconds=SYNC_SLACK))
+    LOG.debug('Synced %d bug tasks of %s', len(tasks), lp_project)
+    return len(tasks)
+
+
+def sync_projects(login, lp_projects, cache, workers=1):
+    """Sync Launchpad projects concurrently.
+
+    launchpadlib objects may not be shared between threads, so each worker
+    thread logs in with its own session.
+
+    :param callable login: Return a logged in
+        :class:`launchpadlib.launchpad.Launchpad`.
+    :param int workers: Number of projects to fetch concurrently.
+    :return: Generator of (lp_project, number of tasks fetched) tuples, in
+        the order of lp_projects, each yielded as soon as the project is
+        synced.
+    """
+    local = threading.local()
+    # Log in once before starting the threads, so that they find the
+    # credentials cached instead of all asking for them.
+    local.launchpad = login()
+
+    def sync(lp_project):
+        if getattr(local, 'launchpad', None) is None:
+            local.launchpad = login()
+        return lp_project, sync_project(local.launchpad, lp_project, cache)
+
+    return utils.ordered_map(sync, lp_projects, workers=workers)
@@ -13,7 +13,7 @@
 # under the License.
 
 from argparse import ArgumentParser
-import bisect
+import array
 from datetime import datetime
 from datetime import timedelta
 import prettytable
@@ -23,112 +23,112 @@ from textwrap import dedent
 from launchpadlib.launchpad import Launchpad
 import pytz
 
+from reviewstats import bugs
 from reviewstats import utils
 
 
-offsets = {
-    'critical': 1,
-    'high': 2,
-    'undecided': 3,
-    'other': 4,
-    'total': 5,
-    'created': 6,
-    'closed': 7,
-    'criticaltags': 8,
-    }
+# Weekly counters, in the order of the summary columns.
+COUNTERS = ('critical', 'high', 'undecided', 'other', 'total', 'created',
+            'closed')
+
+SEVERITIES = {
+    'Critical': 'critical',
+    'High': 'high',
+    'Undecided': 'undecided',
+}
+
+ONE_WEEK = timedelta(weeks=1)
+
+
+def _weeks_before(now, date):
+    """Return (floor, ceil) of the number of weeks from date to now."""
+    weeks, remainder = divmod(now - date, ONE_WEEK)
+    return weeks, weeks if not remainder else weeks + 1
 
 
 class Listener(object):
+    """Weekly bug statistics of a project.
+
+    Week k starts k weeks before now. Each counter is kept as a difference
+    array indexed by k: a task adds to a range of weeks with two updates,
+    and :meth:`summarise` recovers the counts with a prefix sum.
+    """
 
     def __init__(self, project_name, lp_projects):
         self.name = project_name
         self.lp_projects = lp_projects
-        self.periods = []
         self.now = datetime.now(pytz.utc)
+        # Index of the earliest week, None until a task is categorised.
+        self.earliest = None
+        self.diffs = dict((name, array.array('l'))
+                          for name in COUNTERS)
+        # (first week, last week, tags) of the critical tasks, in the
+        # order they were categorised.
+        self.critical_tags = []
+
+    def _add(self, name, first, last):
+        """Count a task in the weeks from first down to last."""
+        if first >= last:
+            diff = self.diffs[name]
+            diff[last] += 1
+            diff[first + 1] -= 1
 
     def categorise_task(self, bug_task, bug):
         """Categorise a bug task.
 
-        :param bug_task: The LP API BugTask object to categorise.
-        :param bug: The LP API Bug object to categorise.
+        :param bug_task: The BugTask to categorise, from the
+            :mod:`reviewstats.bugs` mirror or the LP API.
+        :param bug: The Bug of the task.
 
         Note that we accept tasks in any order - the current merging of
         different projects is done serially rather than iterating all projects
         concurrently, which leads to out of order observation.
         """
-        pos = bisect.bisect_right(self.periods, [bug_task.date_created])
-        if pos:
-            pos -= 1
-        else:
-            # May need to extend self.periods left
-            self._setup_periods(bug_task.date_created)
-        period = self.periods[pos]
-        assert period[0] <= bug_task.date_created, "%s < %s" % (
-            period[0], bug_task.date_created)
+        # The task belongs to the latest week starting strictly before its
+        # creation, or to a new earliest week starting at or before it.
+        floor, ceil = _weeks_before(self.now, bug_task.date_created)
+        week = max(floor + 1, 0)
+        if self.earliest is None or week > self.earliest:
+            week = max(self.earliest or 0, ceil)
+            self._setup_periods(week)
+        assert self.now - week * ONE_WEEK <= bug_task.date_created, (
+            "%s < %s" % (self.now - week * ONE_WEEK, bug_task.date_created))
         sys.stderr.write('.')
-        period[offsets['created']] = period[offsets['created']] + 1
+        self._add('created', week, week)
+        if bug.duplicate_of_link:
+            # Can't determine any transitions reliably.
+            self._add('closed', week, week)
+            return
+        # The task counts in every week up to the one it was closed in.
+        last = 0
+        if bug_task.date_closed:
+            last = max(_weeks_before(self.now, bug_task.date_closed)[1], 0)
+            self._add('closed', week, last)
+        self._add('total', week, last)
         # Generate some cheaply available transition dates.
         # We consider it triaged when it has a status change away from New.
-        date_triaged = bug_task.date_left_new
-        # Run through the periods the bug was in different states for.
         # Unless/until we start doing activity log searching (or perhaps we
         # need to do that and cache the results) we mis-aggregate e.g. we count
         # the bug as the same importance for all time periods after it is
         # triaged.
-        one_week = timedelta(weeks=1)
-        while pos < len(self.periods):
-            period = self.periods[pos]
-            period_start = period[0]
-            period_end = period_start + one_week
-            if bug.duplicate_of_link:
-                # Can't determine any transitions reliably.
-                period[offsets['closed']] = period[offsets['closed']] + 1
-                return
-            if bug_task.date_closed and bug_task.date_closed < period_start:
-                return
-            if date_triaged and date_triaged < period_end:
-                # Untriaged
-                severity = offsets['other']
-            else:
-                if "Critical" == bug_task.importance:
-                    severity = offsets['critical']
-                    period[offsets['criticaltags']].update(bug.tags)
-                elif "High" == bug_task.importance:
-                    severity = offsets['high']
-                elif "Undecided" == bug_task.importance:
-                    severity = offsets['undecided']
-                else:
-                    severity = offsets['other']
-            period[offsets['total']] = period[offsets['total']] + 1
-            period[severity] = period[severity] + 1
-            if bug_task.date_closed and bug_task.date_closed >= period_start:
-                period[offsets['closed']] = period[offsets['closed']] + 1
-            pos += 1
-
-    def _setup_periods(self, start_date):
-        """Setup time periods we're going to report on.
-
-        :param start_date: The earliest date we will see data for.
-
-        After this function is called self.periods will be a list of lists each
-        of which should contain: 'Period start', 'critical', 'high',
-        'undecided', 'other', 'total', 'created', 'closed', 'critical-tags' -
-        e.g.  [datetime(..), 0, 0, 0, 0, 0, 0, 0, {'foo', 'bar}].
-        We create one period for each week from start_date to now.
-
-        If called when periods has already been setup, this will create more
-        rows as needed.
-        """
-        if self.periods and start_date == self.periods[0][0]:
+        untriaged = -1
+        if bug_task.date_left_new:
+            # Weeks ending after the task was triaged
+            untriaged = _weeks_before(self.now, bug_task.date_left_new)[1]
+        self._add('other', min(week, untriaged), last)
+        severity = SEVERITIES.get(bug_task.importance, 'other')
+        self._add(severity, week, max(last, untriaged + 1))
+        if severity == 'critical' and week >= max(last, untriaged + 1):
+            self.critical_tags.append(
+                (week, max(last, untriaged + 1), list(bug.tags)))
+
+    def _setup_periods(self, earliest):
+        """Extend the counters back to the week of index earliest."""
+        if self.earliest is not None and earliest <= self.earliest:
             return
-        self.periods.reverse()
-        if not self.periods:
-            self.periods = [[self.now, 0, 0, 0, 0, 0, 0, 0, set()]]
-        while self.periods[-1][0] > start_date:
-            self.periods.append(
-                [self.periods[-1][0] - timedelta(weeks=1),
-                 0, 0, 0, 0, 0, 0, 0, set()])
-        self.periods.reverse()
+        for diff in self.diffs.values():
+            diff.extend([0] * (earliest + 2 - len(diff)))
+        self.earliest = earliest
 
     def summarise(self):
         """Return summary data about the project.
@@ -138,9 +138,23 @@ class Listener(object):
             undecided, other open bugs, total open bugs, created in the period,
             closed in the period, and bug tags present on any critical bugs.
         """
-        for period in self.periods:
-            yield ([period[0].strftime('%Y-%m-%d')]
-                   + period[1:-1] + [','.join(period[-1])])
+        if self.earliest is None:
+            return
+        counts = {}
+        for name, diff in self.diffs.items():
+            total = 0
+            counts[name] = array.array('l', [0] * (self.earliest + 1))
+            for week in range(self.earliest + 1):
+                total += diff[week]
+                counts[name][week] = total
+        for week in range(self.earliest, -1, -1):
+            tags = set()
+            for first, last, task_tags in self.critical_tags:
+                if first >= week >= last:
+                    tags.update(task_tags)
+            yield ([(self.now - week * ONE_WEEK).strftime('%Y-%m-%d')]
+                   + [counts[name][week] for name in COUNTERS]
+                   + [','.join(tags)])
 
 
 def main():
@@ -159,6 +173,13 @@ def main():
     parser.add_argument(
         '-p', '--project', default='projects/nova.json',
         help='JSON file describing the project to generate stats for.')
+    parser.add_argument(
+        '--offline', action='store_true',
+        help='Use the local bug mirror as is, without syncing it with '
+             'Launchpad.')
+    parser.add_argument(
+        '-j', '--workers', type=int, default=4,
+        help='Number of Launchpad projects to fetch concurrently.')
     args = parser.parse_args()
     projects = utils.get_projects_info(args.project, False)
     lp_project_listeners = {}
@@ -166,9 +187,6 @@ def main():
     if not projects:
         sys.stderr.write('No projects found: please specify one or more.\n')
         return 1
-    launchpad = Launchpad.login_with(
-        'openstack-releasing', 'production', credentials_file='.lpcreds')
-
     for project in projects:
         lp_projects = project.get('lp_projects', [])
         if not lp_projects:
@@ -182,17 +200,25 @@ def main():
     statuses = ['New', 'Incomplete', 'Opinion', 'Invalid', "Won't Fix",
         'Confirmed', 'Triaged', 'In Progress', "Fix Committed", "Fix Released"]
 
-    bugs_by_bug_link = {}
-    for lp_project, receivers in lp_project_listeners.items():
-        proj = launchpad.projects[lp_project]
-        # Sort by id to make creating time periods easy.
-        bugtasks = proj.searchTasks(status=statuses, order_by="id")
-        for task in bugtasks:
-            if task.bug_link not in bugs_by_bug_link:
-                bugs_by_bug_link[task.bug_link] = task.bug
-            bug = bugs_by_bug_link[task.bug_link]
+    cache = bugs.BugStore()
+    if args.offline:
+        synced = lp_project_listeners
+    else:
+        synced = (lp_project for lp_project, count in bugs.sync_projects(
+            lambda: Launchpad.login_with(
+                'openstack-releasing', 'production',
+                credentials_file='.lpcreds'),
+            list(lp_project_listeners), cache, workers=args.workers))
+
+    # Projects are categorised in order, each as soon as it is synced.
+    for lp_project in synced:
+        receivers = lp_project_listeners[lp_project]
+        # Tasks come by creation date, which makes creating time periods
+        # easy.
+        for task, bug in cache.iter_tasks(lp_project, statuses):
             for receiver in receivers:
                 receiver.categorise_task(task, bug)
+    cache.close()
 
     for listener in listeners:
         sys.stdout.write("Project: %s\n" % listener.name)
@@ -0,0 +1,469 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Generate the reports of many projects from a single sync.
+
+The reports to generate are described by a YAML (or JSON) plan::
+
+    output_dir: results
+    projects:
+      - projects/*.json
+    all: true
+    jobs:
+      - report: reviewers
+        args: [-d, "30", -d, "90"]
+        formats: [txt, csv]
+      - report: openreviews
+        args: [-l, "15"]
+        all_args: []
+        formats: [txt, html, json]
+
+Every project file matching ``projects`` is synced with Gerrit once. Then
+each project's changes are read once from the change store and every job
+of the plan is run on them, with the other projects processed in parallel
+processes. With ``all``, the jobs are also run across all the official
+projects. ``args`` are command line options of the report's script,
+``all_args`` the options used across all the projects instead (default
+``args``), and ``formats`` its output formats (default txt). Each output is
+written to ``<output_dir>/<project>-<report>.<format>`` (``-<days>`` is
+inserted for reviewers reports with several windows) by an atomic rename,
+so readers never see partial files.
+
+The outputs are those the genresults-*.sh scripts used to write, which are
+now wrappers of this command: text outputs start with the date and the
+reviewstats revision, except the reviewers ones, and the text and HTML
+openreviews reports of all projects are followed by the reports of each
+project.
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import getpass
+import glob
+import io
+import logging
+import os
+import subprocess
+import sys
+import time
+
+import yaml
+
+from reviewstats.cmd import openapproved
+from reviewstats.cmd import openreviews
+from reviewstats.cmd import reviewers
+from reviewstats.cmd import reviews_for_bugs
+from reviewstats import store
+from reviewstats import utils
+
+LOG = logging.getLogger(__name__)
+
+
+DEFAULT_PLAN = 'genresults.yaml'
+
+
+class PlanError(Exception):
+    pass
+
+
+class StoredChanges(utils.ChangeCache):
+    """:class:`reviewstats.utils.ChangeCache` of the change store.
+
+    Projects are read from the store as is, they must have been synced
+    before.
+
+    :param int updated_since: Only read the changes updated at or after this
+        Unix-like timestamp, and the open changes.
+    """
+
+    def __init__(self, updated_since=None):
+        super(StoredChanges, self).__init__(None, None)
+        self.updated_since = updated_since
+
+    def _fetch(self, projects, updated_since=None):
+        cache = store.ChangeStore()
+        try:
+            for project in projects:
+                yield project, utils.read_project_changes(
+                    project, cache, updated_since=self.updated_since,
+                    include_open=True)
+        finally:
+            cache.close()
+
+
+@contextlib.contextmanager
+def atomic_output(path, header=None):
+    """Open path for writing, replacing it only once fully written."""
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp, 'w') as f:
+            if header:
+                f.write(header)
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def metadata():
+    """Return the header of the text reports."""
+    try:
+        head = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        head = 'unknown'
+    # The format of date -u, which pads the day with a space
+    now = time.gmtime()
+    return '%s %2d %s\nreviewstats HEAD: %s\n\n' % (
+        time.strftime('%a %b', now), now.tm_mday,
+        time.strftime('%H:%M:%S UTC %Y', now), head)
+
+
+def _outputs(unit, job, base, write, header=True):
+    written = []
+    for fmt in job['formats']:
+        path = '%s.%s' % (base, fmt)
+        fmt_header = unit['header'] if header and fmt == 'txt' else None
+        with atomic_output(path, fmt_header) as f:
+            write(fmt, f)
+        written.append(path)
+    return written
+
+
+def _args(unit, job):
+    return job['all_args'] if unit['all'] else job['args']
+
+
+def _reviewers_job(data, unit, job, base):
+    options = reviewers.parse_options(_args(unit, job))
+    utils.set_server_options(options, unit['settings'])
+    options.all = unit['all']
+    projects = unit['projects']
+    windows = reviewers.make_windows(
+        options, datetime.datetime.utcfromtimestamp(unit['now']))
+    core_index = utils.CoreTeamIndex(projects, options.server, options.user,
+                                     options.password)
+    reviewers.compute(options, data.project_changes(
+        projects, stable=options.stable,
+        updated_since=min(window.ts for window in windows)),
+        windows, core_index)
+    written = []
+    for window in windows:
+        window_base = base
+        if len(windows) > 1:
+            window_base = '%s-%d' % (base, window.days)
+        written += _outputs(unit, job, window_base, lambda fmt, f: (
+            reviewers.write_window(window, fmt, f, options, projects,
+                                   core_index)), header=False)
+    return written
+
+
+def _write_all_openreviews(stats, unit, job, fmt, f):
+    """Write the openreviews report of all projects, then of each project.
+
+    The reports of each project are read from their output files.
+    """
+    parts = [os.path.join(unit['output_dir'],
+                          '%s-%s.%s' % (name, job['name'], fmt))
+             for name in unit['parts']]
+    parts = [part for part in parts if os.path.exists(part)]
+    if fmt == 'txt':
+        openreviews.print_stats_txt(stats, f=f)
+        for part in parts:
+            with open(part) as part_f:
+                f.write('\n' + part_f.read())
+    elif fmt == 'html':
+        report = io.StringIO()
+        openreviews.print_stats_html(stats, f=report)
+        for line in report.getvalue().splitlines(True):
+            if '</html>' not in line:
+                f.write(line)
+        for part in parts:
+            with open(part) as part_f:
+                for line in part_f:
+                    if 'html>' not in line and 'head>' not in line:
+                        f.write(line)
+        f.write('</html>\n')
+    else:
+        openreviews.WRITERS[fmt](stats, f=f)
+
+
+def _openreviews_job(data, unit, job, base):
+    options = openreviews.parse_options(_args(unit, job))
+    utils.set_server_options(options, unit['settings'])
+    projects = unit['projects']
+    waiting_on_reviewer, waiting_on_submitter = openreviews.classify(
+        data.changes(projects, only_open=True), options, unit['now'])
+    stats = openreviews.gen_stats(projects, waiting_on_reviewer,
+                                  waiting_on_submitter, options)
+    if unit['all']:
+        return _outputs(unit, job, base, lambda fmt, f: (
+            _write_all_openreviews(stats, unit, job, fmt, f)))
+    return _outputs(unit, job, base, lambda fmt, f: (
+        openreviews.WRITERS[fmt](stats, f=f)))
+
+
+def _openapproved_job(data, unit, job, base):
+    options = openapproved.parse_options(_args(unit, job))
+    utils.set_server_options(options, unit['settings'])
+    result = openapproved.find_approved_and_rebased(
+        data.changes(unit['projects'], only_open=True), options)
+    return _outputs(unit, job, base, lambda fmt, f: (
+        openapproved.WRITERS[fmt](result, f=f)))
+
+
+def _reviews_for_bugs_job(data, unit, job, base):
+    if unit['all']:
+        # Bugs are looked up in the Launchpad project of a single project
+        return []
+    args = _parse_reviews_for_bugs(_args(unit, job))
+    project_name = unit['projects'][0]['name']
+    milestones = reviews_for_bugs.group_by_milestone(
+        data.changes(unit['projects'], only_open=True),
+        reviews_for_bugs.get_bug_tasks(project_name, args.milestone))
+    return _outputs(unit, job, base, lambda fmt, f: (
+        reviews_for_bugs.WRITERS[fmt](milestones, project_name,
+                                      args.milestone, f=f)))
+
+
+def _parse_reviews_for_bugs(argv):
+    return reviews_for_bugs.make_parser().parse_args(argv)
+
+
+# report: (job function, options parser, writers, default output name)
+JOBS = {
+    'reviewers': (_reviewers_job, reviewers.parse_options, reviewers.WRITERS,
+                  'reviewers'),
+    'openreviews': (_openreviews_job, openreviews.parse_options,
+                    openreviews.WRITERS, 'openreviews'),
+    'openapproved': (_openapproved_job, openapproved.parse_options,
+                     openapproved.WRITERS, 'openapproved'),
+    'reviews_for_bugs': (_reviews_for_bugs_job, _parse_reviews_for_bugs,
+                         reviews_for_bugs.WRITERS, 'reviews-for-bugs'),
+}
+
+
+def run_unit(unit):
+    """Run all the jobs of a project, or of all the projects.
+
+    :return: tuple of the list of files written and the list of the names
+        of the jobs that failed.
+    """
+    data = StoredChanges(updated_since=unit['updated_since'])
+    written = []
+    failed = []
+    for job in unit['jobs']:
+        base = os.path.join(unit['output_dir'],
+                            '%s-%s' % (unit['name'], job['name']))
+        try:
+            written += JOBS[job['report']][0](data, unit, job, base)
+        except Exception:
+            LOG.exception('%s report of %s failed', job['report'],
+                          unit['name'])
+            failed.append('%s-%s' % (unit['name'], job['name']))
+    return written, failed
+
+
+def load_plan(path):
+    """Load and check a plan file."""
+    with open(path) as f:
+        plan = yaml.safe_load(f)
+    if not isinstance(plan, dict) or not plan.get('jobs'):
+        raise PlanError('%s does not define any jobs' % path)
+    plan.setdefault('output_dir', 'results')
+    plan.setdefault('projects', ['projects/*.json'])
+    plan.setdefault('projects_dir', 'projects')
+    plan.setdefault('all', False)
+    if isinstance(plan['projects'], str):
+        plan['projects'] = [plan['projects']]
+    for job in plan['jobs']:
+        if job.get('report') not in JOBS:
+            raise PlanError('Unknown report %s, use one of: %s'
+                            % (job.get('report'), ', '.join(sorted(JOBS))))
+        parse, writers, name = JOBS[job['report']][1:]
+        job.setdefault('name', name)
+        job['args'] = [str(arg) for arg in job.get('args', [])]
+        job['all_args'] = [str(arg)
+                           for arg in job.get('all_args', job['args'])]
+        for args in (job['args'], job['all_args']):
+            try:
+                parse(args)
+            except SystemExit:
+                raise PlanError('Invalid arguments for %s: %s'
+                                % (job['report'], ' '.join(args)))
+        job.setdefault('formats', ['txt'])
+        for fmt in job['formats']:
+            if fmt not in writers:
+                raise PlanError('Unsupported format %s for %s'
+                                % (fmt, job['report']))
+    return plan
+
+
+def make_units(plan, settings, now):
+    """Return the units of work of a plan, one per project and for all."""
+    updated_since = now
+    for job in plan['jobs']:
+        if job['report'] != 'reviewers':
+            continue
+        for args in (job['args'], job['all_args']):
+            windows = reviewers.make_windows(
+                reviewers.parse_options(args),
+                datetime.datetime.utcfromtimestamp(now))
+            updated_since = min([updated_since]
+                                + [window.ts for window in windows])
+    header = metadata()
+
+    def unit(name, projects, all_projects=False, parts=()):
+        return {'name': name, 'projects': projects, 'all': all_projects,
+                'jobs': plan['jobs'], 'output_dir': plan['output_dir'],
+                'settings': settings, 'header': header, 'now': now,
+                'updated_since': updated_since, 'parts': list(parts)}
+
+    units = []
+    files = sorted(set(fn for pattern in plan['projects']
+                       for fn in glob.glob(pattern)))
+    for fn in files:
+        projects = utils.get_projects_info(fn, False)
+        if projects:
+            name = os.path.splitext(os.path.basename(fn))[0]
+            units.append(unit(name, projects))
+    if plan['all']:
+        projects = utils.get_projects_info(all_projects=True,
+                                           base_dir=plan['projects_dir'])
+        units.append(unit('all', projects, all_projects=True,
+                          parts=[u['name'] for u in units]))
+    return units
+
+
+def run_units(units, processes=1):
+    """Run units in up to ``processes`` processes.
+
+    :return: tuple of the list of files written and the list of the jobs
+        that failed.
+    """
+    written = []
+    failed = []
+    if processes <= 1:
+        results = map(run_unit, units)
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes)
+        results = executor.map(run_unit, units)
+    for unit_written, unit_failed in results:
+        written += unit_written
+        failed += unit_failed
+    if processes > 1:
+        executor.shutdown()
+    return written, failed
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    parser = argparse.ArgumentParser(
+        prog='genresults',
+        description='Generate the reports described by a plan file')
+    parser.add_argument(
+        '-c', '--plan', default=DEFAULT_PLAN,
+        help='YAML or JSON file describing the reports to generate '
+             '(default %s)' % DEFAULT_PLAN)
+    parser.add_argument(
+        '-u', '--user', default=os.environ.get('GERRIT_USER',
+                                               getpass.getuser()),
+        help='gerrit user')
+    parser.add_argument(
+        '-P', '--password', default=os.environ.get('GERRIT_PASS',
+                                                   getpass.getuser()),
+        help='gerrit HTTP password')
+    parser.add_argument(
+        '-k', '--key', default=os.environ.get('GERRIT_KEY'),
+        help='ssh key for gerrit')
+    parser.add_argument(
+        '--server', default=os.environ.get('GERRIT_SERVER',
+                                           'review.opendev.org'),
+        help='Gerrit server to connect to')
+    parser.add_argument(
+        '-j', '--workers', type=int,
+        default=int(os.environ.get('GERRIT_WORKERS', 1)),
+        help='Number of projects to query from Gerrit concurrently')
+    parser.add_argument(
+        '--processes', type=int, default=os.cpu_count() or 1,
+        help='Number of projects to generate reports for in parallel')
+    parser.add_argument(
+        '-r', '--report', action='append', choices=sorted(JOBS),
+        help='Only generate the reports of the plan of this kind. May be '
+             'given several times.')
+    parser.add_argument(
+        '--projects',
+        help='Project files (glob pattern) to generate reports for instead '
+             'of the ones of the plan, without the reports of all projects')
+    parser.add_argument(
+        '--debug', action='store_true', help='Show extra debug output')
+    options = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.ERROR)
+    if options.debug:
+        logging.root.setLevel(logging.DEBUG)
+
+    try:
+        plan = load_plan(options.plan)
+    except (IOError, PlanError, yaml.YAMLError) as e:
+        parser.error(str(e))
+    if options.report:
+        plan['jobs'] = [job for job in plan['jobs']
+                        if job['report'] in options.report]
+        if not plan['jobs']:
+            parser.error('%s has no %s job' % (options.plan,
+                                               ' or '.join(options.report)))
+    if options.projects:
+        plan['projects'] = [options.projects]
+        plan['all'] = False
+
+    settings = dict((name, getattr(options, name))
+                    for name in utils.SERVER_OPTIONS
+                    if hasattr(options, name))
+    settings['projects_dir'] = plan['projects_dir']
+    units = make_units(plan, settings, int(time.time()))
+    if not units:
+        parser.error('No project matches %s' % ', '.join(plan['projects']))
+    os.makedirs(plan['output_dir'], exist_ok=True)
+
+    projects = {}
+    for unit in units:
+        for project in unit['projects']:
+            projects.setdefault(project['name'], project)
+    projects = list(projects.values())
+    utils.sync_projects(projects, options.user, options.key,
+                        server=options.server, workers=options.workers,
+                        full_history=True)
+    if any(job['report'] == 'reviewers' for job in plan['jobs']):
+        utils.prefetch_core_teams(projects, options.server, options.user,
+                                  options.password, workers=options.workers)
+
+    # The reports of all projects include those of each project
+    written, failed = run_units([unit for unit in units if not unit['all']],
+                                processes=options.processes)
+    all_written, all_failed = run_units(
+        [unit for unit in units if unit['all']], processes=options.processes)
+    written += all_written
+    failed += all_failed
+    LOG.info('Wrote %d files', len(written))
+    if failed:
+        print('Failed reports: %s' % ', '.join(failed), file=sys.stderr)
+        return 1
+    return 0
@@ -21,17 +21,15 @@ still open. Only show patches that are likely to be trivial rebases.
 """
 
 import getpass
+import json
 import optparse
 import sys
 
 from reviewstats import utils
 
 
-def main(argv=None):
-    if argv is None:
-        argv = sys.argv
-
-    optparser = optparse.OptionParser()
+def make_parser():
+    optparser = optparse.OptionParser(prog='openapproved')
     optparser.add_option(
         '-p', '--project', default='projects/nova.json',
         help='JSON file describing the project to generate stats for')
@@ -47,17 +45,33 @@ def main(argv=None):
     optparser.add_option(
         '--server', default='review.opendev.org',
         help='Gerrit server to connect to')
-    options, args = optparser.parse_args()
-    projects = utils.get_projects_info(options.project, options.all)
+    optparser.add_option(
+        '-j', '--workers', type='int', default=1,
+        help='Number of projects to query from Gerrit concurrently')
+    optparser.add_option(
+        '--query-chunk-size', type='int', default=utils.QUERY_CHUNK_SIZE,
+        help='Maximum number of repos in one Gerrit query, projects with '
+             'more repos are queried in several chunks (default %d)'
+             % utils.QUERY_CHUNK_SIZE)
+    optparser.add_option(
+        '--query-page-size', type='int', default=utils.QUERY_PAGE_SIZE,
+        help="Number of changes asked per page of Gerrit queries, the "
+             "server's default if not given")
+    return optparser
 
-    if not projects:
-        print("Please specify a project.")
-        sys.exit(1)
 
-    changes = utils.get_changes(projects, options.user, options.key,
-                                only_open=True,
-                                server=options.server)
+def parse_options(argv):
+    """Parse the command line arguments, without the program name."""
+    options, args = make_parser().parse_args(argv)
+    return options
 
+
+def find_approved_and_rebased(changes, options):
+    """Return the "url subject" of the open changes that lost an approval.
+
+    Those are the changes with an approved patchset followed by a newer
+    patchset that is neither approved nor nacked.
+    """
     approved_and_rebased = set()
     for change in changes:
         if 'rowCount' in change:
@@ -67,23 +81,51 @@ def main(argv=None):
         if change['status'] != 'NEW':
             # Filter out WORKINPROGRESS
             continue
-        for patch_set in change['patchSets'][:-1]:
-            if (utils.patch_set_approved(patch_set)
-                    and not utils.patch_set_approved(change['patchSets'][-1])):
-                if has_negative_feedback(change['patchSets'][-1]):
+        derived = utils.get_derived(change)
+        for approved in derived['approved'][:-1]:
+            if approved and not derived['approved'][-1]:
+                if derived['negative_feedback'][-1]:
                     continue
                 approved_and_rebased.add("%s %s" % (change['url'],
                                                     change['subject']))
+    return sorted(approved_and_rebased)
 
+
+def write_txt(approved_and_rebased, f=sys.stdout):
     for x in approved_and_rebased:
-        print()
-    print("total %d" % len(approved_and_rebased))
+        f.write('\n')
+    f.write("total %d\n" % len(approved_and_rebased))
+
 
+def write_json(approved_and_rebased, f=sys.stdout):
+    json.dump({'changes': approved_and_rebased,
+               'total': len(approved_and_rebased)}, f, indent=2)
+    f.write('\n')
+
+
+WRITERS = {
+    'txt': write_txt,
+    'json': write_json,
+}
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    options = parse_options(argv[1:])
+    projects = utils.get_projects_info(options.project, options.all)
+
+    if not projects:
+        print("Please specify a project.")
+        sys.exit(1)
+
+    changes = utils.get_changes(projects, options.user, options.key,
+                                only_open=True,
+                                fields=('patchSets', 'approvals'),
+                                server=options.server,
+                                workers=options.workers,
+                                chunk_size=options.query_chunk_size,
+                                page_size=options.query_page_size)
 
-def has_negative_feedback(patch_set):
-    approvals = patch_set.get('approvals', [])
-    for review in approvals:
-        if review['type'] in ('CRVW', 'VRIF') \
-                and review['value'] in ('-1', '-2'):
-            return True
-    return False
+    write_txt(find_approved_and_rebased(changes, options))
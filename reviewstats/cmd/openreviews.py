@@ -14,9 +14,11 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import bisect
 import calendar
 import datetime
 import getpass
+import json
 import logging
 import optparse
 import sys
@@ -31,133 +33,142 @@ def sec_to_period_string(seconds):
     return '%d days, %d hours, %d minutes' % (days, hours, minutes)
 
 
-def average_age(changes, key='age'):
-    if not changes:
-        return 0
-    total_seconds = 0
-    for change in changes:
-        total_seconds += change[key]
-    avg_age = total_seconds / len(changes)
-    return sec_to_period_string(avg_age)
+def format_url(url, options):
+    return '%s%s%s' % ('<a href="' if options.html else '',
+                       url,
+                       ('">%s</a>' % url) if options.html else '')
 
 
-def quartile_age(changes, quartile=2, key='age'):
-    """Quartile age
+class Stat(str):
+    """Text of a leaf of the stats tree, with the data it shows.
 
-    quartile 1: 25%
-    quartile 2: 50% (median) default
-    quartile 3: 75%
+    The text and HTML reports write the text, the JSON one the data.
     """
 
-    if not changes:
-        return 0
-    changes = sorted(changes, key=lambda change: change[key])
-    quartile_age = changes[len(changes) * quartile // 4][key]
-    return sec_to_period_string(quartile_age)
+    def __new__(cls, text, data=None):
+        stat = super(Stat, cls).__new__(cls, text)
+        stat.data = data
+        return stat
 
 
-def number_waiting_more_than(changes, seconds, key='age'):
-    index = 0
-    for change in changes:
-        if change[key] < seconds:
-            return index
-        index += 1
-    return len(changes)
+class AgeStats(object):
+    """Order statistics of the changes waiting on reviewers, for one age key.
 
+    The changes are sorted once. Percentiles, threshold counts and the
+    longest waiting changes are then read from the sorted data, and the
+    mean from a single sum.
+    """
+
+    def __init__(self, changes, key='age'):
+        self.key = key
+        # Stable sort, so that changes of the same age keep their order.
+        self.longest = sorted(changes, key=lambda change: change[key],
+                              reverse=True)
+        self.ages = [change[key] for change in reversed(self.longest)]
+
+    def __len__(self):
+        return len(self.ages)
+
+    def average(self):
+        if not self.ages:
+            return 0
+        return sum(self.ages) / len(self.ages)
+
+    def percentile(self, percent):
+        """Return the age at the given percentile, e.g. 50 for the median."""
+        if not self.ages:
+            return 0
+        index = min(len(self.ages) * percent // 100, len(self.ages) - 1)
+        return self.ages[index]
+
+    def number_more_than(self, seconds):
+        return len(self.ages) - bisect.bisect_left(self.ages, seconds)
+
+    def top(self, count):
+        return self.longest[:count]
+
+
+def _percentile_label(percent):
+    labels = {25: '1st quartile', 50: 'Median', 75: '3rd quartile'}
+    if percent in labels:
+        return '%s wait time' % labels[percent]
+    suffix = 'th'
+    if percent % 100 not in (11, 12, 13):
+        suffix = {1: 'st', 2: 'nd', 3: 'rd'}.get(percent % 10, 'th')
+    return '%d%s percentile wait time' % (percent, suffix)
+
+
+def _age_stat(age_stats, seconds):
+    if not age_stats:
+        return Stat('0', 0)
+    return Stat(sec_to_period_string(seconds), seconds)
 
-def format_url(url, options):
-    return '%s%s%s' % ('<a href="' if options.html else '',
-                       url,
-                       ('">%s</a>' % url) if options.html else '')
+
+def _count_stat(count):
+    return Stat('%d' % count, count)
+
+
+def _change_stat(change, key, options):
+    return Stat('%s %s (%s)' % (sec_to_period_string(change[key]),
+                                format_url(change['url'], options),
+                                change['subject']),
+                {'age': change[key], 'url': change['url'],
+                 'subject': change['subject']})
+
+
+def _wait_stats(age_stats, options):
+    stats = [('Average wait time',
+              _age_stat(age_stats, age_stats.average()))]
+    for percent in options.percentiles:
+        stats.append((_percentile_label(percent),
+                      _age_stat(age_stats, age_stats.percentile(percent))))
+    return stats
 
 
 def gen_stats(projects, waiting_on_reviewer, waiting_on_submitter, options):
-    age_sorted = sorted(waiting_on_reviewer,
-                        key=lambda change: change['age'], reverse=True)
-    age2_sorted = sorted(waiting_on_reviewer,
-                         key=lambda change: change['age2'], reverse=True)
-    age3_sorted = sorted(waiting_on_reviewer,
-                         key=lambda change: change['age3'], reverse=True)
+    age_stats = AgeStats(waiting_on_reviewer, key='age')
+    age2_stats = AgeStats(waiting_on_reviewer, key='age2')
+    age3_stats = AgeStats(waiting_on_reviewer, key='age3')
 
     result = []
-    result.append(('Projects', '%s' % [project['name']
-                                       for project in projects]))
+    names = [project['name'] for project in projects]
+    result.append(('Projects', Stat('%s' % names, names)))
     stats = []
-    stats.append(('Total Open Reviews', '%d'
-                  % (len(waiting_on_reviewer) + len(waiting_on_submitter))))
-    stats.append(('Waiting on Submitter', '%d' % len(waiting_on_submitter)))
-    stats.append(('Waiting on Reviewer', '%d' % len(waiting_on_reviewer)))
-
-    latest_rev_stats = []
-    latest_rev_stats.append(('Average wait time', '%s'
-                             % (average_age(waiting_on_reviewer))))
-    latest_rev_stats.append(('1st quartile wait time', '%s'
-                             % (quartile_age(waiting_on_reviewer,
-                                             quartile=1))))
-    latest_rev_stats.append(('Median wait time', '%s'
-                             % (quartile_age(waiting_on_reviewer))))
-    latest_rev_stats.append(('3rd quartile wait time', '%s'
-                             % (quartile_age(waiting_on_reviewer,
-                                             quartile=3))))
-    latest_rev_stats.append((
-        'Number waiting more than %i days' % options.waiting_more,
-        '%i' % (number_waiting_more_than(
-            age_sorted, 60 * 60 * 24 * options.waiting_more))))
+    stats.append(('Total Open Reviews', _count_stat(
+        len(waiting_on_reviewer) + len(waiting_on_submitter))))
+    stats.append(('Waiting on Submitter',
+                  _count_stat(len(waiting_on_submitter))))
+    stats.append(('Waiting on Reviewer',
+                  _count_stat(len(waiting_on_reviewer))))
+
+    latest_rev_stats = _wait_stats(age_stats, options)
+    for days in options.waiting_more:
+        latest_rev_stats.append((
+            'Number waiting more than %i days' % days,
+            _count_stat(age_stats.number_more_than(60 * 60 * 24 * days))))
     stats.append(('Stats since the latest revision', latest_rev_stats))
 
-    last_without_nack_stats = []
-    last_without_nack_stats.append(('Average wait time', '%s'
-                                    % (average_age(waiting_on_reviewer,
-                                                   key='age3'))))
-    last_without_nack_stats.append(('1st quartile wait time', '%s'
-                                    % (quartile_age(waiting_on_reviewer,
-                                                    quartile=1,
-                                                    key='age3'))))
-    last_without_nack_stats.append(('Median wait time', '%s'
-                                    % (quartile_age(waiting_on_reviewer,
-                                                    key='age3'))))
-    last_without_nack_stats.append(('3rd quartile wait time', '%s'
-                                    % (quartile_age(waiting_on_reviewer,
-                                                    quartile=3,
-                                                    key='age3'))))
     stats.append(('Stats since the last revision without -1 or -2 ',
-                 last_without_nack_stats))
-
-    first_rev_stats = []
-    first_rev_stats.append(('Average wait time', '%s'
-                            % (average_age(waiting_on_reviewer, key='age2'))))
-    first_rev_stats.append(('1st quartile wait time', '%s'
-                            % (quartile_age(waiting_on_reviewer, quartile=1,
-                                            key='age2'))))
-    first_rev_stats.append(('Median wait time', '%s'
-                            % (quartile_age(waiting_on_reviewer, key='age2'))))
-    first_rev_stats.append(('3rd quartile wait time', '%s'
-                            % (quartile_age(waiting_on_reviewer, quartile=3,
-                                            key='age2'))))
+                 _wait_stats(age3_stats, options)))
+
     stats.append(('Stats since the first revision (total age)',
-                  first_rev_stats))
+                  _wait_stats(age2_stats, options)))
 
     changes = []
-    for change in age_sorted[:options.longest_waiting]:
-        changes.append('%s %s (%s)' % (sec_to_period_string(change['age']),
-                                       format_url(change['url'], options),
-                                       change['subject']))
+    for change in age_stats.top(options.longest_waiting):
+        changes.append(_change_stat(change, 'age', options))
     stats.append(('Longest waiting reviews (based on latest revision)',
                  changes))
 
     changes = []
-    for change in age3_sorted[:options.longest_waiting]:
-        changes.append('%s %s (%s)' % (sec_to_period_string(change['age3']),
-                                       format_url(change['url'], options),
-                                       change['subject']))
+    for change in age3_stats.top(options.longest_waiting):
+        changes.append(_change_stat(change, 'age3', options))
     stats.append(('Longest waiting reviews (based on oldest rev without -1 or'
                  ' -2)', changes))
 
     changes = []
-    for change in age2_sorted[:options.longest_waiting]:
-        changes.append('%s %s (%s)' % (sec_to_period_string(change['age2']),
-                                       format_url(change['url'], options),
-                                       change['subject']))
+    for change in age2_stats.top(options.longest_waiting):
+        changes.append(_change_stat(change, 'age2', options))
     stats.append(('Oldest reviews (time since first revision)',
                   changes))
 
@@ -221,25 +232,35 @@ def print_stats_html(stats, f=sys.stdout):
     f.write('</html>\n')
 
 
-def find_oldest_no_nack(change):
-    last_patch = None
-    for patch in reversed(change['patchSets']):
-        nacked = False
-        for review in patch.get('approvals', []):
-            if review['value'] in ('-1', '-2'):
-                nacked = True
-                break
-        if nacked:
-            break
-        last_patch = patch
-    return last_patch
+def _stats_to_json(item):
+    if isinstance(item, list):
+        return [_stats_to_json(i) for i in item]
+    if isinstance(item, tuple):
+        return {'name': item[0], 'value': _stats_to_json(item[1])}
+    return getattr(item, 'data', item)
 
 
-def main(argv=None):
-    if argv is None:
-        argv = sys.argv
+def print_stats_json(stats, f=sys.stdout):
+    """Write the stats tree as JSON.
+
+    Lists are written as arrays, (name, value) tuples as objects with a
+    "name" and a "value", and leaves as the data they show: a list of
+    project names, counts, ages in seconds, and the age, url and subject of
+    the longest waiting changes.
+    """
+    json.dump(_stats_to_json(stats), f, indent=2)
+    f.write('\n')
+
+
+WRITERS = {
+    'html': print_stats_html,
+    'json': print_stats_json,
+    'txt': print_stats_txt,
+}
 
-    optparser = optparse.OptionParser()
+
+def make_parser():
+    optparser = optparse.OptionParser(prog='openreviews')
     optparser.add_option(
         '-p', '--project', default='projects/nova.json',
         help='JSON file describing the project to generate stats for')
@@ -257,14 +278,36 @@ def main(argv=None):
         '-l', '--longest-waiting', type='int', default=5,
         help='Show n changesets that have waited the longest)')
     optparser.add_option(
-        '-m', '--waiting-more', type='int', default=7,
-        help='Show number of changesets that have waited more than n days)')
+        '-m', '--waiting-more', type='int', action='append',
+        help='Show number of changesets that have waited more than n days '
+             '(default 7). May be given several times.')
+    optparser.add_option(
+        '--percentiles', default='25,50,75',
+        help='Comma separated list of the wait time percentiles to show')
     optparser.add_option(
         '-H', '--html', action='store_true',
-        help='Use HTML output instead of plain text')
+        help='Use HTML output instead of plain text. Same as --outputs html.')
+    optparser.add_option(
+        '--outputs', type='choice', choices=sorted(WRITERS), action='append',
+        help='Output format, one of %s (default txt). May be given several '
+             'times to write all the formats from a single run; each one '
+             'is then written to the output parameter suffixed with the '
+             'format.' % ', '.join(sorted(WRITERS)))
     optparser.add_option(
         '--server', default='review.opendev.org',
         help='Gerrit server to connect to')
+    optparser.add_option(
+        '-j', '--workers', type='int', default=1,
+        help='Number of projects to query from Gerrit concurrently')
+    optparser.add_option(
+        '--query-chunk-size', type='int', default=utils.QUERY_CHUNK_SIZE,
+        help='Maximum number of repos in one Gerrit query, projects with '
+             'more repos are queried in several chunks (default %d)'
+             % utils.QUERY_CHUNK_SIZE)
+    optparser.add_option(
+        '--query-page-size', type='int', default=utils.QUERY_PAGE_SIZE,
+        help="Number of changes asked per page of Gerrit queries, the "
+             "server's default if not given")
     optparser.add_option(
         '--debug', action='store_true', help='Show extra debug output')
     optparser.add_option(
@@ -272,76 +315,120 @@ def main(argv=None):
         help='Directory where to locate the project files')
     optparser.add_option(
         '--output', '-o', default='-',
-        help="Where to write output. - for stdout. The file will be appended"
-             " if it exists.")
-
-    options, args = optparser.parse_args()
+        help="Where to write output. - for stdout, in which case only one "
+             "output format may be given. The file will be appended if it "
+             "exists.")
 
-    logging.basicConfig(level=logging.ERROR)
-    if options.debug:
-        logging.root.setLevel(logging.DEBUG)
-
-    projects = utils.get_projects_info(options.project, options.all,
-                                       base_dir=options.projects_dir)
+    return optparser
 
-    if not projects:
-        print("Please specify a project.")
-        sys.exit(1)
-
-    changes = utils.get_changes(projects, options.user, options.key,
-                                only_open=True, server=options.server)
 
+def parse_options(argv):
+    """Parse the command line arguments, without the program name."""
+    optparser = make_parser()
+    options, args = optparser.parse_args(argv)
+    options.waiting_more = options.waiting_more or [7]
+    try:
+        options.percentiles = [int(p) for p in options.percentiles.split(',')
+                               if p.strip()]
+    except ValueError:
+        optparser.error('--percentiles must be a comma separated list of '
+                        'integers')
+    outputs = options.outputs or []
+    if options.html:
+        outputs.append('html')
+    options.outputs = []
+    for output in outputs or ['txt']:
+        if output not in options.outputs:
+            options.outputs.append(output)
+    if options.output == '-' and len(options.outputs) > 1:
+        optparser.error('only one output format may be written to stdout')
+    return options
+
+
+def classify(changes, options, now_ts):
+    """Sort the open changes by who they are waiting on.
+
+    The changes are annotated with their ``age``, ``age2`` and ``age3``
+    wait times in seconds.
+
+    :return: tuple of the changes waiting on a reviewer and the changes
+        waiting on their submitter.
+    """
     waiting_on_submitter = []
     waiting_on_reviewer = []
 
-    now = datetime.datetime.utcnow()
-    now_ts = calendar.timegm(now.timetuple())
-
     for change in changes:
         if 'rowCount' in change:
             continue
         if not options.stable and 'stable' in change['branch']:
             continue
-        if utils.is_workinprogress(change):
+        derived = utils.get_derived(change)
+        if derived['wip']:
             # Filter out WORKINPROGRESS
             continue
-        latest_patch = change['patchSets'][-1]
-        if utils.patch_set_approved(latest_patch):
+        if derived['approved'][-1]:
             # Ignore patches already approved and just waiting to merge
             continue
-        waiting_for_review = True
-        approvals = latest_patch.get('approvals', [])
-        approvals.sort(key=lambda a: a['grantedOn'])
-        for review in approvals:
-            if review['type'] not in ('CRVW', 'VRIF',
-                                      'Code-Review', 'Verified'):
-                continue
-            if review['value'] in ('-1', '-2'):
-                waiting_for_review = False
-                break
-
-        change['age'] = utils.get_age_of_patch(latest_patch, now_ts)
-        change['age2'] = utils.get_age_of_patch(change['patchSets'][0], now_ts)
-        patch = find_oldest_no_nack(change)
-        change['age3'] = utils.get_age_of_patch(patch, now_ts) if patch else 0
+        waiting_for_review = not derived['latest_nacked']
+
+        first_vote = derived['first_vote']
+        change['age'] = now_ts - first_vote[-1]
+        change['age2'] = now_ts - first_vote[0]
+        oldest = derived['oldest_no_nack']
+        change['age3'] = 0
+        if oldest is not None:
+            change['age3'] = now_ts - first_vote[oldest]
 
         if waiting_for_review:
             waiting_on_reviewer.append(change)
         else:
             waiting_on_submitter.append(change)
 
+    return waiting_on_reviewer, waiting_on_submitter
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    options = parse_options(argv[1:])
+
+    logging.basicConfig(level=logging.ERROR)
+    if options.debug:
+        logging.root.setLevel(logging.DEBUG)
+
+    projects = utils.get_projects_info(options.project, options.all,
+                                       base_dir=options.projects_dir)
+
+    if not projects:
+        print("Please specify a project.")
+        sys.exit(1)
+
+    changes = utils.get_changes(projects, options.user, options.key,
+                                only_open=True,
+                                fields=('patchSets', 'approvals'),
+                                server=options.server,
+                                workers=options.workers,
+                                chunk_size=options.query_chunk_size,
+                                page_size=options.query_page_size)
+
+    now = datetime.datetime.utcnow()
+    now_ts = calendar.timegm(now.timetuple())
+    waiting_on_reviewer, waiting_on_submitter = classify(changes, options,
+                                                         now_ts)
+
     stats = gen_stats(projects, waiting_on_reviewer, waiting_on_submitter,
                       options)
 
-    if options.output == '-':
-        output = sys.stdout
-    else:
-        output = open(options.output, 'at')
-    try:
-        if options.html:
-            print_stats_html(stats, f=output)
+    for fmt in options.outputs:
+        if options.output == '-':
+            output = sys.stdout
+        elif len(options.outputs) > 1:
+            output = open('%s.%s' % (options.output, fmt), 'at')
         else:
-            print_stats_txt(stats, f=output)
-    finally:
-        if output is not sys.stdout:
-            output.close()
+            output = open(options.output, 'at')
+        try:
+            WRITERS[fmt](stats, f=output)
+        finally:
+            if output is not sys.stdout:
+                output.close()
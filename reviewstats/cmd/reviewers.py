@@ -16,12 +16,16 @@
 
 import argparse
 import calendar
+import copy
 import csv
 import datetime
 import getpass
+import json
 import prettytable
 import sys
 
+from reviewstats import columnar
+from reviewstats import model
 from reviewstats import utils
 
 
@@ -45,13 +49,41 @@ def set_defaults(reviewer, reviewers):
     reviewers[reviewer].setdefault('received', 0)
 
 
-def process_patchset(project, patchset, reviewers, ts, options):
+class Window(object):
+    """Reviewer and change statistics for the last ``days`` days."""
+
+    def __init__(self, days, now):
+        self.days = days
+        cut_off = now - datetime.timedelta(days=days)
+        self.ts = calendar.timegm(cut_off.timetuple())
+        self.reviewers = {}
+        self.change_stats = {
+            'patches': 0,
+            'created': 0,
+            'involved': 0,
+            'merged': 0,
+            'abandoned': 0,
+            'wip': 0,
+        }
+
+
+def process_patchset(project, patchset, windows, options, core_team=None):
+    """Count the reviews of a patchset in every window it falls into.
+
+    :param dict project: Project info the patchset belongs to.
+    :param dict patchset: De-serialized dict of a gerrit patchset.
+    :param windows: List of :class:`Window` to update.
+    :param options: Command line options.
+    :param core_team: Set of the project's core reviewers. Resolved from
+        the project if not given.
+    """
     latest_core_neg_vote = 0
     latest_core_pos_vote = 0
 
     submitter = patchset['uploader'].get('username', 'unknown')
-    core_team = utils.get_core_team(project, options.server, options.user,
-        options.password)
+    if core_team is None:
+        core_team = utils.get_core_team(project, options.server,
+                                        options.user, options.password)
 
     for review in patchset.get('approvals', []):
         if review['type'] != 'Code-Review':
@@ -61,7 +93,7 @@ def process_patchset(project, patchset, reviewers, ts, options):
         if review['by'].get('username', 'unknown') not in core_team:
             # Only checking for disagreements from core team members
             continue
-        if int(review['value']) > 0:
+        if model.vote_value(review) > 0:
             latest_core_pos_vote = max(latest_core_pos_vote,
                                        int(review['grantedOn']))
         else:
@@ -69,39 +101,121 @@ def process_patchset(project, patchset, reviewers, ts, options):
                                        int(review['grantedOn']))
 
     for review in patchset.get('approvals', []):
-        if review['grantedOn'] < ts:
-            continue
-
         if review['type'] not in ('Code-Review', 'Approved', 'Workflow'):
             continue
 
         reviewer = review['by'].get('username', 'unknown')
-        set_defaults(reviewer, reviewers)
-
-        if (review['type'] == 'Approved'
-            or (review['type'] == 'Workflow'
-                and int(review['value']) > 0)):
-            cur = reviewers[reviewer]['votes']['A']
-            reviewers[reviewer]['votes']['A'] = cur + 1
-        elif review['type'] != 'Workflow':
-            cur_total = reviewers[reviewer].get('total', 0)
-            reviewers[reviewer]['total'] = cur_total + 1
-            set_defaults(submitter, reviewers)
-            reviewers[submitter]['received'] += 1
-            cur = reviewers[reviewer]['votes'][review['value']]
-            reviewers[reviewer]['votes'][review['value']] = cur + 1
-            if (review['value'] in ('1', '2')
-                    and int(review['grantedOn']) < latest_core_neg_vote):
-                # A core team member gave a negative vote after this person
-                # gave a positive one
-                cur = reviewers[reviewer]['disagreements']
-                reviewers[reviewer]['disagreements'] = cur + 1
-            if (review['value'] in ('-1', '-2')
-                    and int(review['grantedOn']) < latest_core_pos_vote):
-                # A core team member gave a positive vote after this person
-                # gave a negative one
-                cur = reviewers[reviewer]['disagreements']
-                reviewers[reviewer]['disagreements'] = cur + 1
+        value = model.vote_value(review)
+
+        for window in windows:
+            if review['grantedOn'] < window.ts:
+                continue
+            reviewers = window.reviewers
+            set_defaults(reviewer, reviewers)
+
+            if (review['type'] == 'Approved'
+                or (review['type'] == 'Workflow'
+                    and value > 0)):
+                cur = reviewers[reviewer]['votes']['A']
+                reviewers[reviewer]['votes']['A'] = cur + 1
+            elif review['type'] != 'Workflow':
+                cur_total = reviewers[reviewer].get('total', 0)
+                reviewers[reviewer]['total'] = cur_total + 1
+                set_defaults(submitter, reviewers)
+                reviewers[submitter]['received'] += 1
+                cur = reviewers[reviewer]['votes'][review['value']]
+                reviewers[reviewer]['votes'][review['value']] = cur + 1
+                if (value in (1, 2)
+                        and int(review['grantedOn']) < latest_core_neg_vote):
+                    # A core team member gave a negative vote after this
+                    # person gave a positive one
+                    cur = reviewers[reviewer]['disagreements']
+                    reviewers[reviewer]['disagreements'] = cur + 1
+                if (value in (-1, -2)
+                        and int(review['grantedOn']) < latest_core_pos_vote):
+                    # A core team member gave a positive vote after this
+                    # person gave a negative one
+                    cur = reviewers[reviewer]['disagreements']
+                    reviewers[reviewer]['disagreements'] = cur + 1
+
+
+def process_change(project, change, windows, options, core_team=None,
+                   table=None):
+    """Count the patchsets and reviews of a change in every window.
+
+    :param table: :class:`reviewstats.columnar.ApprovalTable` to append the
+        reviews to instead of counting them in the windows' reviewers.
+    """
+    if core_team is None:
+        core_team = utils.get_core_team(project, options.server,
+                                        options.user, options.password)
+    involved = set()
+    first_patchset = True
+    first_vote = utils.get_derived(change)['first_vote']
+    for index, patchset in enumerate(change.get('patchSets', [])):
+        if table is not None:
+            table.add_patchset(patchset, core_team)
+        else:
+            process_patchset(project, patchset, windows, options, core_team)
+        for window in windows:
+            if first_vote[index] > window.ts:
+                window.change_stats['patches'] += 1
+                involved.add(window)
+                if first_patchset:
+                    window.change_stats['created'] += 1
+        first_patchset = False
+    for window in involved:
+        window.change_stats['involved'] += 1
+        if change['status'] == 'MERGED':
+            window.change_stats['merged'] += 1
+        elif change['status'] == 'ABANDONED':
+            window.change_stats['abandoned'] += 1
+        elif change['status'] == 'WORKINPROGRESS':
+            window.change_stats['wip'] += 1
+
+
+def summarise(reviewers, projects, options, core_index=None):
+    """Compute the per reviewer report rows of a window.
+
+    :param core_index: :class:`reviewstats.utils.CoreTeamIndex` of the
+        projects. Built from the projects if not given.
+
+    :return: tuple of the sorted (stats, name) reviewers list, the report
+        rows and the totals.
+    """
+    reviewers = [(v, k) for k, v in reviewers.items()
+                 if k.lower() not in ('jenkins', 'smokestack')]
+    reviewers.sort(reverse=True, key=lambda r: r[0]['total'])
+    # Do logical processing of reviewers.
+    reviewer_data = []
+    totals = {
+        'all': 0,
+        'core': 0,
+    }
+    if core_index is None:
+        core_index = utils.CoreTeamIndex(projects, options.server,
+                                         options.user, options.password)
+    for k, v in reviewers:
+        in_core_team = core_index.is_core(v)
+        name = '%s%s' % (v, ' **' if in_core_team else '')
+        plus = float(k['votes']['2'] + k['votes']['1'])
+        minus = float(k['votes']['-2'] + k['votes']['-1'])
+        all_reviews = plus + minus
+        ratio = ((plus / (all_reviews)) * 100) if all_reviews > 0 else 0
+        r = (k['total'], k['votes']['-2'],
+             k['votes']['-1'], k['votes']['1'],
+             k['votes']['2'], k['votes']['A'], "%5.1f%%" % ratio)
+        dratio = (((float(k['disagreements']) / all_reviews) * 100)
+                  if all_reviews else 0.0)
+        d = (k['disagreements'], "%5.1f%%" % dratio)
+        sratio = ((float(k['total']) / k['received']) * 100
+                  if k['received'] else 0)
+        s = (k['received'], "%5.1f%%" % sratio if k['received'] else 'inf')
+        reviewer_data.append((name, r, d, s))
+        totals['all'] += k['total']
+        if in_core_team:
+            totals['core'] += k['total']
+    return reviewers, reviewer_data, totals
 
 
 def write_csv(reviewer_data, file_obj, options, reviewers, projects,
@@ -233,11 +347,8 @@ def write_pretty(reviewer_data, file_obj, options, reviewers, projects,
             'received.\n')
 
 
-def main(argv=None):
-    if argv is None:
-        argv = sys.argv
-
-    optparser = argparse.ArgumentParser()
+def make_parser():
+    optparser = argparse.ArgumentParser(prog='reviewers')
     # --stable and --project are mutually exclusive right now, so if
     # --project is specified it's likely an attempt to only show stable
     # reviews for a given project which isn't how --stable works right now
@@ -265,10 +376,13 @@ def main(argv=None):
              'the output parameter to generate file names.')
     optparser.add_argument(
         '--outputs', default=['txt'], action='append',
-        help='Select what outputs to generate. (txt,csv).')
+        help='Select what outputs to generate. (txt,csv,json).')
     optparser.add_argument(
-        '-d', '--days', type=int, default=14,
-        help='Number of days to consider')
+        '-d', '--days', type=int, action='append',
+        help='Number of days to consider (default 14). May be given several '
+             'times to compute one report per number of days in a single '
+             'pass; each report is then written to the output parameter '
+             'suffixed with "-DAYS".')
     optparser.add_argument(
         '-u', '--user', default=getpass.getuser(), help='gerrit user')
     optparser.add_argument(
@@ -282,113 +396,168 @@ def main(argv=None):
     optparser.add_argument(
         '--server', default='review.opendev.org',
         help='Gerrit server to connect to')
+    optparser.add_argument(
+        '--full-history', action='store_true',
+        help='Cache the entire history of projects that are not cached yet, '
+             'instead of only fetching the changes updated within --days')
+    optparser.add_argument(
+        '--compact', action='store_true',
+        help='Hold changes in a compact representation to reduce memory '
+             'use on large histories')
+    optparser.add_argument(
+        '--engine', choices=('python', 'columnar'), default='python',
+        help='How to aggregate the reviews. "columnar" flattens them into '
+             'arrays and aggregates them with NumPy, which must be '
+             'installed.')
+    optparser.add_argument(
+        '-j', '--workers', type=int, default=1,
+        help='Number of projects to query from Gerrit concurrently')
+    optparser.add_argument(
+        '--query-chunk-size', type=int, default=utils.QUERY_CHUNK_SIZE,
+        help='Maximum number of repos in one Gerrit query, projects with '
+             'more repos are queried in several chunks (default %d)'
+             % utils.QUERY_CHUNK_SIZE)
+    optparser.add_argument(
+        '--query-page-size', type=int, default=utils.QUERY_PAGE_SIZE,
+        help="Number of changes asked per page of Gerrit queries, the "
+             "server's default if not given")
+
+    return optparser
+
 
-    options = optparser.parse_args()
+def parse_options(argv):
+    """Parse the command line arguments, without the program name."""
+    optparser = make_parser()
+    options = optparser.parse_args(argv)
+    if options.engine == 'columnar' and not columnar.available():
+        optparser.error('the columnar engine requires NumPy')
+    return options
 
+
+def get_projects(options, base_dir='./projects/'):
     if options.stable:
-        projects = utils.get_projects_info('projects/stable.json', False)
-    else:
-        projects = utils.get_projects_info(options.project, options.all)
+        return utils.get_projects_info('stable', False, base_dir=base_dir)
+    return utils.get_projects_info(options.project, options.all,
+                                   base_dir=base_dir)
+
+
+def make_windows(options, now=None):
+    """Return the :class:`Window` of each of the --days options."""
+    if now is None:
+        now = datetime.datetime.utcnow()
+    return [Window(days, now) for days in sorted(set(options.days or [14]))]
+
+
+def compute(options, project_changes, windows, core_index):
+    """Fill the windows with the reviews of the given changes.
+
+    :param project_changes: Iterable of (project, changes) tuples, as
+        yielded by :func:`reviewstats.utils.iter_project_changes`.
+    """
+    table = None
+    if options.engine == 'columnar':
+        table = columnar.ApprovalTable()
+
+    for project, changes in project_changes:
+        for change in changes.values():
+            process_change(project, change, windows, options,
+                           core_index.team(project), table)
+
+    if table is not None:
+        for window in windows:
+            window.reviewers = table.reviewers(window.ts)
+
+
+def write_json(reviewer_data, file_obj, options, reviewers, projects,
+               totals, change_stats):
+    """Write out reviewers and totals as JSON."""
+    rows = []
+    for (name, r_data, d_data, s_data) in reviewer_data:
+        core = name.endswith(' **')
+        rows.append({
+            'reviewer': name[:-3] if core else name,
+            'core': core,
+            'reviews': r_data[0],
+            'votes': dict(zip(('-2', '-1', '+1', '+2', '+A'), r_data[1:6])),
+            'positive_ratio': r_data[6].strip(),
+            'disagreements': d_data[0],
+            'disagreement_ratio': d_data[1].strip(),
+        })
+        if ENABLE_RECEIVED:
+            rows[-1]['received'] = s_data[0]
+    json.dump({
+        'days': options.days,
+        'projects': [project['name'] for project in projects],
+        'reviewers': rows,
+        'totals': totals,
+        'changes': change_stats,
+    }, file_obj, indent=2)
+    file_obj.write('\n')
+
+
+WRITERS = {
+    'csv': write_csv,
+    'json': write_json,
+    'txt': write_pretty,
+}
+
+
+def write_window(window, output, file_obj, options, projects, core_index):
+    """Write the report of a window in the given output format."""
+    window_options = copy.copy(options)
+    window_options.days = window.days
+    reviewers, reviewer_data, totals = summarise(
+        window.reviewers, projects, window_options, core_index)
+    WRITERS[output](reviewer_data, file_obj, window_options, reviewers,
+                    projects, totals, window.change_stats)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    options = parse_options(argv[1:])
+    projects = get_projects(options)
 
     if not projects:
         print("Please specify a project.")
         sys.exit(1)
 
-    reviewers = {}
+    utils.prefetch_core_teams(projects, options.server, options.user,
+                              options.password, workers=options.workers)
+    core_index = utils.CoreTeamIndex(projects, options.server, options.user,
+                                     options.password)
 
-    now = datetime.datetime.utcnow()
-    cut_off = now - datetime.timedelta(days=options.days)
-    ts = calendar.timegm(cut_off.timetuple())
-    now_ts = calendar.timegm(now.timetuple())
+    windows = make_windows(options, datetime.datetime.utcnow())
 
-    change_stats = {
-        'patches': 0,
-        'created': 0,
-        'involved': 0,
-        'merged': 0,
-        'abandoned': 0,
-        'wip': 0,
-    }
-
-    for project in projects:
-        changes = utils.get_changes([project], options.user, options.key,
-                                    stable=options.stable,
-                                    server=options.server)
-        for change in changes:
-            patch_for_change = False
-            first_patchset = True
-            for patchset in change.get('patchSets', []):
-                process_patchset(project, patchset, reviewers, ts, options)
-                age = utils.get_age_of_patch(patchset, now_ts)
-                if (now_ts - age) > ts:
-                    change_stats['patches'] += 1
-                    patch_for_change = True
-                    if first_patchset:
-                        change_stats['created'] += 1
-                first_patchset = False
-            if patch_for_change:
-                change_stats['involved'] += 1
-                if change['status'] == 'MERGED':
-                    change_stats['merged'] += 1
-                elif change['status'] == 'ABANDONED':
-                    change_stats['abandoned'] += 1
-                elif change['status'] == 'WORKINPROGRESS':
-                    change_stats['wip'] += 1
+    compute(options, utils.iter_project_changes(
+        projects, options.user, options.key, stable=options.stable,
+        server=options.server, workers=options.workers,
+        updated_since=min(window.ts for window in windows),
+        full_history=options.full_history, compact=options.compact,
+        chunk_size=options.query_chunk_size,
+        page_size=options.query_page_size),
+        windows, core_index)
 
-    reviewers = [(v, k) for k, v in reviewers.items()
-                 if k.lower() not in ('jenkins', 'smokestack')]
-    reviewers.sort(reverse=True, key=lambda r: r[0]['total'])
-    # Do logical processing of reviewers.
-    reviewer_data = []
-    totals = {
-        'all': 0,
-        'core': 0,
-    }
-    for k, v in reviewers:
-        in_core_team = False
-        for project in projects:
-            if v in utils.get_core_team(project, options.server, options.user,
-                    options.password):
-                in_core_team = True
-                break
-        name = '%s%s' % (v, ' **' if in_core_team else '')
-        plus = float(k['votes']['2'] + k['votes']['1'])
-        minus = float(k['votes']['-2'] + k['votes']['-1'])
-        all_reviews = plus + minus
-        ratio = ((plus / (all_reviews)) * 100) if all_reviews > 0 else 0
-        r = (k['total'], k['votes']['-2'],
-             k['votes']['-1'], k['votes']['1'],
-             k['votes']['2'], k['votes']['A'], "%5.1f%%" % ratio)
-        dratio = (((float(k['disagreements']) / all_reviews) * 100)
-                  if all_reviews else 0.0)
-        d = (k['disagreements'], "%5.1f%%" % dratio)
-        sratio = ((float(k['total']) / k['received']) * 100
-                  if k['received'] else 0)
-        s = (k['received'], "%5.1f%%" % sratio if k['received'] else 'inf')
-        reviewer_data.append((name, r, d, s))
-        totals['all'] += k['total']
-        if in_core_team:
-            totals['core'] += k['total']
     # And output.
-    writers = {
-        'csv': write_csv,
-        'txt': write_pretty,
-        }
     if options.output == '-':
-        if len(options.outputs) != 1:
+        if len(options.outputs) != 1 or len(windows) != 1:
             raise Exception("Can only output one format to stdout.")
-    for output in options.outputs:
-        if options.output == '-':
-            file_obj = sys.stdout
-            on_done = None
-        else:
-            file_obj = open(options.output + '.' + output, 'wt')
-            on_done = file_obj.close
-        try:
-            writer = writers[output]
-            writer(reviewer_data, file_obj, options, reviewers, projects,
-                   totals, change_stats)
-        finally:
-            if on_done:
-                on_done()
+    for window in windows:
+        output_base = options.output
+        if len(windows) > 1:
+            output_base = '%s-%d' % (options.output, window.days)
+        for output in options.outputs:
+            if options.output == '-':
+                file_obj = sys.stdout
+                on_done = None
+            else:
+                file_obj = open(output_base + '.' + output, 'wt')
+                on_done = file_obj.close
+            try:
+                write_window(window, output, file_obj, options, projects,
+                             core_index)
+            finally:
+                if on_done:
+                    on_done()
     return 0
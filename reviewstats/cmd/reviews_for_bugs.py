@@ -14,15 +14,27 @@
 
 
 from argparse import ArgumentParser
+import concurrent.futures
 import getpass
+import json
 from launchpadlib.launchpad import Launchpad
-import re
+import sys
 
+from reviewstats import bugs
+from reviewstats import store
 from reviewstats import utils
 
 
-def main():
+# Gerrit search predicate of the changes with a bug topic
+BUG_TOPIC_Q = 'topic:^bug/.*'
+
+# Statuses of the bug tasks the changes are listed for
+OPEN_STATUSES = ('New', 'Incomplete', 'Confirmed', 'Triaged', 'In Progress')
+
+
+def make_parser():
     parser = ArgumentParser(
+        prog='reviews_for_bugs',
         description="Get reviews for open bugs against a milestone")
     parser.add_argument(
         '-p', '--project', default='projects/nova.json',
@@ -33,58 +45,159 @@ def main():
     parser.add_argument(
         '-u', '--user', default=getpass.getuser(), help='gerrit user')
     parser.add_argument('-k', '--key', default=None, help='ssh key for gerrit')
+    parser.add_argument(
+        '--footers', action='store_true',
+        help='Also list the changes with a Closes-Bug or Partial-Bug footer '
+             'for a bug, not only those with a bug/<id> topic')
+    return parser
 
-    args = parser.parse_args()
-
-    projects = utils.get_projects_info(args.project, False)
-    project_name = projects[0]['name']
-
-    if not projects:
-        print("Please specify a project.")
-        return 1
 
+def get_bug_tasks(project_name, milestone=''):
+    """Return the open Launchpad bug tasks of a project, by bug id."""
     launchpad = Launchpad.login_with('openstack-releasing', 'production')
     proj = launchpad.projects[project_name]
-    statuses = ['New', 'Incomplete', 'Confirmed', 'Triaged', 'In Progress']
-    if args.milestone:
-        milestone = proj.getMilestone(name=args.milestone)
+    statuses = list(OPEN_STATUSES)
+    if milestone:
+        milestone = proj.getMilestone(name=milestone)
         bugtasks = proj.searchTasks(status=statuses, milestone=milestone)
     else:
         bugtasks = proj.searchTasks(status=statuses)
     bugs_by_id = {}
     for bt in bugtasks:
-        bugs_by_id[str(bt.bug.id)] = bt
+        # The id is the end of the bug link, no need to fetch the bug
+        bugs_by_id[bugs.bug_id(bt.bug_link)] = bt
+    return bugs_by_id
 
-    milestones = {}
 
-    changes = utils.get_changes(projects, args.user, args.key, only_open=True)
-    bug_regex = re.compile(r'bug/(\d+)')
+def stored_bug_tasks(cache, project_name, milestone=''):
+    """Return the open bug tasks of a project from the bug mirror, by bug id.
+
+    :param cache: :class:`reviewstats.bugs.BugStore` the Launchpad project
+        was synced to.
+    """
+    bugs_by_id = {}
+    for bt, bug in cache.iter_tasks(project_name, OPEN_STATUSES):
+        if milestone and milestone_name(bt) != milestone:
+            continue
+        bugs_by_id[bugs.bug_id(bt.bug_link)] = bt
+    return bugs_by_id
+
+
+def milestone_name(bugtask):
+    """Return the name of the milestone of a bug task, or "None"."""
+    return str(bugtask.milestone_link).split('/')[-1]
+
+
+def topic_bug_refs(changes):
+    """Yield (change url, bug id) for each change with a bug topic."""
     for change in changes:
         if 'topic' not in change:
             continue
-        match = bug_regex.match(change['topic'])
-        if not match:
-            continue
-        bugid = match.group(1)
+        match = store.BUG_TOPIC.match(change['topic'])
+        if match:
+            yield change['url'], match.group(1)
+
+
+def group_by_milestone(changes, bugs_by_id):
+    """Group the changes with a bug topic by the milestone of their bug.
+
+    :return: dict of lists of (change url, bug id) tuples, by milestone
+        name.
+    """
+    return group_refs_by_milestone(topic_bug_refs(changes), bugs_by_id)
+
+
+def group_refs_by_milestone(refs, bugs_by_id):
+    """Group (change url, bug id) tuples by the milestone of their bug.
+
+    :return: dict of lists of (change url, bug id) tuples, by milestone
+        name.
+    """
+    milestones = {}
+
+    for url, bugid in refs:
         try:
-            bugtask = bugs_by_id[bugid]
-            milestone = str(bugtask.milestone).split('/')[-1]
+            milestone = milestone_name(bugs_by_id[bugid])
             if milestone == 'None':
                 milestone = 'Untargeted'
         except KeyError:
             milestone = 'Bug does not exist for this project'
 
         milestones.setdefault(milestone, [])
-        milestones[milestone].append((change['url'], bugid))
+        milestones[milestone].append((url, bugid))
+    return milestones
+
 
-    print('Reviews for bugs grouped by milestone for project: %s\n' % (
-          project_name))
+def write_txt(milestones, project_name, only_milestone='', f=sys.stdout):
+    f.write('Reviews for bugs grouped by milestone for project: %s\n\n' % (
+            project_name))
 
     for milestone, reviews in milestones.items():
-        if args.milestone and milestone != args.milestone:
+        if only_milestone and milestone != only_milestone:
             continue
-        print('Milestone: %s' % milestone)
+        f.write('Milestone: %s\n' % milestone)
         for review, bugid in reviews:
-            print('--> %s -- https://bugs.launchpad.net/%s/+bug/%s' %
-                  (review, project_name, bugid))
-        print()
+            f.write('--> %s -- https://bugs.launchpad.net/%s/+bug/%s\n' %
+                    (review, project_name, bugid))
+        f.write('\n')
+
+
+def write_json(milestones, project_name, only_milestone='', f=sys.stdout):
+    json.dump({
+        'project': project_name,
+        'milestones': dict(
+            (milestone, [{'url': url, 'bug': bugid}
+                         for url, bugid in reviews])
+            for milestone, reviews in milestones.items()
+            if not only_milestone or milestone == only_milestone),
+    }, f, indent=2)
+    f.write('\n')
+
+
+WRITERS = {
+    'txt': write_txt,
+    'json': write_json,
+}
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    args = make_parser().parse_args(argv[1:])
+
+    projects = utils.get_projects_info(args.project, False)
+
+    if not projects:
+        print("Please specify a project.")
+        return 1
+
+    project_name = projects[0]['name']
+    # Fetch the bug tasks from Launchpad while querying Gerrit.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        bug_tasks = pool.submit(get_bug_tasks, project_name, args.milestone)
+        if args.footers:
+            # Footers are looked up in the bug index of the change store
+            utils.sync_projects(projects, args.user, args.key,
+                                full_history=True, fields=('commitMessage',))
+        else:
+            # Only the topics are needed, ask Gerrit for nothing more
+            changes = utils.get_changes(projects, args.user, args.key,
+                                        only_open=True, fields=(),
+                                        predicate=BUG_TOPIC_Q)
+        bugs_by_id = bug_tasks.result()
+
+    if args.footers:
+        cache = store.ChangeStore()
+        try:
+            refs = [(change['url'], bugid)
+                    for bugid, change in cache.iter_bug_changes(
+                        [repo for project in projects
+                         for repo in project['subprojects']],
+                        store.BUG_SOURCES, only_open=True)]
+        finally:
+            cache.close()
+    else:
+        refs = topic_bug_refs(changes)
+    write_txt(group_refs_by_milestone(refs, bugs_by_id), project_name,
+              args.milestone)
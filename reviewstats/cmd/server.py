@@ -0,0 +1,402 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Serve the reports over HTTP from changes held in memory.
+
+The changes of the projects asked for are loaded from the change store
+once, then kept up to date by an incremental refresh on a schedule, and
+optionally by the Gerrit event stream. The Launchpad bug tasks of the
+reviews_for_bugs report are mirrored and refreshed the same way. Each
+report is served at its command name::
+
+    GET /reviewers?project=nova&days=30&format=csv
+    GET /openreviews?all&format=html
+    GET /openapproved?project=cinder&format=json
+    GET /reviews_for_bugs?project=nova&milestone=zed-1
+
+Query parameters are the long options of the command line tools, without
+the leading dashes. Parameters without a value, such as ``all``, are
+passed as flags. ``format`` selects the output format of the report.
+"""
+
+import argparse
+import calendar
+import datetime
+import getpass
+import http.server
+import io
+import json
+import logging
+import sys
+import threading
+import urllib.parse
+
+from launchpadlib.launchpad import Launchpad
+
+from reviewstats import bugs
+from reviewstats.cmd import openapproved
+from reviewstats.cmd import openreviews
+from reviewstats.cmd import reviewers
+from reviewstats.cmd import reviews_for_bugs
+from reviewstats import events
+from reviewstats import utils
+
+LOG = logging.getLogger(__name__)
+
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'html': 'text/html; charset=utf-8',
+    'json': 'application/json',
+    'txt': 'text/plain; charset=utf-8',
+}
+
+
+class BadRequest(Exception):
+    pass
+
+
+class BugTaskCache(object):
+    """Open Launchpad bug tasks of the served projects.
+
+    Tasks are read from the :mod:`reviewstats.bugs` mirror. A project is
+    synced into it the first time a report asks for it, then only by
+    :meth:`refresh`, so that requests do not search Launchpad.
+
+    :param callable login: Return a logged in
+        :class:`launchpadlib.launchpad.Launchpad`. launchpadlib objects may
+        not be shared between threads, each thread logs in with its own
+        session.
+    """
+
+    def __init__(self, login, path=bugs.BUGS_DB):
+        self.login = login
+        self.path = path
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._store = None
+        self._projects = []
+
+    def _sync(self, lp_project):
+        launchpad = getattr(self._local, 'launchpad', None)
+        if launchpad is None:
+            launchpad = self._local.launchpad = self.login()
+        bugs.sync_project(launchpad, lp_project, self._store)
+
+    def tasks(self, project_name, milestone=''):
+        """Return the open bug tasks of a project, by bug id.
+
+        See :func:`reviewstats.cmd.reviews_for_bugs.get_bug_tasks`.
+        """
+        with self._lock:
+            if self._store is None:
+                self._store = bugs.BugStore(self.path)
+            if project_name not in self._projects:
+                self._sync(project_name)
+                self._projects.append(project_name)
+        return reviews_for_bugs.stored_bug_tasks(self._store, project_name,
+                                                 milestone)
+
+    def refresh(self):
+        """Sync the mirrored projects with Launchpad."""
+        with self._lock:
+            for lp_project in self._projects:
+                self._sync(lp_project)
+
+
+def _now_ts():
+    return calendar.timegm(datetime.datetime.utcnow().timetuple())
+
+
+def _check_format(fmt, writers):
+    if fmt not in writers:
+        raise BadRequest('Unsupported format %s, use one of: %s'
+                         % (fmt, ', '.join(sorted(writers))))
+
+
+def reviewers_report(httpd, argv, fmt, f):
+    """Write the reviewers report of each of the requested windows.
+
+    Text reports are written one after the other, and JSON reports as a
+    list when there are several windows. CSV holds a single window.
+    """
+    options = reviewers.parse_options(argv)
+    utils.set_server_options(options, httpd.settings)
+    fmt = fmt or 'txt'
+    _check_format(fmt, reviewers.WRITERS)
+    windows = reviewers.make_windows(options)
+    if fmt == 'csv' and len(windows) != 1:
+        raise BadRequest('Only one number of days may be given with csv')
+    projects = reviewers.get_projects(options, base_dir=options.projects_dir)
+    if not projects:
+        raise BadRequest('Unknown project %s' % options.project)
+    core_index = utils.CoreTeamIndex(projects, options.server, options.user,
+                                     options.password)
+    reviewers.compute(options, httpd.cache.project_changes(
+        projects, stable=options.stable,
+        updated_since=min(window.ts for window in windows)),
+        windows, core_index)
+    if fmt == 'json' and len(windows) > 1:
+        reports = []
+        for window in windows:
+            window_f = io.StringIO()
+            reviewers.write_window(window, fmt, window_f, options, projects,
+                                   core_index)
+            reports.append(json.loads(window_f.getvalue()))
+        json.dump(reports, f, indent=2)
+        f.write('\n')
+        return fmt
+    for index, window in enumerate(windows):
+        if index:
+            f.write('\n')
+        reviewers.write_window(window, fmt, f, options, projects,
+                               core_index)
+    return fmt
+
+
+def openreviews_report(httpd, argv, fmt, f):
+    options = openreviews.parse_options(argv)
+    utils.set_server_options(options, httpd.settings)
+    fmt = fmt or options.outputs[0]
+    _check_format(fmt, openreviews.WRITERS)
+    projects = utils.get_projects_info(options.project, options.all,
+                                       base_dir=options.projects_dir)
+    if not projects:
+        raise BadRequest('Unknown project %s' % options.project)
+    # classify() annotates the changes, copy them so that concurrent
+    # requests do not see each other's ages.
+    changes = [dict(change)
+               for change in httpd.cache.changes(projects, only_open=True)]
+    waiting_on_reviewer, waiting_on_submitter = openreviews.classify(
+        changes, options, _now_ts())
+    stats = openreviews.gen_stats(projects, waiting_on_reviewer,
+                                  waiting_on_submitter, options)
+    openreviews.WRITERS[fmt](stats, f=f)
+    return fmt
+
+
+def openapproved_report(httpd, argv, fmt, f):
+    options = openapproved.parse_options(argv)
+    utils.set_server_options(options, httpd.settings)
+    fmt = fmt or 'txt'
+    _check_format(fmt, openapproved.WRITERS)
+    projects = utils.get_projects_info(options.project, options.all,
+                                       base_dir=options.projects_dir)
+    if not projects:
+        raise BadRequest('Unknown project %s' % options.project)
+    result = openapproved.find_approved_and_rebased(
+        httpd.cache.changes(projects, only_open=True), options)
+    openapproved.WRITERS[fmt](result, f=f)
+    return fmt
+
+
+def reviews_for_bugs_report(httpd, argv, fmt, f):
+    args = reviews_for_bugs.make_parser().parse_args(argv)
+    utils.set_server_options(args, httpd.settings)
+    fmt = fmt or 'txt'
+    _check_format(fmt, reviews_for_bugs.WRITERS)
+    projects = utils.get_projects_info(args.project, False,
+                                       base_dir=args.projects_dir)
+    if not projects:
+        raise BadRequest('Unknown project %s' % args.project)
+    project_name = projects[0]['name']
+    milestones = reviews_for_bugs.group_by_milestone(
+        httpd.cache.changes(projects, only_open=True),
+        httpd.bug_tasks.tasks(project_name, args.milestone))
+    reviews_for_bugs.WRITERS[fmt](milestones, project_name, args.milestone,
+                                  f=f)
+    return fmt
+
+
+REPORTS = {
+    'reviewers': reviewers_report,
+    'openreviews': openreviews_report,
+    'openapproved': openapproved_report,
+    'reviews_for_bugs': reviews_for_bugs_report,
+}
+
+
+def query_to_argv(query):
+    """Convert a query string to command line arguments.
+
+    :return: tuple of the arguments and the requested format, or None.
+    """
+    argv = []
+    fmt = None
+    for name, value in urllib.parse.parse_qsl(query, keep_blank_values=True):
+        name = name.replace('_', '-')
+        if name == 'format':
+            fmt = value
+        elif name.replace('-', '_') in utils.SERVER_OPTIONS:
+            raise BadRequest('%s may not be given per request' % name)
+        elif value == '':
+            argv.append('--%s' % name)
+        else:
+            argv.append('--%s=%s' % (name, value))
+    return argv, fmt
+
+
+class ReportHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the reports from the server's :class:`utils.ChangeCache`."""
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        report = REPORTS.get(url.path.strip('/'))
+        if report is None:
+            self._reply(404, 'txt', 'Unknown report %s\n' % url.path)
+            return
+        f = io.StringIO()
+        try:
+            argv, fmt = query_to_argv(url.query)
+            fmt = report(self.server, argv, fmt, f)
+        except BadRequest as e:
+            self._reply(400, 'txt', '%s\n' % e)
+        except SystemExit:
+            # The option parser rejected the arguments
+            self._reply(400, 'txt', 'Invalid options\n')
+        except Exception:
+            LOG.exception('Failed to generate %s', self.path)
+            self._reply(500, 'txt', 'Internal error\n')
+        else:
+            self._reply(200, fmt, f.getvalue())
+
+    def _reply(self, status, fmt, body):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', CONTENT_TYPES[fmt])
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOG.info('%s %s', self.address_string(), format % args)
+
+
+class ReportServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, cache, settings=None, bug_tasks=None):
+        http.server.ThreadingHTTPServer.__init__(self, address,
+                                                 ReportHandler)
+        self.cache = cache
+        self.settings = settings or {}
+        self.bug_tasks = bug_tasks
+
+
+def event_consumer(cache, server, user, key):
+    """Return an :class:`events.EventConsumer` updating the cache.
+
+    Only the events of the loaded projects are applied, to the change
+    store and to the cache.
+    """
+    return events.EventConsumer(server, user, key, repos=cache.repos,
+                                reconcile=cache.refresh,
+                                on_changes=cache.update)
+
+
+def refresh_forever(caches, interval, stop):
+    """Refresh the caches every interval seconds until stop is set."""
+    while not stop.wait(interval):
+        for cache in caches:
+            try:
+                cache.refresh()
+            except Exception:
+                LOG.exception('Failed to refresh %s',
+                              cache.__class__.__name__)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    parser = argparse.ArgumentParser(
+        prog='reviewstats-server',
+        description='Serve the review statistics reports over HTTP')
+    parser.add_argument(
+        '--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument(
+        '--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument(
+        '--refresh', type=int, default=300,
+        help='Number of seconds between two refreshes of the changes')
+    parser.add_argument(
+        '--stream-events', action='store_true',
+        help='Apply the Gerrit event stream to the changes as it happens, '
+             'in addition to the scheduled refreshes')
+    parser.add_argument(
+        '-a', '--all', action='store_true',
+        help='Load all known projects (*.json) on start up instead of on '
+             'first use')
+    parser.add_argument(
+        '--projects-dir', default=utils.PROJECTS_DIR,
+        help='Directory where to locate the project files')
+    parser.add_argument(
+        '-u', '--user', default=getpass.getuser(), help='gerrit user')
+    parser.add_argument(
+        '-P', '--password', default=getpass.getuser(),
+        help='gerrit HTTP password')
+    parser.add_argument(
+        '-k', '--key', default=None, help='ssh key for gerrit')
+    parser.add_argument(
+        '--server', default='review.opendev.org',
+        help='Gerrit server to connect to')
+    parser.add_argument(
+        '-j', '--workers', type=int, default=1,
+        help='Number of projects to query from Gerrit concurrently')
+    parser.add_argument(
+        '--debug', action='store_true', help='Show extra debug output')
+    options = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.INFO)
+    if options.debug:
+        logging.root.setLevel(logging.DEBUG)
+
+    cache = utils.ChangeCache(options.user, options.key, server=options.server,
+                        workers=options.workers)
+    if options.all:
+        cache.ensure(utils.get_projects_info(
+            all_projects=True, base_dir=options.projects_dir))
+
+    def login():
+        return Launchpad.login_with('openstack-releasing', 'production')
+
+    # Log in once before serving, so that the request threads find the
+    # credentials cached instead of asking for them.
+    login()
+    bug_tasks = BugTaskCache(login)
+
+    settings = dict((name, getattr(options, name))
+                    for name in utils.SERVER_OPTIONS)
+    httpd = ReportServer((options.host, options.port), cache, settings,
+                         bug_tasks=bug_tasks)
+    stop = threading.Event()
+    refresher = threading.Thread(
+        target=refresh_forever,
+        args=([cache, bug_tasks], options.refresh, stop))
+    refresher.daemon = True
+    refresher.start()
+    if options.stream_events:
+        consumer = event_consumer(cache, options.server, options.user,
+                                  options.key)
+        streamer = threading.Thread(target=consumer.run, args=(stop,))
+        streamer.daemon = True
+        streamer.start()
+    LOG.info('Serving reports on http://%s:%d/', options.host, options.port)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        httpd.server_close()
+    return 0
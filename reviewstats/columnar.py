@@ -0,0 +1,181 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Columnar approvals table for reviewer aggregation.
+
+Approvals are flattened into typed columns once, then the per reviewer vote
+counts of any number of time windows are computed with grouped NumPy
+reductions instead of Python loops. This module needs NumPy, which is an
+optional dependency (``pip install reviewstats[columnar]``).
+"""
+
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from reviewstats import model
+
+
+CODE_REVIEW = 0
+APPROVED = 1
+WORKFLOW = 2
+
+TYPE_CODES = {
+    'Code-Review': CODE_REVIEW,
+    'Approved': APPROVED,
+    'Workflow': WORKFLOW,
+}
+
+VOTE_KEYS = ('-2', '-1', '1', '2')
+
+
+def available():
+    return numpy is not None
+
+
+class ApprovalTable(object):
+    """Approvals of a set of patchsets, one column per attribute.
+
+    Only the approval types counted by the reviewers report are kept.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self.names = []
+        self._granted_on = array.array('q')
+        self._reviewer = array.array('l')
+        self._type = array.array('b')
+        self._value = array.array('b')
+        self._patchset = array.array('l')
+        self._submitter = array.array('l')
+        self._core = array.array('b')
+        self.patchsets = 0
+        self._columns = None
+
+    def _id(self, name):
+        try:
+            return self._ids[name]
+        except KeyError:
+            self.names.append(name)
+            return self._ids.setdefault(name, len(self.names) - 1)
+
+    def add_patchset(self, patchset, core_team):
+        """Append the approvals of a patchset.
+
+        :param dict patchset: De-serialized dict of a gerrit patchset.
+        :param core_team: Set of the core reviewers of the patchset's
+            project.
+        """
+        ps = self.patchsets
+        self.patchsets += 1
+        submitter = self._id(patchset['uploader'].get('username', 'unknown'))
+        for review in patchset.get('approvals', []):
+            type_code = TYPE_CODES.get(review['type'])
+            if type_code is None:
+                continue
+            reviewer = review['by'].get('username', 'unknown')
+            self._granted_on.append(int(review['grantedOn']))
+            self._reviewer.append(self._id(reviewer))
+            self._type.append(type_code)
+            self._value.append(model.vote_value(review))
+            self._patchset.append(ps)
+            self._submitter.append(submitter)
+            self._core.append(reviewer in core_team)
+        self._columns = None
+
+    def _arrays(self):
+        if self._columns is None:
+            columns = dict(
+                (name, numpy.frombuffer(column, dtype=column.typecode)
+                 if len(column) else numpy.zeros(0, dtype=column.typecode))
+                for name, column in (('granted_on', self._granted_on),
+                                     ('reviewer', self._reviewer),
+                                     ('type', self._type),
+                                     ('value', self._value),
+                                     ('patchset', self._patchset),
+                                     ('submitter', self._submitter),
+                                     ('core', self._core)))
+            # The latest positive and negative core Code-Review vote of
+            # every patchset, whatever the window.
+            core_review = ((columns['type'] == CODE_REVIEW)
+                           & (columns['core'] != 0))
+            for name, mask in (('latest_pos', columns['value'] > 0),
+                               ('latest_neg', columns['value'] <= 0)):
+                latest = numpy.zeros(self.patchsets, dtype='q')
+                mask = mask & core_review
+                numpy.maximum.at(latest, columns['patchset'][mask],
+                                 columns['granted_on'][mask])
+                columns[name] = latest
+            self._columns = columns
+        return self._columns
+
+    def reviewers(self, ts):
+        """Return the reviewer counters of the approvals since ts.
+
+        :param int ts: Unix-like timestamp of the start of the window.
+        :return: dict in the format built by
+            :func:`reviewstats.cmd.reviewers.process_patchset`, with the
+            reviewers in the same order.
+        """
+        c = self._arrays()
+        n = len(self.names)
+        in_window = c['granted_on'] >= ts
+        reviewer = c['reviewer']
+        code_review = in_window & (c['type'] == CODE_REVIEW)
+        approve = in_window & ((c['type'] == APPROVED)
+                               | ((c['type'] == WORKFLOW) & (c['value'] > 0)))
+
+        def count(ids, mask):
+            return numpy.bincount(ids[mask], minlength=n)
+
+        totals = count(reviewer, code_review)
+        received = count(c['submitter'], code_review)
+        approvals = count(reviewer, approve)
+        votes = dict((key, count(reviewer,
+                                 code_review & (c['value'] == int(key))))
+                     for key in VOTE_KEYS)
+        granted_on = c['granted_on']
+        disagree = code_review & (
+            ((c['value'] > 0)
+             & (granted_on < c['latest_neg'][c['patchset']]))
+            | ((c['value'] < 0)
+               & (granted_on < c['latest_pos'][c['patchset']])))
+        disagreements = count(reviewer, disagree)
+
+        # Reviewers appear in the order they are first seen: the reviewer of
+        # each approval, then the submitter for Code-Review votes.
+        seen = numpy.empty(2 * len(reviewer), dtype=reviewer.dtype)
+        seen[0::2] = reviewer
+        seen[1::2] = c['submitter']
+        seen_mask = numpy.empty(len(seen), dtype=bool)
+        seen_mask[0::2] = in_window
+        seen_mask[1::2] = code_review
+        ids, first = numpy.unique(seen[seen_mask], return_index=True)
+        order = ids[numpy.argsort(first, kind='stable')]
+
+        result = {}
+        for i in order.tolist():
+            result[self.names[i]] = {
+                'votes': {
+                    '-2': int(votes['-2'][i]),
+                    '-1': int(votes['-1'][i]),
+                    '1': int(votes['1'][i]),
+                    '2': int(votes['2'][i]),
+                    'A': int(approvals[i]),
+                },
+                'disagreements': int(disagreements[i]),
+                'total': int(totals[i]),
+                'received': int(received[i]),
+            }
+        return result
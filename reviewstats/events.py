@@ -0,0 +1,220 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Live updates of the change store from the Gerrit event stream.
+
+``gerrit stream-events`` reports new patchsets, votes and status changes
+as they happen. Applying them to the stored changes keeps the store
+current without querying Gerrit. Events missed while disconnected are
+caught up by a reconciliation sync each time the stream is (re)opened.
+"""
+
+import json
+import logging
+import threading
+import time
+
+from reviewstats import store
+from reviewstats import utils
+
+LOG = logging.getLogger(__name__)
+
+
+STREAM_EVENTS = ('patchset-created', 'comment-added', 'change-merged',
+                 'change-abandoned', 'change-restored')
+
+STATUSES = {
+    'change-merged': 'MERGED',
+    'change-abandoned': 'ABANDONED',
+    'change-restored': 'NEW',
+}
+
+# Fields of a change that events carry and that may change over time.
+CHANGE_FIELDS = ('subject', 'topic', 'url', 'owner', 'commitMessage',
+                 'status')
+
+MAX_RECONNECT_DELAY = 60
+
+
+def _find_patch_set(change, number):
+    for patch_set in change.get('patchSets', []):
+        if str(patch_set.get('number')) == str(number):
+            return patch_set
+    return None
+
+
+def apply_event(change, event):
+    """Apply a stream event to a stored change.
+
+    :param change: De-serialized dict of the stored change, or None if the
+        change is not stored. It is updated in place.
+    :param dict event: De-serialized Gerrit stream event.
+    :return: the updated change, or None if the event can not be applied.
+        Events that predate the stored change, or that refer to a change
+        or patchset that is not stored, are not applied.
+    """
+    event_type = event.get('type')
+    updated = event.get('eventCreatedOn', 0)
+    if change is None:
+        patch_set = event.get('patchSet', {})
+        if (event_type != 'patchset-created'
+                or str(patch_set.get('number')) != '1'):
+            return None
+        change = dict((key, event['change'][key])
+                      for key in ('id', 'project', 'branch', 'number')
+                      if key in event['change'])
+        change['status'] = 'NEW'
+        change['createdOn'] = patch_set.get('createdOn', updated)
+        change['patchSets'] = []
+    elif updated < change.get('lastUpdated', 0):
+        return None
+
+    for key in CHANGE_FIELDS:
+        if key in event['change']:
+            change[key] = event['change'][key]
+
+    if event_type == 'patchset-created':
+        patch_set = dict(event['patchSet'])
+        patch_set.pop('approvals', None)
+        patch_sets = [p for p in change.get('patchSets', [])
+                      if str(p.get('number')) != str(patch_set['number'])]
+        patch_sets.append(patch_set)
+        patch_sets.sort(key=lambda p: int(p['number']))
+        change['patchSets'] = patch_sets
+        change['status'] = 'NEW'
+    elif event_type == 'comment-added':
+        patch_set = _find_patch_set(change, event['patchSet']['number'])
+        if patch_set is None:
+            return None
+        author = event.get('author', {})
+        for vote in event.get('approvals', []):
+            if 'oldValue' not in vote:
+                # The vote did not change with this comment
+                continue
+            approvals = [a for a in patch_set.get('approvals', [])
+                         if a['type'] != vote['type']
+                         or a['by'].get('username') != author.get('username')]
+            if vote['value'] != '0':
+                approval = {'type': vote['type'], 'value': vote['value'],
+                            'grantedOn': updated, 'by': author}
+                if 'description' in vote:
+                    approval['description'] = vote['description']
+                approvals.append(approval)
+            patch_set['approvals'] = approvals
+    elif event_type in STATUSES:
+        change['status'] = STATUSES[event_type]
+    else:
+        return None
+
+    change['lastUpdated'] = max(change.get('lastUpdated', 0), updated)
+    return change
+
+
+class EventConsumer(object):
+    """Apply the Gerrit event stream to the change store.
+
+    :param callable reconcile: Called each time the stream is opened,
+        before consuming events, to sync the changes that were updated
+        while disconnected. Defaults to an incremental sync of projects.
+    :param projects: List of project dicts whose events are applied. All
+        events are applied if None.
+    :param repos: Container of the Gerrit projects whose events are
+        applied, checked as each event arrives. Overrides projects.
+    :param callable on_changes: Called with the list of changes updated by
+        each applied event.
+    """
+
+    def __init__(self, server, ssh_user, ssh_key, projects=None,
+                 reconcile=None, on_changes=None, path=store.CHANGES_DB,
+                 repos=None):
+        self.server = server
+        self.ssh_user = ssh_user
+        self.ssh_key = ssh_key
+        self.projects = projects
+        self.repos = repos
+        if repos is None and projects is not None:
+            self.repos = set(repo for project in projects
+                             for repo in project['subprojects'])
+        self.reconcile = reconcile or self._sync
+        self.on_changes = on_changes
+        self.path = path
+        self._synced = None
+
+    def _sync(self):
+        if not self.projects:
+            return
+        for project, changes in utils.iter_project_changes(
+                self.projects, self.ssh_user, self.ssh_key,
+                server=self.server, updated_since=self._synced,
+                full_history=True):
+            if self.on_changes is not None:
+                self.on_changes(list(changes.values()))
+
+    def handle(self, cache, line):
+        """Apply one line of the event stream to the cache."""
+        try:
+            event = json.loads(line)
+        except ValueError:
+            LOG.warning('Ignoring malformed event %r', line)
+            return None
+        if event.get('type') not in STREAM_EVENTS or 'change' not in event:
+            return None
+        key = store.change_key(event['change'])
+        if self.repos is not None and key[1] not in self.repos:
+            return None
+        change = apply_event(cache.get(key), event)
+        if change is None:
+            LOG.debug('Could not apply %s event on %s, left for the next '
+                      'reconciliation', event['type'], key)
+            return None
+        cache.upsert([change])
+        if self.on_changes is not None:
+            self.on_changes([change])
+        return change
+
+    def stream_once(self, stop=None):
+        """Open the event stream and consume it until it ends.
+
+        The stream is opened before reconciling, so that the events
+        happening while reconciling are buffered and applied afterwards.
+        """
+        conn = utils.GerritConnection(self.server, self.ssh_user,
+                                      self.ssh_key)
+        cache = store.ChangeStore(self.path)
+        try:
+            cmd = 'gerrit stream-events %s' % ' '.join(
+                '-s %s' % event_type for event_type in STREAM_EVENTS)
+            stdout = conn.exec_command(cmd)
+            started = time.time()
+            self.reconcile()
+            self._synced = int(started) - utils.CURSOR_SLACK
+            for line in stdout:
+                if stop is not None and stop.is_set():
+                    break
+                if line.strip():
+                    self.handle(cache, line)
+        finally:
+            cache.close()
+            conn.close()
+
+    def run(self, stop=None):
+        """Consume the event stream, reconnecting until stop is set."""
+        if stop is None:
+            stop = threading.Event()
+        delay = 1
+        while not stop.is_set():
+            try:
+                self.stream_once(stop)
+                delay = 1
+            except Exception:
+                LOG.exception('Gerrit event stream failed')
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+            stop.wait(delay)
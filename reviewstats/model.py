@@ -0,0 +1,224 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Compact representation of Gerrit changes.
+
+The classes of this module hold the parts of the de-serialized Gerrit JSON
+that the commands use, in ``__slots__`` objects with interned strings,
+shared account objects and integer votes. They are built once at ingest
+and take a fraction of the memory of the nested dicts.
+
+For compatibility they also support read access with the Gerrit JSON key
+names (``change['patchSets']``, ``review.get('by')``...), so code written
+against the raw dicts works unchanged. Keys that are not modelled are
+dropped.
+"""
+
+import sys
+import weakref
+
+
+# Accounts in use, so that equal accounts share a single instance. Entries
+# go away with the last change referring to them.
+_ACCOUNTS = weakref.WeakValueDictionary()
+
+# Vote values are integers in the model and strings in the Gerrit JSON.
+_VOTE_STRINGS = dict((v, str(v)) for v in range(-2, 3))
+
+
+class _Record(object):
+    """Read-only mapping interface over the slots of a record.
+
+    Subclasses map Gerrit JSON keys to attribute names in ``_KEYS``.
+    """
+
+    __slots__ = ()
+    _KEYS = {}
+
+    def __getitem__(self, key):
+        try:
+            value = getattr(self, self._KEYS[key])
+        except KeyError:
+            raise KeyError(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def to_json(self):
+        """Return the record as Gerrit JSON dicts."""
+        result = {}
+        for key in self._KEYS:
+            value = self.get(key)
+            if value is None:
+                continue
+            if isinstance(value, _Record):
+                value = value.to_json()
+            elif isinstance(value, list):
+                value = [v.to_json() for v in value]
+            result[key] = value
+        return result
+
+
+def _intern(value):
+    return sys.intern(value) if value is not None else None
+
+
+class Account(_Record):
+    """A Gerrit account. Equal accounts share a single instance."""
+
+    __slots__ = ('username', 'name', 'email', '__weakref__')
+    _KEYS = {'username': 'username', 'name': 'name', 'email': 'email'}
+
+    def __init__(self, username=None, name=None, email=None):
+        self.username = _intern(username)
+        self.name = name
+        self.email = email
+
+    @classmethod
+    def from_json(cls, data):
+        if not data:
+            data = {}
+        key = (data.get('username'), data.get('name'), data.get('email'))
+        account = _ACCOUNTS.get(key)
+        if account is None:
+            account = _ACCOUNTS.setdefault(key, cls(*key))
+        return account
+
+
+def vote_value(review):
+    """Return the value of a vote as an int.
+
+    :param review: :class:`Approval`, or de-serialized dict of a Gerrit
+        approval whose value is a string.
+    """
+    if isinstance(review, Approval):
+        return review.value
+    return int(review['value'])
+
+
+class Approval(_Record):
+    """A vote on a patchset. ``value`` is an int."""
+
+    __slots__ = ('type', 'value', 'granted_on', 'by')
+    _KEYS = {'type': 'type', 'value': 'value_string',
+             'grantedOn': 'granted_on', 'by': 'by'}
+
+    def __init__(self, type, value, granted_on, by):
+        self.type = _intern(type)
+        self.value = value
+        self.granted_on = granted_on
+        self.by = by
+
+    @property
+    def value_string(self):
+        return _VOTE_STRINGS.get(self.value) or str(self.value)
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['type'], int(data['value']), data.get('grantedOn'),
+                   Account.from_json(data.get('by')))
+
+
+class PatchSet(_Record):
+    """A patchset and its approvals."""
+
+    __slots__ = ('number', 'created_on', 'uploader', 'approvals')
+    _KEYS = {'number': 'number', 'createdOn': 'created_on',
+             'uploader': 'uploader', 'approvals': 'approvals'}
+
+    def __init__(self, number, created_on, uploader, approvals=None):
+        self.number = number
+        self.created_on = created_on
+        self.uploader = uploader
+        self.approvals = approvals
+
+    @classmethod
+    def from_json(cls, data):
+        approvals = None
+        if 'approvals' in data:
+            approvals = [Approval.from_json(a) for a in data['approvals']]
+        return cls(data.get('number'), data.get('createdOn'),
+                   Account.from_json(data.get('uploader')), approvals)
+
+
+class Change(_Record):
+    """A change and its patchsets.
+
+    Besides the modelled keys, a change accepts arbitrary extra keys
+    (``change['age'] = ...``), which commands use to annotate changes.
+    """
+
+    __slots__ = ('id', 'project', 'branch', 'number', 'subject', 'status',
+                 'url', 'topic', 'owner', 'created_on', 'last_updated',
+                 'commit_message', 'patch_sets', '_extra')
+    _KEYS = {'id': 'id', 'project': 'project', 'branch': 'branch',
+             'number': 'number', 'subject': 'subject', 'status': 'status',
+             'url': 'url', 'topic': 'topic', 'owner': 'owner',
+             'createdOn': 'created_on', 'lastUpdated': 'last_updated',
+             'commitMessage': 'commit_message', 'patchSets': 'patch_sets'}
+
+    def __init__(self, id, project, branch, number=None, subject=None,
+                 status=None, url=None, topic=None, owner=None,
+                 created_on=None, last_updated=None, commit_message=None,
+                 patch_sets=None):
+        self.id = id
+        self.project = _intern(project)
+        self.branch = _intern(branch)
+        self.number = number
+        self.subject = subject
+        self.status = _intern(status)
+        self.url = url
+        self.topic = topic
+        self.owner = owner
+        self.created_on = created_on
+        self.last_updated = last_updated
+        self.commit_message = commit_message
+        self.patch_sets = patch_sets
+        self._extra = None
+
+    def __getitem__(self, key):
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        return super(Change, self).__getitem__(key)
+
+    def __setitem__(self, key, value):
+        if key in self._KEYS:
+            raise TypeError('%s is read-only' % key)
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+
+    @classmethod
+    def from_json(cls, data):
+        patch_sets = None
+        if 'patchSets' in data:
+            patch_sets = [PatchSet.from_json(p) for p in data['patchSets']]
+        return cls(data['id'], data['project'], data['branch'],
+                   number=data.get('number'),
+                   subject=data.get('subject'),
+                   status=data.get('status'),
+                   url=data.get('url'),
+                   topic=data.get('topic'),
+                   owner=(Account.from_json(data['owner'])
+                          if 'owner' in data else None),
+                   created_on=data.get('createdOn'),
+                   last_updated=data.get('lastUpdated'),
+                   commit_message=data.get('commitMessage'),
+                   patch_sets=patch_sets)
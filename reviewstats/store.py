@@ -0,0 +1,431 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Indexed on-disk store of Gerrit changes"""
+
+import json
+import logging
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+
+CHANGES_DB = '.reviewstats-changes.sqlite'
+
+# Seconds to wait for other processes writing to the store.
+SQLITE_TIMEOUT = 60
+
+# Number of rows read at once when iterating over stored changes.
+FETCH_BATCH = 500
+
+# Payload profile of the changes returned by full Gerrit queries, see
+# reviewstats.utils.PROFILES. Each stored change records the profile of
+# the query that filled it.
+FULL_PROFILE = 'full'
+
+# Ways a change refers to a Launchpad bug.
+BUG_TOPIC = re.compile(r'bug/(\d+)')
+BUG_FOOTER = re.compile(r'^(Closes|Partial)-Bug:\s*#?(\d+)',
+                        re.MULTILINE | re.IGNORECASE)
+BUG_SOURCES = ('topic', 'Closes-Bug', 'Partial-Bug')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS changes (
+    id TEXT NOT NULL,
+    project TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    status TEXT,
+    last_updated INTEGER,
+    data TEXT NOT NULL,
+    profile TEXT,
+    PRIMARY KEY (id, project, branch)
+);
+CREATE INDEX IF NOT EXISTS changes_project ON changes (project);
+CREATE INDEX IF NOT EXISTS changes_branch ON changes (branch);
+CREATE INDEX IF NOT EXISTS changes_status ON changes (status);
+CREATE INDEX IF NOT EXISTS changes_last_updated ON changes (last_updated);
+CREATE TABLE IF NOT EXISTS derived (
+    id TEXT NOT NULL,
+    project TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    last_updated INTEGER,
+    data TEXT NOT NULL,
+    PRIMARY KEY (id, project, branch)
+);
+CREATE TABLE IF NOT EXISTS bug_changes (
+    bug TEXT NOT NULL,
+    source TEXT NOT NULL,
+    id TEXT NOT NULL,
+    project TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    last_updated INTEGER,
+    PRIMARY KEY (bug, source, id, project, branch)
+);
+CREATE INDEX IF NOT EXISTS bug_changes_change
+    ON bug_changes (id, project, branch);
+CREATE TABLE IF NOT EXISTS sync_state (
+    project TEXT PRIMARY KEY,
+    high_water INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS team_members (
+    team TEXT NOT NULL,
+    server TEXT NOT NULL,
+    members TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    PRIMARY KEY (team, server)
+);
+CREATE TABLE IF NOT EXISTS imported_pickles (
+    name TEXT PRIMARY KEY
+);
+"""
+
+
+def change_key(change):
+    """Return the (id, project, branch) key identifying a change."""
+    return (change['id'], change['project'], change['branch'])
+
+
+def bug_refs(change):
+    """Return the set of (bug id, source) of the bugs a change refers to.
+
+    The source is "topic" for a bug/<id> topic, or the name of the
+    commit message footer (Closes-Bug or Partial-Bug).
+    """
+    refs = set()
+    match = BUG_TOPIC.match(change.get('topic') or '')
+    if match:
+        refs.add((match.group(1), 'topic'))
+    for kind, bug in BUG_FOOTER.findall(change.get('commitMessage') or ''):
+        refs.add((bug, '%s-Bug' % kind.capitalize()))
+    return refs
+
+
+def _without_derived(change):
+    if '_derived' not in change:
+        return change
+    return dict((k, v) for k, v in change.items() if k != '_derived')
+
+
+class ChangeStore(object):
+    """SQLite backed store of de-serialized Gerrit changes.
+
+    Changes are stored one row each, keyed by (id, project, branch), with
+    indexes on project, branch, status and lastUpdated. Updates are row
+    level upserts so refreshing a few changes never rewrites the whole
+    store.
+
+    The store may be shared between threads; access is serialized.
+    """
+
+    def __init__(self, path=CHANGES_DB):
+        self.path = path
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   timeout=SQLITE_TIMEOUT)
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.executescript(SCHEMA)
+            self._db.commit()
+
+    def _index_bugs(self, changes):
+        """Index the bugs of the stored copy of the given changes.
+
+        The entries of the changes whose stored copy is older are left
+        alone.
+        """
+        self._db.executemany(
+            'DELETE FROM bug_changes '
+            'WHERE id = ? AND project = ? AND branch = ? '
+            'AND last_updated IS NOT (SELECT last_updated FROM changes c '
+            'WHERE c.id = bug_changes.id AND c.project = bug_changes.project '
+            'AND c.branch = bug_changes.branch)',
+            [change_key(change) for change in changes])
+        self._db.executemany(
+            'INSERT OR IGNORE INTO bug_changes '
+            '(bug, source, id, project, branch, last_updated) '
+            'SELECT ?, ?, id, project, branch, last_updated FROM changes '
+            'WHERE id = ? AND project = ? AND branch = ? '
+            'AND last_updated IS ?',
+            [ref + change_key(change) + (change.get('lastUpdated'),)
+             for change in changes for ref in bug_refs(change)])
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def get(self, key):
+        """Return the stored change with the given key, or None."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT data FROM changes '
+                'WHERE id = ? AND project = ? AND branch = ?',
+                key).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def upsert(self, changes, profile=FULL_PROFILE):
+        """Insert or replace the given changes.
+
+        :param str profile: Payload profile of the query that returned the
+            changes.
+
+        A stored change is only replaced by a copy updated at the same time
+        or later. Derived attributes attached to the changes are not stored
+        with them, see :meth:`save_derived`. The bugs the changes refer to
+        are indexed, see :meth:`iter_bug_changes`.
+        """
+        changes = list(changes)
+        rows = [change_key(change)
+                + (change.get('status'), change.get('lastUpdated'),
+                   json.dumps(_without_derived(change),
+                              separators=(',', ':')), profile)
+                for change in changes]
+        with self._lock:
+            with self._db:
+                self._db.executemany(
+                    'INSERT INTO changes '
+                    '(id, project, branch, status, last_updated, data, '
+                    'profile) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (id, project, branch) DO UPDATE SET '
+                    'status = excluded.status, '
+                    'last_updated = excluded.last_updated, '
+                    'data = excluded.data, '
+                    'profile = excluded.profile '
+                    'WHERE COALESCE(excluded.last_updated, 0) '
+                    '>= COALESCE(changes.last_updated, 0)',
+                    rows)
+                self._index_bugs(changes)
+
+    def iter_changes(self, repos, updated_since=None, include_open=False):
+        """Yield the stored changes of the given Gerrit projects.
+
+        Changes whose derived attributes are stored and up to date carry
+        them under the ``_derived`` key. Rows are read FETCH_BATCH at a
+        time, so only one batch of them is held besides the changes the
+        caller keeps.
+
+        :param int updated_since: If given, only yield the changes updated
+            at or after this Unix-like timestamp.
+        :param bool include_open: If True, also yield the open changes
+            updated before updated_since.
+        """
+        repos = list(repos)
+        if not repos:
+            return
+        sql = ('SELECT c.data, d.data FROM changes c '
+               'LEFT JOIN derived d ON d.id = c.id '
+               'AND d.project = c.project AND d.branch = c.branch '
+               'AND d.last_updated IS c.last_updated '
+               'WHERE c.project IN (%s)' % ', '.join('?' * len(repos)))
+        args = repos
+        if updated_since is not None:
+            if include_open:
+                sql += (" AND (c.last_updated >= ? "
+                        "OR c.status NOT IN ('MERGED', 'ABANDONED'))")
+            else:
+                sql += ' AND c.last_updated >= ?'
+            args = repos + [updated_since]
+        with self._lock:
+            cursor = self._db.execute(sql, args)
+        try:
+            while True:
+                with self._lock:
+                    rows = cursor.fetchmany(FETCH_BATCH)
+                if not rows:
+                    break
+                for data, derived in rows:
+                    change = json.loads(data)
+                    if derived is not None:
+                        change['_derived'] = json.loads(derived)
+                    yield change
+        finally:
+            cursor.close()
+
+    def repos_missing_profiles(self, repos, profiles):
+        """Return the repos with stored changes of none of the profiles."""
+        repos = list(repos)
+        profiles = list(profiles)
+        if not repos:
+            return set()
+        with self._lock:
+            return set(row[0] for row in self._db.execute(
+                'SELECT DISTINCT project FROM changes '
+                'WHERE project IN (%s) AND profile NOT IN (%s)'
+                % (', '.join('?' * len(repos)),
+                   ', '.join('?' * len(profiles))),
+                repos + profiles).fetchall())
+
+    def iter_bug_changes(self, repos, sources=BUG_SOURCES, only_open=False):
+        """Yield (bug id, change) for the changes referring to a bug.
+
+        Changes are yielded most recently updated first, once per bug.
+
+        :param sources: Only follow these kinds of references, see
+            :func:`bug_refs`.
+        :param bool only_open: If True, only yield the open changes.
+        """
+        repos = list(repos)
+        sources = list(sources)
+        if not repos or not sources:
+            return
+        sql = ('SELECT DISTINCT b.bug, c.data, c.last_updated, c.id '
+               'FROM bug_changes b JOIN changes c ON c.id = b.id '
+               'AND c.project = b.project AND c.branch = b.branch '
+               'AND c.last_updated IS b.last_updated '
+               'WHERE c.project IN (%s) AND b.source IN (%s)'
+               % (', '.join('?' * len(repos)), ', '.join('?' * len(sources))))
+        if only_open:
+            sql += " AND c.status NOT IN ('MERGED', 'ABANDONED')"
+        sql += ' ORDER BY c.last_updated DESC, c.id, b.bug'
+        with self._lock:
+            rows = self._db.execute(sql, repos + sources).fetchall()
+        for bug, data, last_updated, id in rows:
+            yield bug, json.loads(data)
+
+    def load_derived(self, changes):
+        """Attach the stored derived attributes to the given changes.
+
+        Only attributes computed for the current lastUpdated of a change
+        are attached, under the ``_derived`` key.
+        """
+        with self._lock:
+            for change in changes:
+                row = self._db.execute(
+                    'SELECT data FROM derived '
+                    'WHERE id = ? AND project = ? AND branch = ? '
+                    'AND last_updated IS ?',
+                    change_key(change) + (change.get('lastUpdated'),)
+                ).fetchone()
+                if row is not None:
+                    change['_derived'] = json.loads(row[0])
+
+    def save_derived(self, changes):
+        """Store the ``_derived`` attributes of the given changes."""
+        rows = [change_key(change)
+                + (change.get('lastUpdated'),
+                   json.dumps(change['_derived'], separators=(',', ':')))
+                for change in changes]
+        with self._lock:
+            with self._db:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO derived '
+                    '(id, project, branch, last_updated, data) '
+                    'VALUES (?, ?, ?, ?, ?)', rows)
+
+    def high_water_marks(self, repos):
+        """Return the high-water mark of each of the given repos.
+
+        A repo's high-water mark is the largest lastUpdated timestamp up to
+        which all of its changes are known to be stored. Repos that have
+        never been fully fetched are missing from the returned dict.
+        """
+        repos = list(repos)
+        if not repos:
+            return {}
+        with self._lock:
+            return dict(self._db.execute(
+                'SELECT project, high_water FROM sync_state '
+                'WHERE project IN (%s)' % ', '.join('?' * len(repos)),
+                repos).fetchall())
+
+    def set_high_water(self, repos, high_water):
+        with self._lock:
+            with self._db:
+                self._db.executemany(
+                    'INSERT INTO sync_state (project, high_water) '
+                    'VALUES (?, ?) '
+                    'ON CONFLICT (project) DO UPDATE SET '
+                    'high_water = MAX(high_water, excluded.high_water)',
+                    [(r, high_water) for r in repos])
+
+    def get_team_members(self, team, server, ttl):
+        """Return the cached members of a Gerrit group.
+
+        :return: tuple of the list of usernames and the time they were
+            fetched, or None if the group is not cached or was cached more
+            than ttl seconds ago.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT members, fetched FROM team_members '
+                'WHERE team = ? AND server = ? AND fetched >= ?',
+                (team, server, time.time() - ttl)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set_team_members(self, team, server, members):
+        """Cache the members of a Gerrit group.
+
+        :return: the time they are recorded as fetched.
+        """
+        fetched = time.time()
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO team_members '
+                    '(team, server, members, fetched) VALUES (?, ?, ?, ?)',
+                    (team, server, json.dumps(members), fetched))
+        return fetched
+
+    def import_pickle(self, name, pickle_fn):
+        """Import a legacy “.{name}-changes.pickle” cache file once.
+
+        Only changes newer than the stored copy are imported, and the
+        high-water mark of each repo found in the pickle is set to its most
+        recently updated change.
+        """
+        with self._lock:
+            if self._db.execute(
+                    'SELECT 1 FROM imported_pickles WHERE name = ?',
+                    (name,)).fetchone():
+                return
+            if os.path.isfile(pickle_fn):
+                with open(pickle_fn, 'rb') as f:
+                    try:
+                        changes = pickle.load(f)
+                    except Exception:
+                        LOG.warning('Failed to load cached data from %s',
+                                    pickle_fn)
+                        changes = {}
+                if not isinstance(changes, dict):
+                    # The cache is in the old list format
+                    changes = {}
+                changes = [change for key, change in changes.items()
+                           if isinstance(key, tuple)]
+                newer = []
+                for change in changes:
+                    stored = self.get(change_key(change))
+                    if (stored is None
+                            or stored.get('lastUpdated', 0)
+                            < change.get('lastUpdated', 0)):
+                        newer.append(change)
+                # Pickled changes were queried without their commit message
+                self.upsert(newer, profile='reviews')
+                high_water = {}
+                for change in changes:
+                    high_water[change['project']] = max(
+                        high_water.get(change['project'], 0),
+                        change.get('lastUpdated', 0))
+                for repo, mark in high_water.items():
+                    self.set_high_water([repo], mark)
+                LOG.debug('Imported %d changes from %s',
+                          len(newer), pickle_fn)
+            with self._db:
+                self._db.execute(
+                    'INSERT INTO imported_pickles (name) VALUES (?)',
+                    (name,))
@@ -0,0 +1,152 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Fake Gerrit and Launchpad services for tests."""
+
+import datetime
+import io
+import json
+import re
+import threading
+import time
+
+import pytz
+
+
+def make_change(number, project='openstack/nova', branch='master',
+                status='NEW', updated=1000, approvals=None, **kwargs):
+    change = {
+        'id': 'I%040d' % number,
+        'number': number,
+        'project': project,
+        'branch': branch,
+        'status': status,
+        'lastUpdated': updated,
+        'url': 'https://review.example.org/%d' % number,
+        'subject': 'Change %d' % number,
+        'patchSets': [{
+            'number': 1,
+            'createdOn': updated - 100,
+            'uploader': {'username': 'submitter'},
+            'approvals': approvals or [],
+        }],
+    }
+    change.update(kwargs)
+    return change
+
+
+class FakeGerrit(object):
+    """Answers ``gerrit query`` commands from a list of changes.
+
+    ``gerrit stream-events`` sends the events of the ``events`` list, then
+    ends as if the connection dropped.
+    """
+
+    def __init__(self, changes=(), page_size=500):
+        self.changes = list(changes)
+        self.page_size = page_size
+        self.events = []
+        self.commands = []
+        self._lock = threading.Lock()
+
+    def query(self, cmd):
+        with self._lock:
+            self.commands.append(cmd)
+        if cmd.startswith('gerrit stream-events'):
+            return [json.dumps(event) for event in self.events]
+        repos = re.findall(r'project:(\S+?)[ )]', cmd)
+        matches = [c for c in self.changes if c['project'] in repos]
+        if 'status:open' in cmd:
+            matches = [c for c in matches if c['status'] == 'NEW']
+        age = re.search(r' -age:(\d+)s', cmd)
+        if age:
+            since = time.time() - int(age.group(1))
+            matches = [c for c in matches if c['lastUpdated'] > since]
+        topic = re.search(r' topic:\^(\S+)', cmd)
+        if topic:
+            matches = [c for c in matches
+                       if re.match(topic.group(1), c.get('topic', ''))]
+        branch = re.search(r' branch:(\S+)', cmd)
+        if branch:
+            pattern = branch.group(1)
+            if pattern.startswith('^'):
+                matches = [c for c in matches
+                           if re.match(pattern, c['branch'])]
+            else:
+                matches = [c for c in matches if c['branch'] == pattern]
+        matches.sort(key=lambda c: c['lastUpdated'], reverse=True)
+        start = re.search(r'--start (\d+)', cmd)
+        start = int(start.group(1)) if start else 0
+        limit = re.search(r'limit:(\d+)', cmd)
+        # Like Gerrit, never send more than the server's page size
+        limit = min(int(limit.group(1)), self.page_size) if limit \
+            else self.page_size
+        page = matches[start:start + limit]
+        lines = [json.dumps(c) for c in page]
+        lines.append(json.dumps({
+            'type': 'stats', 'rowCount': len(page),
+            'moreChanges': start + len(page) < len(matches)}))
+        return lines
+
+    def connection(self, server, ssh_user, ssh_key):
+        return FakeConnection(self)
+
+
+class FakeConnection(object):
+
+    def __init__(self, gerrit):
+        self.gerrit = gerrit
+
+    def exec_command(self, cmd):
+        return io.StringIO('\n'.join(self.gerrit.query(cmd)) + '\n')
+
+    def close(self):
+        pass
+
+
+LP_API = 'https://api.launchpad.net/1.0'
+
+
+class FakeEntry(object):
+    """Launchpad API entry with the given attributes."""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeProject(object):
+    """Launchpad project answering searchTasks from a list of tasks."""
+
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.searches = []
+
+    def searchTasks(self, omit_duplicates=True, **kwargs):
+        kwargs['omit_duplicates'] = omit_duplicates
+        self.searches.append(kwargs)
+        return [task for task in self.tasks
+                if not (omit_duplicates and task.bug.duplicate_of_link)]
+
+
+def make_task(bug_id, created, status='New', importance='Undecided',
+              milestone=None):
+    bug = FakeEntry(self_link='%s/bugs/%d' % (LP_API, bug_id), id=bug_id,
+                    duplicate_of_link=None, tags=['low-hanging-fruit'])
+    milestone_link = None
+    if milestone:
+        milestone_link = '%s/nova/+milestone/%s' % (LP_API, milestone)
+    return FakeEntry(
+        self_link='%s/nova/+bug/%d' % (LP_API, bug_id),
+        bug_link=bug.self_link, bug=bug, status=status,
+        importance=importance, milestone_link=milestone_link,
+        date_created=datetime.datetime(2026, 1, created, tzinfo=pytz.utc),
+        date_left_new=None, date_closed=None)
@@ -0,0 +1,97 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+import os
+import threading
+
+import fixtures
+import pytz
+
+from reviewstats import bugs
+from reviewstats.tests import base
+from reviewstats.tests import fakes
+
+
+class TestBugStore(base.TestCase):
+
+    def setUp(self):
+        super(TestBugStore, self).setUp()
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tempdir)
+        self.project = fakes.FakeProject([fakes.make_task(2, 5),
+                                          fakes.make_task(1, 10)])
+        self.launchpad = fakes.FakeEntry(projects={'nova': self.project})
+        self.cache = bugs.BugStore()
+        self.addCleanup(self.cache.close)
+
+    def test_sync_and_read(self):
+        self.assertEqual(2, bugs.sync_project(self.launchpad, 'nova',
+                                              self.cache))
+        self.assertNotIn('modified_since', self.project.searches[0])
+        tasks = list(self.cache.iter_tasks('nova'))
+        self.assertEqual([2, 1], [bug.id for task, bug in tasks])
+        task, bug = tasks[0]
+        self.assertEqual(
+            datetime.datetime(2026, 1, 5, tzinfo=pytz.utc), task.date_created)
+        self.assertEqual(['low-hanging-fruit'], bug.tags)
+        self.assertEqual([], list(self.cache.iter_tasks('swift')))
+
+    def test_incremental_sync(self):
+        bugs.sync_project(self.launchpad, 'nova', self.cache)
+        self.project.tasks = [fakes.make_task(1, 10, status='Fix Released')]
+        self.assertEqual(1, bugs.sync_project(self.launchpad, 'nova',
+                                              self.cache))
+        since = datetime.datetime.fromisoformat(
+            self.project.searches[1]['modified_since'])
+        self.assertLess(since, datetime.datetime.now(pytz.utc))
+        self.assertEqual(
+            [2], [bug.id for task, bug in self.cache.iter_tasks(
+                'nova', statuses=['New'])])
+        self.assertEqual(2, len(list(self.cache.iter_tasks('nova'))))
+
+    def test_duplicate_after_sync(self):
+        bugs.sync_project(self.launchpad, 'nova', self.cache)
+        task = fakes.make_task(1, 10)
+        task.bug.duplicate_of_link = '%s/bugs/2' % fakes.LP_API
+        self.project.tasks = [task]
+        self.assertEqual(1, bugs.sync_project(self.launchpad, 'nova',
+                                              self.cache))
+        self.assertFalse(self.project.searches[1]['omit_duplicates'])
+        self.assertEqual(
+            [2], [bug.id for task, bug in self.cache.iter_tasks('nova')])
+        self.assertEqual(
+            [2, 1], [bug.id for task, bug in self.cache.iter_tasks(
+                'nova', omit_duplicates=False)])
+
+    def test_sync_projects(self):
+        swift = fakes.FakeProject([fakes.make_task(3, 1)])
+        self.launchpad.projects['swift'] = swift
+        logins = []
+
+        def login():
+            logins.append(threading.current_thread())
+            return self.launchpad
+
+        self.assertEqual(
+            [('nova', 2), ('swift', 1)],
+            list(bugs.sync_projects(login, ['nova', 'swift'], self.cache,
+                                    workers=2)))
+        # The main thread, then each worker thread logs in
+        self.assertIs(threading.current_thread(), logins[0])
+        self.assertEqual(len(logins), len(set(logins)))
+        self.assertEqual([3], [bug.id for task, bug in
+                               self.cache.iter_tasks('swift')])
+
+    def test_bug_id(self):
+        self.assertEqual('1234', bugs.bug_id('%s/bugs/1234' % fakes.LP_API))
@@ -0,0 +1,66 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+import io
+
+import fixtures
+import pytz
+
+from reviewstats import bugs
+from reviewstats.cmd import bugstats
+from reviewstats.tests import base
+
+
+NOW = datetime.datetime(2026, 3, 4, 12, 0, tzinfo=pytz.utc)
+
+
+def days_ago(days):
+    return NOW - datetime.timedelta(days=days)
+
+
+def task(created, importance='High', triaged=None, closed=None):
+    return bugs.BugTask(
+        self_link=None, bug_link=None, status=None, importance=importance,
+        milestone_link=None, date_created=days_ago(created),
+        date_left_new=triaged and days_ago(triaged),
+        date_closed=closed and days_ago(closed))
+
+
+def bug(tags=(), duplicate_of_link=None):
+    return bugs.Bug(self_link=None, id=None,
+                    duplicate_of_link=duplicate_of_link, tags=list(tags))
+
+
+class TestListener(base.TestCase):
+
+    def setUp(self):
+        super(TestListener, self).setUp()
+        # categorise_task() writes progress dots
+        self.useFixture(fixtures.MonkeyPatch('sys.stderr', io.StringIO()))
+        self.listener = bugstats.Listener('nova', ['nova'])
+        self.listener.now = NOW
+
+    def test_summarise(self):
+        self.listener.categorise_task(task(10, closed=3), bug())
+        self.listener.categorise_task(
+            task(20, importance='Critical', triaged=12), bug(['gate']))
+        self.listener.categorise_task(task(16), bug(duplicate_of_link='x'))
+        self.assertEqual([
+            ['2026-02-11', 1, 0, 0, 0, 1, 2, 1, 'gate'],
+            ['2026-02-18', 0, 1, 0, 1, 2, 1, 1, ''],
+            ['2026-02-25', 0, 1, 0, 1, 2, 0, 1, ''],
+            ['2026-03-04', 0, 0, 0, 1, 1, 0, 0, ''],
+        ], list(self.listener.summarise()))
+
+    def test_no_tasks(self):
+        self.assertEqual([], list(self.listener.summarise()))
@@ -0,0 +1,125 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import time
+
+import fixtures
+
+from reviewstats import events
+from reviewstats import store
+from reviewstats.tests import base
+from reviewstats.tests import fakes
+from reviewstats import utils
+
+
+NOVA = {'name': 'nova', 'subprojects': ['openstack/nova']}
+
+
+def event(type, change, when, **kwargs):
+    result = {'type': type, 'eventCreatedOn': when,
+              'change': dict((k, change[k])
+                             for k in ('id', 'project', 'branch', 'number',
+                                       'subject', 'url'))}
+    result.update(kwargs)
+    return result
+
+
+def comment(change, when, username, votes):
+    return event('comment-added', change, when,
+                 patchSet={'number': 1}, author={'username': username},
+                 approvals=votes)
+
+
+class TestApplyEvent(base.TestCase):
+
+    def setUp(self):
+        super(TestApplyEvent, self).setUp()
+        self.change = fakes.make_change(1, updated=1000)
+
+    def test_new_patchset(self):
+        change = events.apply_event(self.change, event(
+            'patchset-created', self.change, 2000,
+            patchSet={'number': 2, 'createdOn': 2000,
+                      'uploader': {'username': 'submitter'}}))
+        self.assertEqual([1, 2], [p['number'] for p in change['patchSets']])
+        self.assertEqual(2000, change['lastUpdated'])
+
+    def test_votes_replace_previous_votes(self):
+        events.apply_event(self.change, comment(self.change, 2000, 'alice', [
+            {'type': 'Code-Review', 'value': '-1', 'oldValue': '0'}]))
+        events.apply_event(self.change, comment(self.change, 3000, 'alice', [
+            {'type': 'Code-Review', 'value': '2', 'oldValue': '-1'},
+            {'type': 'Verified', 'value': '1'}]))
+        self.assertEqual(
+            [{'type': 'Code-Review', 'value': '2', 'grantedOn': 3000,
+              'by': {'username': 'alice'}}],
+            self.change['patchSets'][0]['approvals'])
+
+    def test_status(self):
+        change = events.apply_event(self.change, event(
+            'change-merged', self.change, 2000))
+        self.assertEqual('MERGED', change['status'])
+
+    def test_stale_and_unknown(self):
+        self.assertIsNone(events.apply_event(self.change, event(
+            'change-merged', self.change, 500)))
+        self.assertIsNone(events.apply_event(None, comment(
+            self.change, 2000, 'alice', [])))
+
+
+class TestEventConsumer(base.TestCase):
+
+    def setUp(self):
+        super(TestEventConsumer, self).setUp()
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tempdir)
+        self.now = int(time.time())
+        self.gerrit = fakes.FakeGerrit(
+            [fakes.make_change(n, updated=self.now - 3600 + n)
+             for n in range(3)])
+        self.useFixture(fixtures.MonkeyPatch(
+            'reviewstats.utils.GerritConnection', self.gerrit.connection))
+
+    def test_stream_applies_events_after_reconciling(self):
+        utils.get_changes([NOVA], 'user', None)
+        del self.gerrit.commands[:]
+        new = fakes.make_change(10, updated=self.now)
+        self.gerrit.events = [
+            event('change-abandoned', self.gerrit.changes[1], self.now),
+            {'type': 'ref-updated'},
+            event('patchset-created', new, self.now,
+                  patchSet=new['patchSets'][0]),
+            event('change-merged', fakes.make_change(
+                20, project='openstack/swift'), self.now),
+        ]
+        updated = []
+        consumer = events.EventConsumer('review.example.org', 'user', None,
+                                        projects=[NOVA],
+                                        on_changes=updated.extend)
+        consumer.stream_once()
+
+        self.assertIn('gerrit stream-events', self.gerrit.commands[0])
+        self.assertIn('-age:', self.gerrit.commands[1])
+        self.assertEqual(2, len(self.gerrit.commands))
+        cache = store.ChangeStore()
+        self.assertEqual(
+            'ABANDONED',
+            cache.get(store.change_key(self.gerrit.changes[1]))['status'])
+        self.assertEqual([1, 10],
+                         sorted(c['number'] for c in cache.iter_changes(
+                             ['openstack/nova'], updated_since=self.now)))
+        # The three changes synced when reconciling, then the two events
+        self.assertEqual([0, 1, 2],
+                         sorted(c['number'] for c in updated[:3]))
+        self.assertEqual([1, 10], [c['number'] for c in updated[3:]])
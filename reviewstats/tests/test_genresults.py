@@ -0,0 +1,147 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import time
+
+import fixtures
+
+from reviewstats.cmd import genresults
+from reviewstats.tests import base
+from reviewstats.tests import fakes
+
+
+PLAN = {
+    'projects': ['projects/*.json'],
+    'all': True,
+    'jobs': [
+        {'report': 'reviewers', 'args': ['-d', 30, '-d', 90],
+         'formats': ['txt', 'csv']},
+        {'report': 'openreviews', 'formats': ['txt', 'json']},
+        {'report': 'openapproved'},
+    ],
+}
+
+
+class TestGenResults(base.TestCase):
+
+    def setUp(self):
+        super(TestGenResults, self).setUp()
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tempdir)
+        now = int(time.time())
+        self.gerrit = fakes.FakeGerrit(
+            [fakes.make_change(n, updated=now - 86400 + n)
+             for n in range(3)]
+            + [fakes.make_change(10, project='openstack/swift',
+                                 updated=now - 3600)])
+        self.useFixture(fixtures.MonkeyPatch(
+            'reviewstats.utils.GerritConnection', self.gerrit.connection))
+        self.useFixture(fixtures.MonkeyPatch(
+            'reviewstats.utils.get_governance_projects', lambda: {}))
+        os.mkdir('projects')
+        for name in ('nova', 'swift'):
+            with open('projects/%s.json' % name, 'w') as f:
+                json.dump({'name': name,
+                           'subprojects': ['openstack/%s' % name],
+                           'core-team': ['core']}, f)
+
+    def write_plan(self, plan):
+        with open('plan.yaml', 'w') as f:
+            json.dump(plan, f)
+
+    def main(self):
+        return genresults.main(['genresults', '-c', 'plan.yaml',
+                                '--processes', '1', '-u', 'user'])
+
+    def test_projects_are_synced_once(self):
+        self.write_plan(PLAN)
+        self.assertEqual(0, self.main())
+        # One query per project, shared by all the reports and by "all"
+        self.assertEqual(2, len(self.gerrit.commands))
+        self.assertEqual(
+            sorted('%s-%s' % (unit, report)
+                   for unit in ('all', 'nova', 'swift')
+                   for report in ('reviewers-30.txt', 'reviewers-30.csv',
+                                  'reviewers-90.txt', 'reviewers-90.csv',
+                                  'openreviews.txt', 'openreviews.json',
+                                  'openapproved.txt')),
+            sorted(os.listdir('results')))
+        with open('results/nova-openreviews.json') as f:
+            stats = json.load(f)
+        self.assertIn({'name': 'Total Open Reviews', 'value': 3}, stats[1])
+        with open('results/nova-openapproved.txt') as f:
+            self.assertIn('reviewstats HEAD: ', f.read())
+
+    def test_script_outputs(self):
+        self.write_plan(dict(PLAN, jobs=[
+            {'report': 'reviewers', 'args': ['-d', 30]},
+            {'report': 'openreviews', 'args': ['-l', 15], 'all_args': [],
+             'formats': ['txt', 'html']}]))
+        self.assertEqual(0, self.main())
+        with open('results/nova-reviewers.txt') as f:
+            self.assertNotIn('reviewstats HEAD: ', f.read())
+        reports = {}
+        for name in ('all', 'nova', 'swift'):
+            for fmt in ('txt', 'html'):
+                with open('results/%s-openreviews.%s' % (name, fmt)) as f:
+                    reports[name, fmt] = f.read()
+        # The reports of all projects are followed by those of each project
+        self.assertEqual(3, reports['all', 'txt'].count('reviewstats HEAD: '))
+        self.assertTrue(reports['all', 'txt'].endswith(
+            '\n' + reports['nova', 'txt'] + '\n' + reports['swift', 'txt']))
+        self.assertEqual(1, reports['all', 'html'].count('<html>'))
+        self.assertTrue(reports['all', 'html'].endswith(
+            '</ul>\n</html>\n'))
+        self.assertIn('Open Reviews for', reports['nova', 'html'])
+        self.assertEqual(3, reports['all', 'html'].count(
+            'Total Open Reviews'))
+
+    def test_header_of_txt_after_other_formats(self):
+        self.write_plan(dict(PLAN, all=False, jobs=[
+            {'report': 'openreviews', 'formats': ['json', 'txt']}]))
+        self.assertEqual(0, self.main())
+        with open('results/nova-openreviews.txt') as f:
+            self.assertIn('reviewstats HEAD: ', f.read())
+        with open('results/nova-openreviews.json') as f:
+            json.load(f)
+
+    def test_report_and_projects_filters(self):
+        self.write_plan(PLAN)
+        self.assertEqual(0, genresults.main(
+            ['genresults', '-c', 'plan.yaml', '--processes', '1', '-u',
+             'user', '-r', 'openapproved', '--projects',
+             'projects/nova.json']))
+        self.assertEqual(['nova-openapproved.txt'], os.listdir('results'))
+        self.assertEqual(1, len(self.gerrit.commands))
+
+    def test_failed_report_does_not_stop_others(self):
+        def fail(*args):
+            raise RuntimeError('boom')
+
+        self.useFixture(fixtures.MonkeyPatch(
+            'reviewstats.cmd.openreviews.classify', fail))
+        self.write_plan(dict(PLAN, all=False, jobs=[
+            {'report': 'openreviews'}, {'report': 'openapproved'}]))
+        self.assertEqual(1, self.main())
+        self.assertEqual(['nova-openapproved.txt', 'swift-openapproved.txt'],
+                         sorted(os.listdir('results')))
+
+    def test_bad_plan(self):
+        for job in ({'report': 'nope'},
+                    {'report': 'openapproved', 'formats': ['csv']},
+                    {'report': 'openreviews', 'args': ['--no-such-option']}):
+            self.write_plan({'jobs': [job]})
+            self.assertRaises(SystemExit, self.main)
+        self.assertFalse(os.path.exists('results'))
@@ -0,0 +1,75 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import gc
+
+from reviewstats import model
+from reviewstats.tests import base
+from reviewstats.tests import fakes
+from reviewstats import utils
+
+
+def _change():
+    return fakes.make_change(1, topic='bug/123', owner={'username': 'o'},
+                             approvals=[
+        {'type': 'Code-Review', 'value': '-1', 'grantedOn': 1200,
+         'by': {'username': 'alice', 'name': 'Alice'}},
+        {'type': 'Workflow', 'value': '1', 'grantedOn': 1100,
+         'by': {'username': 'bob'}}])
+
+
+class TestModel(base.TestCase):
+
+    def test_round_trip(self):
+        data = _change()
+        change = model.Change.from_json(data)
+        self.assertEqual(data, change.to_json())
+
+    def test_typed_attributes(self):
+        change = model.Change.from_json(_change())
+        approval = change.patch_sets[0].approvals[0]
+        self.assertEqual(-1, approval.value)
+        self.assertEqual('-1', approval['value'])
+        self.assertEqual(-1, model.vote_value(approval))
+        self.assertEqual(-1, model.vote_value(_change()['patchSets'][0][
+            'approvals'][0]))
+        self.assertEqual('alice', approval.by.username)
+        self.assertIs(approval.by, model.Change.from_json(
+            _change()).patch_sets[0].approvals[0].by)
+
+    def test_accounts_are_released(self):
+        change = model.Change.from_json(_change())
+        self.assertIn(('bob', None, None), model._ACCOUNTS)
+        del change
+        gc.collect()
+        self.assertNotIn(('bob', None, None), model._ACCOUNTS)
+
+    def test_dict_compatibility(self):
+        change = model.Change.from_json(_change())
+        self.assertIn('topic', change)
+        self.assertNotIn('commitMessage', change)
+        self.assertIsNone(change.get('commitMessage'))
+        self.assertRaises(KeyError, change.__getitem__, 'commitMessage')
+        self.assertEqual('unknown', change['patchSets'][0]['approvals'][1][
+            'by'].get('name', 'unknown'))
+        change['age'] = 10
+        self.assertEqual(10, change['age'])
+        self.assertRaises(TypeError, change.__setitem__, 'status', 'MERGED')
+
+    def test_utils_accept_compact_changes(self):
+        data = _change()
+        change = model.Change.from_json(data)
+        self.assertEqual(utils.is_workinprogress(data),
+                         utils.is_workinprogress(change))
+        self.assertTrue(utils.patch_set_approved(change['patchSets'][0]))
+        self.assertEqual(utils.derive_change(data),
+                         utils.derive_change(change))
@@ -0,0 +1,125 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import io
+import json
+import random
+
+from reviewstats.cmd import openreviews
+from reviewstats.tests import base
+
+
+DAY = 60 * 60 * 24
+
+
+class Options(object):
+    html = False
+    longest_waiting = 3
+    waiting_more = [7]
+    percentiles = [25, 50, 75]
+
+
+def _waiting(count):
+    rand = random.Random(count)
+    return [{'age': rand.randint(0, 30) * DAY,
+             'age2': rand.randint(0, 90) * DAY,
+             'age3': rand.randint(0, 60) * DAY,
+             'url': 'https://review.example.org/%d' % n,
+             'subject': 'Change %d' % n}
+            for n in range(count)]
+
+
+class TestAgeStats(base.TestCase):
+
+    def test_stats(self):
+        changes = [{'age': days * DAY, 'url': str(days)}
+                   for days in (3, 1, 10, 2)]
+        stats = openreviews.AgeStats(changes)
+        self.assertEqual(4, len(stats))
+        self.assertEqual(4 * DAY, stats.average())
+        self.assertEqual([2 * DAY, 3 * DAY, 10 * DAY, 10 * DAY],
+                         [stats.percentile(p) for p in (25, 50, 75, 100)])
+        self.assertEqual([4, 2, 1, 0],
+                         [stats.number_more_than(days * DAY)
+                          for days in (0, 3, 4, 11)])
+        self.assertEqual(['10', '3'],
+                         [change['url'] for change in stats.top(2)])
+
+    def test_no_changes(self):
+        stats = openreviews.AgeStats([], key='age2')
+        self.assertEqual(0, stats.average())
+        self.assertEqual(0, stats.percentile(50))
+        self.assertEqual(0, stats.number_more_than(0))
+        self.assertEqual([], stats.top(3))
+
+    def test_configurable_stats(self):
+        options = Options()
+        options.percentiles = [50, 90]
+        options.waiting_more = [7, 14]
+        stats = openreviews.gen_stats([{'name': 'nova'}], _waiting(20), [],
+                                      options)
+        latest = dict(stats[1][3][1])
+        self.assertEqual(openreviews.sec_to_period_string(
+            openreviews.AgeStats(_waiting(20)).percentile(50)),
+            latest['Median wait time'])
+        self.assertIn('90th percentile wait time', latest)
+        self.assertNotIn('1st quartile wait time', latest)
+        self.assertIn('Number waiting more than 14 days', latest)
+
+    def test_default_labels(self):
+        stats = openreviews.gen_stats([{'name': 'nova'}], _waiting(5), [],
+                                      Options())
+        self.assertEqual(['Average wait time', '1st quartile wait time',
+                          'Median wait time', '3rd quartile wait time',
+                          'Number waiting more than 7 days'],
+                         [item[0] for item in stats[1][3][1]])
+
+
+class TestOutputs(base.TestCase):
+
+    def test_outputs(self):
+        self.assertEqual(['txt'], openreviews.parse_options([]).outputs)
+        self.assertEqual(['html'],
+                         openreviews.parse_options(['--html']).outputs)
+        self.assertEqual(['txt', 'json', 'html'], openreviews.parse_options(
+            ['-o', 'out', '--outputs', 'txt', '--outputs', 'json',
+             '--html']).outputs)
+        self.assertRaises(SystemExit, openreviews.parse_options,
+                          ['--outputs', 'txt', '--outputs', 'json'])
+
+    def test_json(self):
+        stats = openreviews.gen_stats([{'name': 'nova'}], _waiting(5), [],
+                                      Options())
+        f = io.StringIO()
+        openreviews.print_stats_json(stats, f=f)
+        result = json.loads(f.getvalue())
+        self.assertEqual({'name': 'Projects', 'value': ['nova']}, result[0])
+        self.assertEqual({'name': 'Waiting on Reviewer', 'value': 5},
+                         result[1][2])
+        ages = openreviews.AgeStats(_waiting(5))
+        self.assertEqual(
+            {'name': 'Average wait time', 'value': ages.average()},
+            result[1][3]['value'][0])
+        longest = ages.top(1)[0]
+        self.assertEqual(
+            {'age': longest['age'], 'url': longest['url'],
+             'subject': longest['subject']},
+            result[1][6]['value'][0])
+
+    def test_txt(self):
+        stats = openreviews.gen_stats([{'name': 'nova'}], _waiting(5), [],
+                                      Options())
+        f = io.StringIO()
+        openreviews.print_stats_txt(stats, f=f)
+        lines = f.getvalue().splitlines()
+        self.assertEqual("> Projects: ['nova']", lines[0])
+        self.assertEqual('--> Waiting on Reviewer: 5', lines[3])
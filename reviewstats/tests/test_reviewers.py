@@ -0,0 +1,112 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import calendar
+import copy
+import datetime
+
+from reviewstats.cmd import reviewers
+from reviewstats import columnar
+from reviewstats import model
+from reviewstats.tests import base
+from reviewstats.tests import fakes
+
+
+class Options(object):
+    server = 'review.example.org'
+    user = 'user'
+    password = 'password'
+
+
+PROJECT = {'name': 'nova', 'subprojects': ['openstack/nova'],
+           'core-team': ['core1', 'core2']}
+
+DAY = 60 * 60 * 24
+
+
+def vote(by, value, granted_on, type='Code-Review'):
+    return {'type': type, 'value': value, 'grantedOn': granted_on,
+            'by': {'username': by}}
+
+
+class TestWindows(base.TestCase):
+
+    def setUp(self):
+        super(TestWindows, self).setUp()
+        self.now = datetime.datetime.utcnow()
+        now_ts = calendar.timegm(self.now.timetuple())
+        self.now_ts = now_ts
+        self.changes = [
+            fakes.make_change(1, status='MERGED', updated=now_ts - DAY,
+                              approvals=[
+                                  vote('alice', '1', now_ts - 3 * DAY),
+                                  vote('core1', '-1', now_ts - 2 * DAY),
+                                  vote('core2', '2', now_ts - DAY),
+                                  vote('core2', '1', now_ts - DAY,
+                                       type='Workflow')]),
+            fakes.make_change(2, updated=now_ts - 40 * DAY, approvals=[
+                vote('bob', '-1', now_ts - 45 * DAY),
+                vote('core1', '2', now_ts - 40 * DAY)]),
+        ]
+
+    def _run(self, days, compact=False, table=None):
+        windows = [reviewers.Window(d, self.now) for d in days]
+        for change in copy.deepcopy(self.changes):
+            if compact:
+                change = model.Change.from_json(change)
+            reviewers.process_change(PROJECT, change, windows, Options(),
+                                     table=table)
+        if table is not None:
+            for window in windows:
+                window.reviewers = table.reviewers(window.ts)
+        return windows
+
+    def test_single_pass_matches_separate_runs(self):
+        combined = self._run([7, 30, 60])
+        for window in combined:
+            separate = self._run([window.days])[0]
+            self.assertEqual(separate.reviewers, window.reviewers)
+            self.assertEqual(separate.change_stats, window.change_stats)
+
+    def test_compact_changes(self):
+        for window, compact in zip(self._run([7, 60]),
+                                   self._run([7, 60], compact=True)):
+            self.assertEqual(window.reviewers, compact.reviewers)
+            self.assertEqual(window.change_stats, compact.change_stats)
+
+    def test_columnar_engine(self):
+        if not columnar.available():
+            self.skipTest('NumPy is not installed')
+        self.changes.append(fakes.make_change(
+            3, updated=self.now_ts, approvals=[
+                vote('carol', '1', self.now_ts - 5 * DAY),
+                vote('core2', '-2', self.now_ts - 4 * DAY),
+                vote('core1', '1', self.now_ts - 3 * DAY),
+                vote('bob', '-1', self.now_ts - 2 * DAY),
+                vote('core1', '-1', self.now_ts - DAY, type='Workflow'),
+                vote('carol', '1', self.now_ts - DAY, type='Verified')]))
+        days = [1, 3, 7, 30, 60]
+        expected = self._run(days)
+        actual = self._run(days, table=columnar.ApprovalTable())
+        for window, columns in zip(expected, actual):
+            self.assertEqual(list(window.reviewers.items()),
+                             list(columns.reviewers.items()))
+            self.assertEqual(window.change_stats, columns.change_stats)
+
+    def test_window_contents(self):
+        week, month, two_months = self._run([7, 30, 60])
+        self.assertNotIn('bob', week.reviewers)
+        self.assertEqual(1, week.reviewers['alice']['disagreements'])
+        self.assertEqual(1, week.reviewers['core2']['votes']['A'])
+        self.assertEqual(1, month.change_stats['merged'])
+        self.assertEqual(2, two_months.change_stats['involved'])
+        self.assertEqual(1, two_months.reviewers['bob']['disagreements'])
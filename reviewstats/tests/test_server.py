@@ -0,0 +1,205 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import fixtures
+
+from reviewstats.cmd import server
+from reviewstats import store
+from reviewstats.tests import base
+from reviewstats.tests import fakes
+from reviewstats import utils
+
+
+NOVA = {'name': 'nova', 'subprojects': ['openstack/nova']}
+
+
+def vote(type, value, granted_on):
+    return {'type': type, 'value': value, 'grantedOn': granted_on,
+            'by': {'username': 'core'}}
+
+
+class ServerTestCase(base.TestCase):
+
+    def setUp(self):
+        super(ServerTestCase, self).setUp()
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tempdir)
+        now = int(time.time())
+        self.gerrit = fakes.FakeGerrit(
+            [fakes.make_change(n, updated=now - 86400 + n * 600)
+             for n in range(5)])
+        # Change 0 was approved, then rebased
+        self.gerrit.changes[0]['patchSets'] = [
+            {'number': 1, 'createdOn': now - 86400,
+             'uploader': {'username': 'submitter'},
+             'approvals': [vote('Workflow', '1', now - 86000)]},
+            {'number': 2, 'createdOn': now - 80000,
+             'uploader': {'username': 'submitter'}},
+        ]
+        self.gerrit.changes[4]['status'] = 'MERGED'
+        self.useFixture(fixtures.MonkeyPatch(
+            'reviewstats.utils.GerritConnection', self.gerrit.connection))
+        self.useFixture(fixtures.MonkeyPatch(
+            'reviewstats.utils.get_governance_projects', lambda: {}))
+        os.mkdir('projects')
+        with open('projects/nova.json', 'w') as f:
+            json.dump(NOVA, f)
+        self.cache = utils.ChangeCache('user', None)
+
+
+class TestChangeCache(ServerTestCase):
+
+    def test_load_on_first_use(self):
+        changes = self.cache.changes([NOVA])
+        self.assertEqual(5, len(changes))
+        self.assertEqual(1, len(self.gerrit.commands))
+        self.assertEqual(4, len(self.cache.changes([NOVA], only_open=True)))
+        self.assertEqual(1, len(self.gerrit.commands))
+
+    def test_refresh_merges_updates(self):
+        self.cache.ensure([NOVA])
+        self.gerrit.changes[2]['status'] = 'ABANDONED'
+        self.gerrit.changes[2]['lastUpdated'] = int(time.time())
+        self.cache.refresh()
+        self.assertIn('-age:', self.gerrit.commands[-1])
+        self.assertEqual([0, 1, 3], sorted(
+            c['number'] for c in self.cache.changes([NOVA], only_open=True)))
+
+    def test_events_of_loaded_projects_only(self):
+        consumer = server.event_consumer(self.cache, 'review.example.org',
+                                         'user', None)
+        now = int(time.time())
+        self.cache.ensure([NOVA])
+        for type, number, project in (
+                ('change-merged', 2, 'openstack/nova'),
+                ('patchset-created', 20, 'openstack/swift')):
+            change = fakes.make_change(number, project=project)
+            self.gerrit.events.append({
+                'type': type, 'eventCreatedOn': now,
+                'change': dict((k, change[k])
+                               for k in ('id', 'project', 'branch')),
+                'patchSet': change['patchSets'][0]})
+        consumer.stream_once()
+        self.assertEqual([0, 1, 3], sorted(
+            c['number'] for c in self.cache.changes([NOVA], only_open=True)))
+        self.assertEqual({'openstack/nova'}, set(
+            row[0] for row in store.ChangeStore()._db.execute(
+                'SELECT project FROM changes')))
+
+        # Events of the projects loaded later are applied too
+        self.cache.ensure([{'name': 'swift',
+                            'subprojects': ['openstack/swift']}])
+        self.assertIn('openstack/swift', consumer.repos)
+
+
+class TestReportServer(ServerTestCase):
+
+    def setUp(self):
+        super(TestReportServer, self).setUp()
+        os.rename('projects', 'served')
+        self.lp_project = fakes.FakeProject([
+            fakes.make_task(1, 5), fakes.make_task(2, 6, milestone='zed-1')])
+        self.logins = []
+
+        def login():
+            self.logins.append(threading.current_thread())
+            return fakes.FakeEntry(projects={'nova': self.lp_project})
+
+        self.bug_tasks = server.BugTaskCache(login)
+        httpd = server.ReportServer(('127.0.0.1', 0), self.cache,
+                                    {'user': 'user', 'key': None,
+                                     'projects_dir': 'served'},
+                                    bug_tasks=self.bug_tasks)
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d' % httpd.server_address[1]
+
+    def get(self, path):
+        try:
+            with urllib.request.urlopen(self.url + path) as response:
+                return (response.status, response.headers['Content-Type'],
+                        response.read().decode('utf-8'))
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers['Content-Type'], e.read().decode('utf-8')
+
+    def test_openapproved_json(self):
+        status, content_type, body = self.get(
+            '/openapproved?project=nova&format=json')
+        self.assertEqual(200, status)
+        self.assertEqual('application/json', content_type)
+        self.assertEqual(
+            {'changes': ['https://review.example.org/0 Change 0'],
+             'total': 1},
+            json.loads(body))
+
+    def test_openreviews_html(self):
+        status, content_type, body = self.get(
+            '/openreviews?project=nova&waiting-more=1&html')
+        self.assertEqual(200, status)
+        self.assertTrue(content_type.startswith('text/html'))
+        self.assertIn('<li>Total Open Reviews: 4</li>', body)
+
+    def test_reviewers_windows(self):
+        status, content_type, body = self.get(
+            '/reviewers?project=nova&days=1&days=30&format=json')
+        self.assertEqual(200, status)
+        self.assertEqual([1, 30],
+                         [report['days'] for report in json.loads(body)])
+        status, content_type, body = self.get('/reviewers?project=nova')
+        self.assertEqual(200, status)
+        self.assertIn('Reviews for the last 14 days in nova', body)
+
+    def test_reviews_for_bugs_from_mirror(self):
+        self.gerrit.changes[1]['topic'] = 'bug/1'
+        self.gerrit.changes[2]['topic'] = 'bug/2'
+        status, content_type, body = self.get(
+            '/reviews_for_bugs?project=nova&format=json')
+        self.assertEqual(200, status)
+        self.assertEqual(
+            {'Untargeted': [{'url': 'https://review.example.org/1',
+                             'bug': '1'}],
+             'zed-1': [{'url': 'https://review.example.org/2', 'bug': '2'}]},
+            json.loads(body)['milestones'])
+        status, content_type, body = self.get(
+            '/reviews_for_bugs?project=nova&milestone=zed-1&format=json')
+        self.assertEqual(
+            {'zed-1': [{'url': 'https://review.example.org/2', 'bug': '2'}]},
+            json.loads(body)['milestones'])
+        # The second request is served from the mirror
+        self.assertEqual(1, len(self.lp_project.searches))
+        self.assertEqual(1, len(self.logins))
+
+        self.bug_tasks.refresh()
+        self.assertIn('modified_since', self.lp_project.searches[1])
+
+    def test_errors(self):
+        self.assertEqual(404, self.get('/nope')[0])
+        self.assertEqual(400, self.get('/openapproved?user=admin')[0])
+        self.assertEqual(400, self.get('/openapproved?format=csv')[0])
+        self.assertEqual(400, self.get('/openreviews?no-such-option')[0])
+        self.assertEqual(400, self.get('/openreviews?projects-dir=/')[0])
+        self.assertEqual(400, self.get(
+            '/reviewers?project=nova&days=1&days=30&format=csv')[0])
+        self.assertEqual(400, self.get('/reviewers?project=nope')[0])
+        self.assertEqual(400, self.get('/openreviews?project=nope')[0])
+        self.assertEqual(400, self.get('/openapproved?project=nope')[0])
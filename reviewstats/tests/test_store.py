@@ -0,0 +1,318 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import pickle
+import re
+import time
+from unittest import mock
+
+import fixtures
+
+from reviewstats import store
+from reviewstats.tests import base
+from reviewstats.tests import fakes
+from reviewstats import utils
+
+
+NOVA = {'name': 'nova', 'subprojects': ['openstack/nova']}
+
+
+def _gerrit_json(changes):
+    """Return changes without their derived attributes, by number."""
+    return sorted((dict((k, v) for k, v in change.items()
+                        if k != '_derived') for change in changes),
+                  key=lambda c: c['number'])
+
+
+class StoreTestCase(base.TestCase):
+
+    def setUp(self):
+        super(StoreTestCase, self).setUp()
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tempdir)
+
+
+class TestChangeStore(StoreTestCase):
+
+    def test_upsert_and_get(self):
+        cache = store.ChangeStore()
+        change = fakes.make_change(1)
+        cache.upsert([change])
+        self.assertEqual(change, cache.get(store.change_key(change)))
+        change['status'] = 'MERGED'
+        cache.upsert([change])
+        self.assertEqual('MERGED',
+                         cache.get(store.change_key(change))['status'])
+        self.assertEqual([change],
+                         list(cache.iter_changes(['openstack/nova'])))
+        self.assertEqual([], list(cache.iter_changes(['openstack/swift'])))
+
+    def test_upsert_keeps_newer_copy(self):
+        cache = store.ChangeStore()
+        cache.upsert([fakes.make_change(1, status='MERGED', updated=2000)])
+        cache.upsert([fakes.make_change(1, updated=1000)])
+        self.assertEqual('MERGED', cache.get(
+            store.change_key(fakes.make_change(1)))['status'])
+
+    def test_iter_changes_in_batches(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'reviewstats.store.FETCH_BATCH', 2))
+        cache = store.ChangeStore()
+        cache.upsert([fakes.make_change(n) for n in range(5)])
+        changes = cache.iter_changes(['openstack/nova'])
+        first = next(changes)
+        # The store stays usable while a batch is being consumed
+        cache.upsert([fakes.make_change(10, project='openstack/swift')])
+        self.assertEqual(list(range(5)), sorted(
+            [first['number']] + [c['number'] for c in changes]))
+
+    def test_bug_index(self):
+        cache = store.ChangeStore()
+        cache.upsert([
+            fakes.make_change(1, topic='bug/100', updated=1000,
+                              commitMessage='Fix\n\nCloses-Bug: #200\n'),
+            fakes.make_change(2, status='MERGED', topic='bug/100'),
+            fakes.make_change(3, updated=2000,
+                              commitMessage='Partial-Bug: 100\n'),
+        ])
+        self.assertEqual(
+            [('100', 3), ('100', 1), ('200', 1)],
+            [(bug, change['number']) for bug, change in
+             cache.iter_bug_changes(['openstack/nova'], only_open=True)])
+        self.assertEqual(
+            [('100', 1), ('100', 2)],
+            [(bug, change['number']) for bug, change in
+             cache.iter_bug_changes(['openstack/nova'], ['topic'])])
+        # Only the stored copy of a change is indexed
+        cache.upsert([fakes.make_change(1, topic='bug/300', updated=3000)])
+        cache.upsert([fakes.make_change(1, topic='bug/400', updated=1500)])
+        self.assertEqual(
+            [('300', 1), ('100', 2)],
+            [(bug, change['number']) for bug, change in
+             cache.iter_bug_changes(['openstack/nova'], ['topic'])])
+
+    def test_import_pickle(self):
+        change = fakes.make_change(1)
+        with open('.nova-changes.pickle', 'wb') as f:
+            pickle.dump({store.change_key(change): change}, f)
+        cache = store.ChangeStore()
+        cache.import_pickle('nova', '.nova-changes.pickle')
+        self.assertEqual(change, cache.get(store.change_key(change)))
+        self.assertEqual({'openstack/nova': change['lastUpdated']},
+                         cache.high_water_marks(['openstack/nova',
+                                                 'openstack/swift']))
+
+
+class TestGetChangesCache(StoreTestCase):
+
+    def setUp(self):
+        super(TestGetChangesCache, self).setUp()
+        base = int(time.time()) - 86400
+        self.gerrit = fakes.FakeGerrit(
+            [fakes.make_change(n, updated=base + n * 600) for n in range(20)],
+            page_size=8)
+        self.useFixture(fixtures.MonkeyPatch(
+            'reviewstats.utils.GerritConnection', self.gerrit.connection))
+
+    def test_refresh_is_one_query(self):
+        changes = utils.get_changes([NOVA], 'user', None)
+        self.assertEqual(20, len(changes))
+        # Three pages, and one requested ahead past the last one
+        self.assertEqual(4, len(self.gerrit.commands))
+        self.assertNotIn('-age:', self.gerrit.commands[0])
+
+        utils.get_changes([NOVA], 'user', None)
+        self.assertEqual(5, len(self.gerrit.commands))
+        self.assertIn('-age:', self.gerrit.commands[-1])
+
+        self.gerrit.changes[3]['status'] = 'MERGED'
+        self.gerrit.changes[3]['lastUpdated'] = int(time.time())
+        changes = utils.get_changes([NOVA], 'user', None)
+        self.assertEqual(20, len(changes))
+        self.assertEqual(6, len(self.gerrit.commands))
+        self.assertIn(self.gerrit.changes[3], _gerrit_json(changes))
+
+    def test_new_repo_is_fetched_entirely(self):
+        utils.get_changes([NOVA], 'user', None)
+        self.gerrit.changes.append(fakes.make_change(
+            100, project='openstack/os-vif', updated=1000))
+        project = {'name': 'nova',
+                   'subprojects': ['openstack/nova', 'openstack/os-vif']}
+        changes = utils.get_changes([project], 'user', None)
+        self.assertEqual(21, len(changes))
+
+    def test_window_on_warm_cache_reads_index(self):
+        utils.get_changes([NOVA], 'user', None)
+        since = self.gerrit.changes[15]['lastUpdated']
+        changes = utils.get_changes([NOVA], 'user', None,
+                                    updated_since=since)
+        self.assertEqual(self.gerrit.changes[15:], _gerrit_json(changes))
+
+    def test_window_on_cold_cache_queries_window(self):
+        since = self.gerrit.changes[15]['lastUpdated']
+        changes = utils.get_changes([NOVA], 'user', None,
+                                    updated_since=since)
+        self.assertIn('-age:', self.gerrit.commands[0])
+        self.assertEqual(self.gerrit.changes[15:], _gerrit_json(changes))
+        self.assertEqual({}, store.ChangeStore().high_water_marks(
+            ['openstack/nova']))
+
+    def test_shared_repos_are_fetched_once(self):
+        stable = {'name': 'stable',
+                  'subprojects': ['openstack/nova', 'openstack/swift']}
+        self.gerrit.changes.append(fakes.make_change(
+            30, project='openstack/swift', updated=int(time.time())))
+        result = [(project['name'], len(changes))
+                  for project, changes in utils.iter_project_changes(
+                      [NOVA, stable, NOVA], 'user', None, workers=2)]
+        self.assertEqual([('nova', 20), ('stable', 21), ('nova', 20)],
+                         result)
+        # Three pages of nova and one ahead, one page of swift
+        self.assertEqual(
+            [4, 1], [len([cmd for cmd in self.gerrit.commands if repo in cmd])
+                     for repo in ('openstack/nova', 'openstack/swift')])
+        self.assertEqual(5, len(self.gerrit.commands))
+
+    def test_chunked_queries(self):
+        stable = {'name': 'stable',
+                  'subprojects': ['openstack/nova', 'openstack/swift']}
+        self.gerrit.changes.append(fakes.make_change(
+            30, project='openstack/swift', updated=int(time.time())))
+        changes = utils.get_changes([stable], 'user', None, only_open=True,
+                                    workers=2, chunk_size=1)
+        self.assertEqual(21, len(changes))
+        self.assertEqual(
+            [4, 1], [len([cmd for cmd in self.gerrit.commands if repo in cmd])
+                     for repo in ('openstack/nova', 'openstack/swift')])
+        self.assertNotIn(' OR ', ''.join(self.gerrit.commands))
+
+    def test_pages_are_requested_ahead(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'reviewstats.utils.QUERY_READ_AHEAD', 2))
+        changes = utils.get_changes([NOVA], 'user', None, only_open=True,
+                                    page_size=5)
+        self.assertEqual(self.gerrit.changes, _gerrit_json(changes))
+        starts = [re.search(r'--start (\d+)', cmd)
+                  for cmd in self.gerrit.commands]
+        self.assertEqual([0, 5, 10, 15, 20, 25],
+                         [int(s.group(1)) if s else 0 for s in starts])
+        self.assertIn('limit:5 ', self.gerrit.commands[0])
+
+    def test_capped_pages_are_requested_again(self):
+        # The server sends 8 changes per page whatever the limit asked
+        changes = utils.get_changes([NOVA], 'user', None, only_open=True,
+                                    page_size=10)
+        self.assertEqual(self.gerrit.changes, _gerrit_json(changes))
+        starts = [re.search(r'--start (\d+)', cmd)
+                  for cmd in self.gerrit.commands]
+        self.assertEqual([0, 8, 16, 24],
+                         [int(s.group(1)) if s else 0 for s in starts])
+        self.assertIn('limit:10 ', self.gerrit.commands[-1])
+
+    def test_lean_profile(self):
+        self.gerrit.changes[2]['topic'] = 'bug/100'
+        changes = utils.get_changes([NOVA], 'user', None, only_open=True,
+                                    fields=(), predicate='topic:^bug/.*')
+        self.assertEqual([2], [c['number'] for c in changes])
+        self.assertNotIn('_derived', changes[0])
+        self.assertEqual(1, len(self.gerrit.commands))
+        for option in ('--patch-sets', '--all-approvals', '--commit-message'):
+            self.assertNotIn(option, self.gerrit.commands[0])
+
+    def test_missing_fields_are_fetched_again(self):
+        utils.get_changes([NOVA], 'user', None)
+        self.assertNotIn('--commit-message', self.gerrit.commands[0])
+        cache = store.ChangeStore()
+        self.assertEqual({'openstack/nova'}, cache.repos_missing_profiles(
+            ['openstack/nova'], ['full']))
+        utils.sync_projects([NOVA], 'user', None)
+        self.assertIn('-age:', self.gerrit.commands[-1])
+        del self.gerrit.commands[:]
+        utils.sync_projects([NOVA], 'user', None, fields=['commitMessage'])
+        self.assertNotIn('-age:', self.gerrit.commands[0])
+        self.assertIn('--commit-message', self.gerrit.commands[0])
+        self.assertEqual(set(), cache.repos_missing_profiles(
+            ['openstack/nova'], ['full']))
+
+    def test_open_changes_skip_cache(self):
+        changes = utils.get_changes([NOVA], 'user', None, only_open=True)
+        self.assertEqual(20, len(changes))
+        self.assertFalse(os.path.exists(store.CHANGES_DB))
+
+    def test_derived_attributes_follow_last_updated(self):
+        utils.get_changes([NOVA], 'user', None)
+        self.gerrit.changes[3]['patchSets'][0]['approvals'] = [
+            {'type': 'Workflow', 'value': '1', 'grantedOn': 2000,
+             'by': {'username': 'core'}}]
+        self.gerrit.changes[3]['lastUpdated'] = int(time.time())
+        with mock.patch.object(utils, 'derive_change',
+                               wraps=utils.derive_change) as derive:
+            changes = utils.get_changes([NOVA], 'user', None)
+        self.assertEqual(1, derive.call_count)
+        approved = [c['number'] for c in changes
+                    if c['_derived']['approved'][-1]]
+        self.assertEqual([3], approved)
+
+
+class TestTeamMembers(StoreTestCase):
+
+    def setUp(self):
+        super(TestTeamMembers, self).setUp()
+        self.useFixture(fixtures.MonkeyPatch(
+            'reviewstats.utils.TEAM_MEMBERS', {}))
+        self.useFixture(fixtures.MonkeyPatch(
+            'reviewstats.utils._TEAM_MEMBERS_FETCHED', {}))
+        self.useFixture(fixtures.MonkeyPatch(
+            'reviewstats.utils._GERRIT_GROUPS', {}))
+        self.http_get = self.useFixture(fixtures.MockPatch(
+            'reviewstats.utils.http_get', side_effect=self._http_get)).mock
+
+    def _http_get(self, address, auth=None):
+        if address.endswith('/a/groups/'):
+            body = ')]}\'\n{"nova-core": {"id": "1"}, "glance-core": ' \
+                   '{"id": "2"}}'
+        else:
+            group_id = address.split('/')[-2]
+            body = ')]}\'\n{"members": [{"username": "core%s"}]}' % group_id
+        return 200, {}, body.encode('utf-8')
+
+    def test_prefetch_shares_groups_listing(self):
+        projects = [{'name': 'nova', 'core-team-gerrit-group': 'nova-core'},
+                    {'name': 'glance',
+                     'core-team-gerrit-group': 'glance-core'},
+                    {'name': 'swift', 'core-team': ['someone']}]
+        utils.prefetch_core_teams(projects, 'review.example.org', 'user',
+                                  'pw', workers=2)
+        self.assertEqual(3, self.http_get.call_count)
+        self.assertEqual(['core1'], utils.get_core_team(
+            projects[0], 'review.example.org', 'user', 'pw'))
+
+        # A new process reads the memberships from the store.
+        utils.TEAM_MEMBERS.clear()
+        utils.prefetch_core_teams(projects, 'review.example.org', 'user',
+                                  'pw')
+        self.assertEqual(3, self.http_get.call_count)
+        self.assertEqual(['core2'], utils.TEAM_MEMBERS['glance-core'])
+
+    def test_memo_expires(self):
+        project = {'name': 'nova', 'core-team-gerrit-group': 'nova-core'}
+        utils.get_core_team(project, 'review.example.org', 'user', 'pw')
+        utils.get_core_team(project, 'review.example.org', 'user', 'pw')
+        self.assertEqual(2, self.http_get.call_count)
+        # A long running process fetches the groups again once stale
+        self.useFixture(fixtures.MonkeyPatch(
+            'reviewstats.utils.TEAM_MEMBERS_TTL', -1))
+        self.assertEqual(['core1'], utils.get_core_team(
+            project, 'review.example.org', 'user', 'pw'))
+        self.assertEqual(4, self.http_get.call_count)
@@ -0,0 +1,233 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import gzip
+import http.server
+import os
+import random
+import threading
+import time
+
+import fixtures
+
+from reviewstats.tests import base
+from reviewstats import utils
+
+
+class TestOrderedMap(base.TestCase):
+
+    def test_sequential(self):
+        self.assertEqual([2, 4, 6],
+                         list(utils.ordered_map(lambda x: x * 2, [1, 2, 3])))
+
+    def test_concurrent_keeps_order(self):
+        def slow_double(x):
+            time.sleep(random.random() / 100)
+            return x * 2
+
+        items = list(range(20))
+        self.assertEqual([x * 2 for x in items],
+                         list(utils.ordered_map(slow_double, items,
+                                                workers=4)))
+
+
+class TestProjectRegistry(base.TestCase):
+
+    def test_units_and_route(self):
+        nova = {'name': 'nova', 'subprojects': ['openstack/nova']}
+        stable = {'name': 'stable',
+                  'subprojects': ['openstack/nova', 'openstack/swift']}
+        registry = utils.ProjectRegistry([nova, stable])
+        self.assertEqual([(0, ['openstack/nova']), (1, ['openstack/swift'])],
+                         [(i, u['subprojects']) for i, u in registry.units()])
+        self.assertEqual([nova, stable],
+                         registry.projects_of('openstack/nova'))
+        by_repo = {'openstack/nova': {('I1', 'openstack/nova', 'master'): 1}}
+        self.assertEqual({('I1', 'openstack/nova', 'master'): 1},
+                         registry.route(by_repo, 0))
+        # stable still needs the nova changes
+        self.assertIn('openstack/nova', by_repo)
+        by_repo['openstack/swift'] = {('I2', 'openstack/swift', 'master'): 2}
+        self.assertEqual(2, len(registry.route(by_repo, 1)))
+        self.assertEqual({}, by_repo)
+
+    def test_chunks(self):
+        big = {'name': 'big',
+               'subprojects': ['openstack/repo%d' % n for n in range(5)]}
+        registry = utils.ProjectRegistry([big])
+        self.assertEqual(
+            [['openstack/repo0', 'openstack/repo1'],
+             ['openstack/repo2', 'openstack/repo3'], ['openstack/repo4']],
+            [unit['subprojects'] for index, unit in registry.units(2)])
+
+
+class TestProfiles(base.TestCase):
+
+    def test_profile_for(self):
+        self.assertEqual('full', utils.profile_for())
+        self.assertEqual('minimal', utils.profile_for(()))
+        self.assertEqual('reviews', utils.profile_for(['approvals']))
+        self.assertEqual('full', utils.profile_for(['approvals',
+                                                    'commitMessage']))
+        self.assertRaises(ValueError, utils.profile_for, ['reviewers'])
+
+
+class TestRemoteDataCache(base.TestCase):
+
+    def setUp(self):
+        super(TestRemoteDataCache, self).setUp()
+        self.cache_file = os.path.join(
+            self.useFixture(fixtures.TempDir()).path, 'projects.yaml')
+        self.fetch = self.useFixture(fixtures.MockPatch(
+            'reviewstats.utils._fetch_remote_data',
+            return_value=(200, {'ETag': '"v1"'}, b'nova: {}\n'))).mock
+
+    def _get(self, ttl=60):
+        return utils.get_remote_data('https://example.org/projects.yaml',
+                                     'yaml', cache_file=self.cache_file,
+                                     ttl=ttl)
+
+    def test_fresh_copy_is_not_fetched(self):
+        self.assertEqual({'nova': {}}, self._get())
+        self.assertEqual({'nova': {}}, self._get())
+        self.assertEqual(1, self.fetch.call_count)
+
+    def test_expired_copy_is_revalidated(self):
+        self._get(ttl=0)
+        self.fetch.return_value = (304, {}, b'')
+        self.assertEqual({'nova': {}}, self._get(ttl=0))
+        self.assertEqual({'If-None-Match': '"v1"'},
+                         self.fetch.call_args[0][1])
+
+    def test_offline_fallback(self):
+        self._get(ttl=0)
+        self.fetch.side_effect = utils.DataRetrievalFailed('offline')
+        self.assertEqual({'nova': {}}, self._get(ttl=0))
+
+    def test_no_cached_copy(self):
+        self.fetch.side_effect = utils.DataRetrievalFailed('offline')
+        self.assertRaises(utils.DataRetrievalFailed, self._get)
+
+
+class TestGovernanceProjects(base.TestCase):
+
+    def setUp(self):
+        super(TestGovernanceProjects, self).setUp()
+        self.useFixture(fixtures.MonkeyPatch(
+            'reviewstats.utils._GOVERNANCE_PROJECTS', None))
+        self.get = self.useFixture(fixtures.MockPatch(
+            'reviewstats.utils.get_remote_data',
+            return_value={'nova': {}})).mock
+
+    def test_memo_expires(self):
+        utils.get_governance_projects()
+        utils.get_governance_projects()
+        self.assertEqual(1, self.get.call_count)
+        self.useFixture(fixtures.MonkeyPatch(
+            'reviewstats.utils.PROJECTS_YAML_TTL', -1))
+        self.assertEqual({'nova': {}}, utils.get_governance_projects())
+        self.assertEqual(2, self.get.call_count)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = gzip.compress(b'{"nova": [1, 2, 3]}')
+        self.send_response(200)
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHTTPGet(base.TestCase):
+
+    def setUp(self):
+        super(TestHTTPGet, self).setUp()
+        server = http.server.HTTPServer(('127.0.0.1', 0), _Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = 'http://127.0.0.1:%d/' % server.server_port
+
+    def test_gzip_body_is_decompressed(self):
+        self.assertEqual({'nova': [1, 2, 3]},
+                         utils.get_remote_data(self.url))
+
+    def test_size_limit(self):
+        self.assertRaises(utils.DataRetrievalFailed, utils.http_get,
+                          self.url, max_bytes=4)
+
+
+class TestCoreTeamIndex(base.TestCase):
+
+    def test_lookups(self):
+        nova = {'name': 'nova', 'core-team': ['alice', 'bob']}
+        glance = {'name': 'glance', 'core-team': ['bob']}
+        swift = {'name': 'swift'}
+        index = utils.CoreTeamIndex([nova, glance, swift], 'server', 'user',
+                                    'pw')
+        self.assertEqual(frozenset(['alice', 'bob']), index.team(nova))
+        self.assertEqual(frozenset(), index.team(swift))
+        self.assertEqual(frozenset(['nova', 'glance']),
+                         index.core_projects('bob'))
+        self.assertTrue(index.is_core('alice'))
+        self.assertFalse(index.is_core('alice', glance))
+        self.assertFalse(index.is_core('carol'))
+
+
+class TestDeriveChange(base.TestCase):
+
+    def _vote(self, type, value, granted_on):
+        return {'type': type, 'value': value, 'grantedOn': granted_on,
+                'by': {'username': 'reviewer'}}
+
+    def test_matches_helpers(self):
+        change = {
+            'id': 'I1', 'project': 'openstack/nova', 'branch': 'master',
+            'status': 'NEW', 'lastUpdated': 500,
+            'patchSets': [
+                {'createdOn': 100, 'approvals': [
+                    self._vote('Workflow', '1', 160),
+                    self._vote('Code-Review', '2', 150)]},
+                {'createdOn': 200, 'approvals': [
+                    self._vote('CRVW', '-1', 250)]},
+                {'createdOn': 300},
+                {'createdOn': 400, 'approvals': [
+                    self._vote('Code-Review', '1', 420)]},
+            ],
+        }
+        derived = utils.derive_change(change)
+        patch_sets = change['patchSets']
+        self.assertFalse(derived['wip'])
+        self.assertFalse(derived['latest_nacked'])
+        self.assertEqual([utils.patch_set_approved(p) for p in patch_sets],
+                         derived['approved'])
+        self.assertEqual([False, True, False, False],
+                         derived['negative_feedback'])
+        self.assertEqual([150, 250, 300, 420], derived['first_vote'])
+        self.assertEqual(2, derived['oldest_no_nack'])
+
+    def test_get_derived_recomputes_updated_change(self):
+        change = {'id': 'I1', 'project': 'openstack/nova',
+                  'branch': 'master', 'status': 'NEW', 'lastUpdated': 1,
+                  'patchSets': [{'createdOn': 1}]}
+        derived = utils.get_derived(change)
+        self.assertIs(derived, utils.get_derived(change))
+        change['status'] = 'MERGED'
+        change['lastUpdated'] = 2
+        self.assertTrue(utils.get_derived(change)['wip'])
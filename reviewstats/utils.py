@@ -16,52 +16,233 @@
 # limitations under the License.
 """Utility functions module"""
 
+import collections
+import concurrent.futures
+import contextlib
 import glob
-import gzip
-import io
+import itertools
 import json
 import logging
 import os
-import pickle
+import queue
+import sys
+import threading
 import time
-import urllib
 
 import paramiko
 import requests
+import requests.adapters
 import requests.auth
+import urllib3.util
 import yaml
 
+from reviewstats import model
+from reviewstats import store
+
 LOG = logging.getLogger(__name__)
 
 
+# Seconds subtracted from a high-water mark when asking Gerrit for the
+# changes updated since, to allow for clock skew and changes updated while
+# the previous sync was paging.
+CURSOR_SLACK = 300
+
+# Number of cached changes whose derived attributes are looked up at once.
+INGEST_BATCH = 1000
+
+# Maximum number of repos OR-ed in one Gerrit query. Projects with more
+# repos are queried in several chunks.
+QUERY_CHUNK_SIZE = 50
+
+# Number of changes per page of Gerrit queries, None for the server's
+# default, and number of pages requested ahead of the one being parsed.
+QUERY_PAGE_SIZE = None
+QUERY_READ_AHEAD = 1
+
+# Payload profiles of Gerrit queries, leanest first: the query options of
+# each profile and the change fields they add to the ones Gerrit always
+# returns (id, project, branch, topic, url, subject, owner, status...).
+PROFILES = collections.OrderedDict([
+    ('minimal', ((), ())),
+    ('bugs', (('--commit-message',), ('commitMessage',))),
+    ('reviews', (('--all-approvals', '--patch-sets'),
+                 ('patchSets', 'approvals'))),
+    (store.FULL_PROFILE, (('--all-approvals', '--patch-sets',
+                           '--commit-message'),
+                          ('patchSets', 'approvals', 'commitMessage'))),
+])
+
+# Change fields the cached changes always have, so that their derived
+# attributes can be computed. Other fields are only synced for the callers
+# asking for them.
+SYNC_FIELDS = ('patchSets', 'approvals')
+
+# Options that are set by the server, or the batch run, for all the
+# reports. The server does not accept them per request.
+SERVER_OPTIONS = ('user', 'password', 'key', 'server', 'projects_dir')
+
+# Directory of the project files of the server and batch reports.
+PROJECTS_DIR = './projects'
+
+CLOSED_STATUSES = ('MERGED', 'ABANDONED')
+
 PROJECTS_YAML = ('https://opendev.org/openstack/governance/raw/branch/master/'
                  'reference/projects.yaml')
+PROJECTS_YAML_CACHE = '.governance-projects.yaml'
+PROJECTS_YAML_TTL = 60 * 60
+
+
+HTTP_TIMEOUT = 10
+HTTP_RETRIES = 3
+HTTP_POOL_SIZE = 8
+HTTP_MAX_BYTES = 64 * 1024 * 1024
+
+_HTTP_SESSION = None
+_HTTP_LOCK = threading.Lock()
 
 
 class DataRetrievalFailed(Exception):
     pass
 
 
-# Copied from https://github.com/cybertron/zuul-status/blob/master/app.py
-def get_remote_data(address, datatype='json'):
-    req = urllib.request.Request(address)
-    req.add_header('Accept-encoding', 'gzip')
+def http_session():
+    """Return the process wide HTTP session.
+
+    All the HTTP requests of this module go through this session so that
+    connections to the same host are kept alive and reused. Idempotent
+    requests failing on a connection error or a transient server error
+    are retried with an exponential backoff.
+    """
+    global _HTTP_SESSION
+    with _HTTP_LOCK:
+        if _HTTP_SESSION is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=HTTP_POOL_SIZE,
+                pool_maxsize=HTTP_POOL_SIZE,
+                max_retries=urllib3.util.Retry(
+                    total=HTTP_RETRIES, backoff_factor=0.5,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    allowed_methods=('GET', 'HEAD'),
+                    raise_on_status=False))
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _HTTP_SESSION = session
+        return _HTTP_SESSION
+
+
+def http_get(address, headers=None, auth=None, max_bytes=HTTP_MAX_BYTES):
+    """GET a URL over the shared HTTP session.
+
+    The body is streamed and decompressed chunk by chunk, and the transfer
+    is aborted if it grows over max_bytes.
+
+    :param str address: URL to fetch.
+    :param dict headers: Extra request headers.
+    :param auth: requests authentication handler.
+    :param int max_bytes: Maximum size of the decompressed body.
+    :return: tuple of the HTTP status, the response headers and the body
+        bytes.
+    :raises DataRetrievalFailed: if the server could not be reached or the
+        body is too large.
+    """
     try:
-        remote_data = urllib.request.urlopen(req, timeout=10)
-    except Exception as e:
+        with http_session().get(address, headers=headers, auth=auth,
+                                stream=True,
+                                timeout=HTTP_TIMEOUT) as response:
+            body = bytearray()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                body += chunk
+                if len(body) > max_bytes:
+                    raise DataRetrievalFailed(
+                        'Response from %s is larger than %d bytes'
+                        % (address, max_bytes))
+            return response.status_code, response.headers, bytes(body)
+    except requests.RequestException as e:
         msg = 'Failed to retrieve data from %s: %s' % (address, str(e))
         raise DataRetrievalFailed(msg)
-    data = ""
-    while True:
-        chunk = remote_data.read().decode('utf-8')
-        if not chunk:
-            break
-        data += chunk
 
-    if remote_data.info().get('Content-Encoding') == 'gzip':
-        buf = io.StringIO(data)
-        f = gzip.GzipFile(fileobj=buf)
-        data = f.read()
+
+def _fetch_remote_data(address, headers=None):
+    """Fetch a URL.
+
+    :param str address: URL to fetch.
+    :param dict headers: Extra request headers.
+    :return: tuple of the HTTP status, the response headers and the
+        decompressed body bytes. The status is 304 and the body empty if a
+        conditional request found the resource unchanged.
+    :raises DataRetrievalFailed: if the resource could not be retrieved.
+    """
+    status, resp_headers, data = http_get(address, headers=headers)
+    if status >= 400:
+        msg = 'Failed to retrieve data from %s: HTTP %d' % (address, status)
+        raise DataRetrievalFailed(msg)
+    return status, resp_headers, data
+
+
+def _read_remote_cache(cache_file):
+    """Return the (metadata, body) cached in cache_file, or None."""
+    try:
+        with open(cache_file + '.json', 'r') as f:
+            meta = json.load(f)
+        with open(cache_file, 'rb') as f:
+            return meta, f.read()
+    except (IOError, ValueError):
+        return None
+
+
+def _write_remote_cache(cache_file, meta, data=None):
+    for fn, content, mode in ((cache_file, data, 'wb'),
+                              (cache_file + '.json', json.dumps(meta), 'w')):
+        if content is None:
+            continue
+        with open(fn + '.tmp', mode) as f:
+            f.write(content)
+        os.replace(fn + '.tmp', fn)
+
+
+def get_remote_data(address, datatype='json', cache_file=None, ttl=0):
+    """Fetch and de-serialize a remote JSON or YAML document.
+
+    :param str address: URL of the document.
+    :param str datatype: “json” or “yaml”.
+    :param str cache_file: If given, keep the last good copy of the document
+        in this file.
+    :param int ttl: Number of seconds the cached copy is used without
+        asking the server. Once expired, the server is asked whether the
+        document changed using its ETag and Last-Modified headers. If the
+        server can not be reached, the cached copy is used whatever its
+        age.
+    """
+    cached = _read_remote_cache(cache_file) if cache_file else None
+    if cached and time.time() - cached[0]['fetched'] < ttl:
+        data = cached[1]
+    else:
+        headers = {}
+        if cached:
+            if cached[0].get('etag'):
+                headers['If-None-Match'] = cached[0]['etag']
+            if cached[0].get('last_modified'):
+                headers['If-Modified-Since'] = cached[0]['last_modified']
+        try:
+            status, resp_headers, data = _fetch_remote_data(address, headers)
+        except DataRetrievalFailed:
+            if not cached:
+                raise
+            LOG.warning('Failed to retrieve data from %s, using the copy '
+                        'cached in %s', address, cache_file)
+            data = cached[1]
+        else:
+            if status == 304 and cached:
+                data = cached[1]
+                cached[0]['fetched'] = time.time()
+                _write_remote_cache(cache_file, cached[0])
+            elif cache_file:
+                _write_remote_cache(cache_file, {
+                    'fetched': time.time(),
+                    'etag': resp_headers.get('ETag'),
+                    'last_modified': resp_headers.get('Last-Modified'),
+                }, data)
 
     if datatype == 'json':
         return json.loads(data)
@@ -69,6 +250,26 @@ def get_remote_data(address, datatype='json'):
         return yaml.safe_load(data)
 
 
+# (time read, document) of the governance projects.yaml
+_GOVERNANCE_PROJECTS = None
+
+
+def get_governance_projects():
+    """Return the de-serialized governance projects.yaml.
+
+    The document is cached on disk and memoized in the process for
+    PROJECTS_YAML_TTL seconds, so long running processes see it change.
+    """
+    global _GOVERNANCE_PROJECTS
+    now = time.time()
+    if (_GOVERNANCE_PROJECTS is None
+            or _GOVERNANCE_PROJECTS[0] < now - PROJECTS_YAML_TTL):
+        _GOVERNANCE_PROJECTS = (now, get_remote_data(
+            PROJECTS_YAML, 'yaml', cache_file=PROJECTS_YAML_CACHE,
+            ttl=PROJECTS_YAML_TTL))
+    return _GOVERNANCE_PROJECTS[1]
+
+
 def get_projects_info(project=None, all_projects=False,
                       base_dir='./projects/'):
     """Return the list of project dict objects.
@@ -99,7 +300,7 @@ def get_projects_info(project=None, all_projects=False,
         # handle just passing the project name
         if not os.path.isfile(project):
             if not project.startswith(base_dir):
-                project = base_dir + project
+                project = os.path.join(base_dir, project)
             if not project.endswith('.json'):
                 project = project + '.json'
         files = [project]
@@ -118,7 +319,7 @@ def get_projects_info(project=None, all_projects=False,
                     projects.append(project)
         # Get base project name
         project_name = os.path.splitext(os.path.basename(fn))[0]
-        project_data = get_remote_data(PROJECTS_YAML, 'yaml')
+        project_data = get_governance_projects()
         for name, data in project_data.items():
             if name == project_name:
                 for d, d_data in data['deliverables'].items():
@@ -131,11 +332,82 @@ def get_projects_info(project=None, all_projects=False,
     return projects
 
 
+class ProjectRegistry(object):
+    """Projects and the reverse index from their Gerrit repos to them.
+
+    A repo may be listed by several projects, e.g. by projects/stable.json
+    and by the file of its own project. The registry assigns each repo to
+    the first project listing it, so that it is fetched once, and routes
+    its changes back to every project listing it.
+
+    :param projects: List of project dicts, as returned by
+        :func:`get_projects_info`.
+    """
+
+    def __init__(self, projects):
+        self.projects = list(projects)
+        # repo: indexes of the projects listing it, in order
+        self.by_repo = collections.OrderedDict()
+        for index, project in enumerate(self.projects):
+            for repo in project['subprojects']:
+                users = self.by_repo.setdefault(repo, [])
+                if not users or users[-1] != index:
+                    users.append(index)
+
+    def projects_of(self, repo):
+        """Return the projects listing repo."""
+        return [self.projects[index] for index in self.by_repo.get(repo, [])]
+
+    def units(self, chunk_size=None):
+        """Return the units of work fetching the repos of the projects.
+
+        Each unit is a copy of a project with only the repos that no
+        earlier project lists, so fetching every unit fetches each repo
+        once. Projects with more than chunk_size such repos are split in
+        several units, so that no query ORs more than chunk_size repos.
+
+        :param int chunk_size: Defaults to QUERY_CHUNK_SIZE.
+        :return: list of (project index, unit) tuples, in project order.
+            Projects whose repos are all listed by earlier projects have no
+            unit.
+        """
+        if chunk_size is None:
+            chunk_size = QUERY_CHUNK_SIZE
+        units = []
+        for index, project in enumerate(self.projects):
+            repos = [repo for repo in project['subprojects']
+                     if self.by_repo[repo][0] == index]
+            chunks = [repos[start:start + chunk_size]
+                      for start in range(0, len(repos), chunk_size)]
+            if len(chunks) > 1:
+                LOG.debug('Querying the %d repos of %s in %d chunks of up '
+                          'to %d repos', len(repos), project['name'],
+                          len(chunks), chunk_size)
+            for chunk in chunks:
+                units.append((index, dict(project, subprojects=chunk)))
+        return units
+
+    def route(self, by_repo, index):
+        """Return the changes of a project, from the changes of its repos.
+
+        :param dict by_repo: Changes of the repos fetched so far, by repo.
+            The repos that no later project lists are removed from it.
+        :param int index: Index of the project in the registry.
+        :return: dict of changes keyed by (id, project, branch).
+        """
+        changes = {}
+        for repo in self.projects[index]['subprojects']:
+            changes.update(by_repo.get(repo, {}))
+            if self.by_repo[repo][-1] == index:
+                by_repo.pop(repo, None)
+        return changes
+
+
 def projects_q(project):
     """Return the gerrit query selecting all the project in the given list
 
-    :param project: List of gerrit project name.
-    :type project: list of str
+    :param dict project: Project info with a list of gerrit project names
+        under the “subprojects” key.
     :return:
         gerrit query according to `Searching Changes`_ section of gerrit
         documentation.
@@ -144,24 +416,522 @@ def projects_q(project):
     .. _Searching Changes:
         https://review.opendev.org/Documentation/user-search.html
     """
-    return ('('
-            + ' OR '.join(['project:' + p for p in project['subprojects']])
-            + ')')
+    return repos_q(project['subprojects'])
+
+
+def repos_q(repos):
+    """Return the gerrit query selecting all the given gerrit projects.
+
+    :param repos: List of gerrit project names.
+    :type repos: list of str
+    :rtype: str
+    """
+    return '(' + ' OR '.join(['project:' + p for p in repos]) + ')'
+
+
+class GerritConnection(object):
+    """A lazily connected SSH session to a Gerrit server.
+
+    The session connects on first use and transparently reconnects if the
+    transport drops while running a command.
+    """
+
+    def __init__(self, server, ssh_user, ssh_key):
+        self.server = server
+        self.ssh_user = ssh_user
+        self.ssh_key = ssh_key
+        self.client = paramiko.SSHClient()
+        self.client.load_system_host_keys()
+        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.connected = False
+
+    def connect(self):
+        connect_attempts = 3
+        for attempt in range(connect_attempts):
+            if self.connected:
+                break
+            try:
+                self.client.connect(self.server, port=29418,
+                                    key_filename=self.ssh_key,
+                                    username=self.ssh_user)
+            except paramiko.SSHException:
+                try:
+                    self.client.connect(self.server, port=29418,
+                                        key_filename=self.ssh_key,
+                                        username=self.ssh_user,
+                                        allow_agent=False)
+                except paramiko.SSHException:
+                    if attempt == connect_attempts - 1:
+                        raise
+                    time.sleep(3)
+                    continue
+            self.connected = True
+            break
+
+    def exec_command(self, cmd):
+        """Run cmd on the Gerrit server and return its stdout."""
+        while True:
+            self.connect()
+            try:
+                stdin, stdout, stderr = self.client.exec_command(cmd)
+            except paramiko.SSHException:
+                self.close()
+                time.sleep(5)
+                continue
+            return stdout
+
+    def close(self):
+        if self.connected:
+            try:
+                self.client.close()
+            except Exception:
+                pass
+        self.connected = False
+
+
+class GerritConnectionPool(object):
+    """A bounded pool of :class:`GerritConnection` sessions.
+
+    At most ``size`` sessions are opened. Callers borrow a session with
+    :meth:`connection` and block while all of them are in use.
+    """
+
+    def __init__(self, server, ssh_user, ssh_key, size=1):
+        self.server = server
+        self.ssh_user = ssh_user
+        self.ssh_key = ssh_key
+        self.size = max(1, size)
+        self._connections = []
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                if len(self._connections) < self.size:
+                    conn = GerritConnection(self.server, self.ssh_user,
+                                            self.ssh_key)
+                    self._connections.append(conn)
+            if conn is None:
+                conn = self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+
+
+def ordered_map(func, items, workers=1):
+    """Yield func(item) for each of items, in order.
+
+    With more than one worker the calls run in a thread pool. At most
+    ``workers`` results are computed ahead of the consumer, so memory use
+    stays bounded however many items there are.
+    """
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def profiles_providing(fields):
+    """Return the names of the profiles providing all the given fields."""
+    fields = set(fields)
+    return [name for name, (options, provided) in PROFILES.items()
+            if fields <= set(provided)]
+
+
+def profile_for(fields=None):
+    """Return the name of the leanest profile providing the given fields.
+
+    :param fields: Iterable of the change fields needed beyond the ones
+        Gerrit always returns, e.g. "approvals". All the fields if None.
+    """
+    if fields is None:
+        return store.FULL_PROFILE
+    names = profiles_providing(fields)
+    if not names:
+        raise ValueError('No query profile provides %s'
+                         % ', '.join(sorted(fields)))
+    return names[0]
+
+
+def _read_page(stdout):
+    """Read a page of a gerrit query.
+
+    :return: tuple of the list of changes of the page and whether there are
+        more changes after it.
+    """
+    page = []
+    for l in stdout:
+        new_change = json.loads(l)
+        if 'rowCount' in new_change:
+            # Older Gerrit versions do not say whether there are more
+            # changes, keep going until we get an empty page.
+            return page, new_change.get('moreChanges',
+                                        new_change['rowCount'] > 0)
+        page.append(new_change)
+    return page, True
+
+
+def _discard(stdout):
+    """Close the channel of a query whose output is not needed."""
+    channel = getattr(stdout, 'channel', None)
+    if channel is not None:
+        channel.close()
+
+
+def _query_pages(conn, query, profile=store.FULL_PROFILE, page_size=None,
+                 read_ahead=None):
+    """Yield pages of the changes matching a gerrit query.
+
+    Once the first page shows there are more changes, the next pages are
+    requested ahead, each over its own channel of the connection, so that
+    Gerrit sends a page while the previous one is parsed.
+
+    :param conn: :class:`GerritConnection` to run the query over.
+    :param str query: Gerrit search query.
+    :param str profile: Name of the payload profile of the query, see
+        PROFILES.
+    :param int page_size: Number of changes per page, QUERY_PAGE_SIZE by
+        default. The server's default if None.
+    :param int read_ahead: Number of pages requested ahead of the one being
+        parsed, QUERY_READ_AHEAD by default.
+    :return: Generator of lists of de-serialized JSON changes.
+    """
+    if page_size is None:
+        page_size = QUERY_PAGE_SIZE
+    if read_ahead is None:
+        read_ahead = QUERY_READ_AHEAD
+    if page_size:
+        query += ' limit:%d' % page_size
+    cmd = 'gerrit query %s %s--format JSON' % (
+        query, ''.join('%s ' % option for option in PROFILES[profile][0]))
+
+    def request(start):
+        if start:
+            return start, conn.exec_command(cmd + ' --start %d' % start)
+        return start, conn.exec_command(cmd)
+
+    # (start, stdout) of the pages requested, in order
+    requested = collections.deque([request(0)])
+    try:
+        while requested:
+            start, stdout = requested.popleft()
+            page, more_changes = _read_page(stdout)
+            if page:
+                yield page
+            if not more_changes or not page:
+                break
+            if page_size is None or len(page) < page_size:
+                # First page, or the server returned fewer changes than
+                # asked: the pages requested ahead start at the wrong
+                # offsets.
+                page_size = len(page)
+                while requested:
+                    _discard(requested.pop()[1])
+            next_start = start + len(page)
+            if requested:
+                next_start = requested[-1][0] + page_size
+            while len(requested) <= read_ahead:
+                requested.append(request(next_start))
+                next_start += page_size
+    finally:
+        for start, stdout in requested:
+            _discard(stdout)
+
+
+def _age_q(since):
+    """Return a gerrit query predicate for changes updated since a time.
+
+    :param int since: Unix-like timestamp in seconds since EPOCH.
+    :rtype: str
+    """
+    return ' -age:%ds' % max(1, time.time() - since + CURSOR_SLACK)
+
+
+def _get_project_changes(project, conn, cache=None, only_open=False,
+                         stable='', updated_since=None, full_history=False,
+                         compact=False, fields=None, predicate='',
+                         page_size=None):
+    """Get the changes of a single project over the given connection.
+
+    :param cache: :class:`reviewstats.store.ChangeStore` to refresh and read
+        the project's changes from, or None to query Gerrit only.
+    :param int updated_since: If given, only changes updated at or after
+        this Unix-like timestamp are returned.
+    :param bool full_history: If True, repos that were never synced are
+        fetched entirely even if updated_since is given.
+    :param bool compact: If True, return :class:`reviewstats.model.Change`
+        objects instead of dicts.
+    :param fields: Change fields needed, see :func:`profile_for`. Without a
+        cache, the query only asks for these.
+    :param str predicate: Gerrit search predicate added to the query
+        without a cache.
+    :param int page_size: Number of changes per page of the queries, see
+        :func:`_query_pages`.
+    :return: dict of changes keyed by (id, project, branch).
+
+    .. note::
+        With a cache, repos that were synced before are only asked for the
+        changes updated since their high-water mark, so refreshing an
+        unchanged project costs one small query. Repos that were never
+        synced are fetched entirely, unless updated_since is given: then
+        only the changes within that window are fetched, and the repo
+        stays unsynced.
+    """
+    logging.debug('Getting changes for project %s', project['name'])
+
+    if cache is None:
+        query = projects_q(project)
+        if only_open:
+            query += ' status:open'
+        if stable:
+            # Check for "all" to query all stable branches.
+            if stable.strip() == 'all':
+                query += ' branch:^stable/.*'
+            else:
+                query += ' branch:stable/%s' % stable
+        if predicate:
+            query += ' %s' % predicate
+        if updated_since is not None:
+            query += _age_q(updated_since)
+        profile = profile_for(fields)
+        # Derived attributes are computed from the votes
+        derive = 'approvals' in PROFILES[profile][1]
+        changes = {}
+        for page in _query_pages(conn, query, profile, page_size=page_size):
+            if derive:
+                page = _ingest(page, compact=compact)
+            elif compact:
+                page = [model.Change.from_json(c) for c in page]
+            for new_change in page:
+                changes[store.change_key(new_change)] = new_change
+        return changes
+
+    sync_project(project, conn, cache, updated_since=updated_since,
+                 full_history=full_history, fields=fields,
+                 page_size=page_size)
+    return read_project_changes(project, cache, updated_since=updated_since,
+                                compact=compact)
+
+
+def sync_project(project, conn, cache, updated_since=None,
+                 full_history=False, fields=None, page_size=None):
+    """Bring the cached changes of a project up to date with Gerrit.
+
+    The arguments are the same as for :func:`_get_project_changes`. Changes
+    are queried with the leanest profile providing SYNC_FIELDS and the
+    given fields. Repos with changes stored by a query that did not return
+    all of them are fetched again entirely.
+    """
+    cache.import_pickle(project['name'],
+                        '.%s-changes.pickle' % project['name'])
+    fields = set(SYNC_FIELDS).union(fields or ())
+    profile = profile_for(fields)
+    repos = project['subprojects']
+    marks = cache.high_water_marks(repos)
+    for repo in cache.repos_missing_profiles(repos,
+                                             profiles_providing(fields)):
+        marks.pop(repo, None)
+    cold = [repo for repo in repos if repo not in marks]
+    warm = [repo for repo in repos if repo in marks]
+    for group in (cold, warm):
+        if not group:
+            continue
+        query = repos_q(group)
+        high_water = 0
+        synced = True
+        if group is warm:
+            high_water = min(marks[repo] for repo in warm)
+            query += _age_q(high_water)
+        elif updated_since is not None and not full_history:
+            query += _age_q(updated_since)
+            synced = False
+        for page in _query_pages(conn, query, profile, page_size=page_size):
+            cache.upsert(page, profile=profile)
+            high_water = max([high_water]
+                             + [c['lastUpdated'] for c in page])
+        if synced:
+            cache.set_high_water(group, high_water)
+
+
+def read_project_changes(project, cache, updated_since=None,
+                         include_open=False, compact=False):
+    """Read the cached changes of a project, with their derived attributes.
+
+    :param cache: :class:`reviewstats.store.ChangeStore` to read from.
+    :param int updated_since: If given, only changes updated at or after
+        this Unix-like timestamp are returned.
+    :param bool include_open: If True, also return the open changes that
+        were updated before updated_since.
+    :return: dict of changes keyed by (id, project, branch).
+    """
+    changes = {}
+    batch = []
+    stored = cache.iter_changes(project['subprojects'],
+                                updated_since=updated_since,
+                                include_open=include_open)
+    for change in itertools.chain(stored, [None]):
+        if change is not None:
+            batch.append(change)
+            if len(batch) < INGEST_BATCH:
+                continue
+        for change in _ingest(batch, cache, compact):
+            changes[store.change_key(change)] = change
+        batch = []
+    return changes
+
+
+def iter_project_changes(projects, ssh_user, ssh_key, only_open=False,
+                         stable='', server='review.opendev.org', workers=1,
+                         updated_since=None, full_history=False,
+                         compact=False, fields=None, predicate='',
+                         chunk_size=None, page_size=None):
+    """Yield (project, changes) for each of projects, in order.
+
+    The arguments are the same as for :func:`get_changes`. Each project's
+    changes are a dict keyed by (id, project, branch).
+
+    With more than one worker, projects are queried concurrently over a
+    pool of up to ``workers`` SSH sessions. Results are still yielded in
+    the order of ``projects``.
+
+    Repos listed by several projects are only fetched once, and projects
+    with many repos are queried in chunks of up to chunk_size repos, see
+    :meth:`ProjectRegistry.units`. Chunks are queried concurrently like
+    projects.
+    """
+    pool = GerritConnectionPool(server, ssh_user, ssh_key, size=workers)
+    cache = None
+    if not only_open and not stable and not predicate:
+        # Only use the cache for *all* changes (the entire history).
+        cache = store.ChangeStore()
+
+    registry = ProjectRegistry(projects)
+    units = registry.units(chunk_size)
+
+    def fetch(unit):
+        with pool.connection() as conn:
+            return _get_project_changes(
+                unit, conn, cache=cache, only_open=only_open,
+                stable=stable, updated_since=updated_since,
+                full_history=full_history, compact=compact,
+                fields=fields, predicate=predicate, page_size=page_size)
+
+    # Changes of the fetched repos that later projects list too
+    by_repo = {}
+    # Index of the next project to yield
+    pending = 0
+    try:
+        for (index, unit), changes in zip(units, ordered_map(
+                fetch, [unit for index, unit in units], workers=workers)):
+            # All the units of the earlier projects are fetched
+            while pending < index:
+                yield registry.projects[pending], registry.route(by_repo,
+                                                                 pending)
+                pending += 1
+            for key, change in changes.items():
+                by_repo.setdefault(key[1], {})[key] = change
+        while pending < len(registry.projects):
+            yield registry.projects[pending], registry.route(by_repo,
+                                                             pending)
+            pending += 1
+    finally:
+        pool.close()
+        if cache is not None:
+            cache.close()
+
+
+def sync_projects(projects, ssh_user, ssh_key, server='review.opendev.org',
+                  workers=1, updated_since=None, full_history=False,
+                  fields=None, chunk_size=None, page_size=None):
+    """Bring the cached changes of projects up to date, without reading them.
+
+    The arguments are the same as for :func:`get_changes`. Projects are
+    synced concurrently over up to ``workers`` SSH sessions, and repos
+    listed by several projects are synced once.
+    """
+    pool = GerritConnectionPool(server, ssh_user, ssh_key, size=workers)
+    cache = store.ChangeStore()
+
+    def sync(project):
+        with pool.connection() as conn:
+            sync_project(project, conn, cache, updated_since=updated_since,
+                         full_history=full_history, fields=fields,
+                         page_size=page_size)
+
+    units = [unit for index, unit
+             in ProjectRegistry(projects).units(chunk_size)]
+    try:
+        list(ordered_map(sync, units, workers=workers))
+    finally:
+        pool.close()
+        cache.close()
 
 
 def get_changes(projects, ssh_user, ssh_key, only_open=False, stable='',
-                server='review.opendev.org'):
+                server='review.opendev.org', workers=1, updated_since=None,
+                full_history=False, compact=False, fields=None, predicate='',
+                chunk_size=None, page_size=None):
     """Get the changesets data list.
 
     :param projects: List of gerrit project names.
     :type projects: list of str
     :param str ssh_user: Gerrit username.
-    :param str ssh_key: Filename of one SSH key registered at gerrit.
+    :param str ssh_key: Filename of one SSH key registered at gerrit.
     :param bool only_open: If True, get only the not closed reviews.
     :param str stable:
         Name of the stable branch. If empty string, the changesets are not
         filtered by any branch. The special value "all" is handled to get
         changes for all open stable branches.
+    :param int workers:
+        Number of projects to query concurrently, each over its own SSH
+        session. The result does not depend on this value.
+    :param int updated_since:
+        Unix-like timestamp in seconds since EPOCH. If given, only changes
+        updated at or after that time are returned. The window is applied
+        as a Gerrit query predicate, or as an index lookup in the cache for
+        repos that are already cached.
+    :param bool full_history:
+        If True, cache the entire history of repos that are not cached yet
+        even if updated_since is given.
+    :param bool compact:
+        If True, return compact :class:`reviewstats.model.Change` objects
+        instead of the de-serialized JSON dicts. They are built at ingest
+        and support the same read access by key.
+    :param fields:
+        Change fields the caller needs beyond the ones Gerrit always
+        returns, among "patchSets", "approvals" and "commitMessage". Gerrit
+        is queried with the leanest options providing them, see PROFILES.
+        All the fields if None. Cached changes always have the SYNC_FIELDS,
+        and the other fields only once a caller asked for them.
+    :param str predicate:
+        Gerrit search predicate narrowing the query, e.g. "topic:^bug/.*".
+        The cache is not used with a predicate.
+    :param int chunk_size:
+        Maximum number of repos OR-ed in one query, QUERY_CHUNK_SIZE by
+        default. Projects with more repos are queried in several chunks.
+    :param int page_size:
+        Number of changes asked per page of the queries, QUERY_PAGE_SIZE by
+        default. Pages after the first are requested ahead while the
+        previous one is parsed.
 
     :return: List of de-serialized JSON changeset data as returned by gerrit.
     :rtype: list
@@ -173,136 +943,26 @@ def get_changes(projects, ssh_user, ssh_key, only_open=False, stable='',
         so just get the current data.
         Also do not use cache for stable stats as they cover different
         results.
-        Cached results are pickled per project in the following filenames:
-        “.{projectname}-changes.pickle”.
+        Cached results are stored one row per change in the SQLite database
+        “.reviewstats-changes.sqlite”. Legacy
+        “.{projectname}-changes.pickle” caches are imported on first use.
     """
     all_changes = {}
 
-    client = paramiko.SSHClient()
-    client.load_system_host_keys()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    connected = False
-
-    for project in projects:
-        changes = {}
-        new_count = 0
-        logging.debug('Getting changes for project %s', project['name'])
-
-        if not only_open and not stable:
-            # Only use the cache for *all* changes (the entire history).
-            pickle_fn = '.%s-changes.pickle' % project['name']
-
-            if os.path.isfile(pickle_fn):
-                with open(pickle_fn, 'rb') as f:
-                    try:
-                        changes = pickle.load(f)
-                    except Exception:
-                        logging.warning('Failed to load cached data from %s',
-                                        pickle_fn)
-                        changes = {}
-
-        if not isinstance(changes, dict):
-            # The cache is in the old list format
-            changes = {}
-
-        if changes:
-            for k, v in changes.items():
-                # The cache is only using the id as a key.  We now need both
-                # id and branch.
-                if not isinstance(k, tuple):
-                    changes = {}
-                break
-
-        while True:
-            connect_attempts = 3
-            for attempt in range(connect_attempts):
-                if connected:
-                    break
-                try:
-                    client.connect(server, port=29418,
-                                   key_filename=ssh_key,
-                                   username=ssh_user)
-                except paramiko.SSHException:
-                    try:
-                        client.connect(server, port=29418,
-                                       key_filename=ssh_key,
-                                       username=ssh_user,
-                                       allow_agent=False)
-                    except paramiko.SSHException:
-                        if attempt == connect_attempts + 1:
-                            raise
-                        time.sleep(3)
-                        continue
-                connected = True
-                break
-
-            cmd = ('gerrit query %s --all-approvals --patch-sets '
-                   '--format JSON' % projects_q(project))
-            if only_open:
-                cmd += ' status:open'
-            if stable:
-                # Check for "all" to query all stable branches.
-                if stable.strip() == 'all':
-                    cmd += ' branch:^stable/.*'
-                else:
-                    cmd += ' branch:stable/%s' % stable
-            if new_count:
-                cmd += ' --start %d' % new_count
-            else:
-                # Get a small set the first time so we can get to checking
-                # againt the cache sooner
-                cmd += ' limit:5'
-            try:
-                stdin, stdout, stderr = client.exec_command(cmd)
-            except paramiko.SSHException:
-                try:
-                    client.close()
-                except Exception:
-                    pass
-                connected = False
-                time.sleep(5)
-                continue
-            end_of_changes = False
-            for l in stdout:
-                new_change = json.loads(l)
-                if 'rowCount' in new_change:
-                    if new_change['rowCount'] == 0:
-                        # We've reached the end of all changes
-                        end_of_changes = True
-                        break
-                    else:
-                        break
-                if changes.get((new_change['id'],
-                                new_change['project'],
-                                new_change['branch']), None) == new_change:
-                    # Changes are ordered by latest to be updated.  As soon
-                    # as we hit one that hasn't changed since our cached
-                    # version, we're done.
-                    end_of_changes = True
-                    break
-                changes[(new_change['id'],
-                         new_change['project'],
-                         new_change['branch'])] = new_change
-                new_count += 1
-            if end_of_changes:
-                break
-
-        if not only_open and not stable:
-            with open(pickle_fn, 'wb') as f:
-                try:
-                    pickle.dump(changes, f)
-                except Exception:
-                    logging.warning('Failed to save cached data to %s',
-                                    pickle_fn)
-
+    for project, changes in iter_project_changes(projects, ssh_user, ssh_key,
+                                                 only_open=only_open,
+                                                 stable=stable,
+                                                 server=server,
+                                                 workers=workers,
+                                                 updated_since=updated_since,
+                                                 full_history=full_history,
+                                                 compact=compact,
+                                                 fields=fields,
+                                                 predicate=predicate,
+                                                 chunk_size=chunk_size,
+                                                 page_size=page_size):
         all_changes.update(changes)
 
-    if connected:
-        try:
-            client.close()
-        except Exception:
-            pass
-
     # changes used to be a list, but is now a dict.  Convert it back to a list
     # for the sake of not having to change all the code that calls this
     # function (yet, anyway).
@@ -312,6 +972,147 @@ def get_changes(projects, ssh_user, ssh_key, only_open=False, stable='',
     return all_changes
 
 
+def _branch_matches(branch, stable):
+    if not stable:
+        return True
+    if stable.strip() == 'all':
+        return branch.startswith('stable/')
+    return branch == 'stable/%s' % stable
+
+
+class ChangeCache(object):
+    """In-memory copy of the changes of the projects of many reports.
+
+    Projects are loaded from the change store, after syncing it with
+    Gerrit, the first time a report asks for them. :meth:`refresh` then
+    only fetches and reads the changes updated since the previous refresh.
+    """
+
+    def __init__(self, user, key, server='review.opendev.org', workers=1):
+        self.user = user
+        self.key = key
+        self.server = server
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._changes = {}
+        self._loaded = set()
+        self._projects = []
+        self._synced = None
+
+    @property
+    def repos(self):
+        """Set of the Gerrit projects loaded so far.
+
+        It grows as projects are loaded, and must not be modified.
+        """
+        return self._loaded
+
+    def _merge(self, project_changes):
+        for project, changes in project_changes:
+            with self._lock:
+                for key, change in changes.items():
+                    self._changes.setdefault(key[1], {})[key] = change
+
+    def _fetch(self, projects, updated_since=None):
+        return iter_project_changes(
+            projects, self.user, self.key, server=self.server,
+            workers=self.workers, updated_since=updated_since,
+            full_history=True)
+
+    def ensure(self, projects):
+        """Load the changes of the projects that are not loaded yet."""
+        with self._load_lock:
+            new = []
+            for project in projects:
+                repos = [repo for repo in project['subprojects']
+                         if repo not in self._loaded]
+                if repos:
+                    new.append(dict(project, subprojects=repos))
+                    self._loaded.update(repos)
+            if not new:
+                return
+            started = time.time()
+            try:
+                self._merge(self._fetch(new))
+            except Exception:
+                for project in new:
+                    self._loaded.difference_update(project['subprojects'])
+                raise
+            self._projects.extend(new)
+            if self._synced is None:
+                self._synced = started
+
+    def refresh(self):
+        """Fetch the changes updated since the previous refresh."""
+        with self._load_lock:
+            if self._synced is None:
+                return
+            started = time.time()
+            self._merge(self._fetch(
+                self._projects,
+                updated_since=int(self._synced) - CURSOR_SLACK))
+            self._synced = started
+
+    def update(self, changes):
+        """Merge changes updated outside of a refresh, e.g. by events."""
+        with self._lock:
+            for change in changes:
+                key = store.change_key(change)
+                if key[1] in self._loaded:
+                    self._changes.setdefault(key[1], {})[key] = change
+
+    def project_changes(self, projects, only_open=False, stable='',
+                        updated_since=None):
+        """Return (project, changes) tuples of the given projects.
+
+        :param bool only_open: If True, only return the open changes.
+        :param str stable: Only return the changes of this stable branch,
+            or of all the stable branches if "all".
+        :param int updated_since: Only return the changes updated at or
+            after this Unix-like timestamp.
+        """
+        self.ensure(projects)
+        result = []
+        for project in projects:
+            changes = {}
+            with self._lock:
+                for repo in project['subprojects']:
+                    changes.update(self._changes.get(repo, {}))
+            for key in list(changes):
+                change = changes[key]
+                if ((only_open and change['status'] in CLOSED_STATUSES)
+                        or not _branch_matches(change['branch'], stable)
+                        or (updated_since is not None
+                            and change['lastUpdated'] < updated_since)):
+                    del changes[key]
+            result.append((project, changes))
+        return result
+
+    def changes(self, projects, **kwargs):
+        """Return the list of changes of the given projects.
+
+        Takes the same keyword arguments as :meth:`project_changes`.
+        """
+        all_changes = {}
+        for project, changes in self.project_changes(projects, **kwargs):
+            all_changes.update(changes)
+        return list(all_changes.values())
+
+
+def set_server_options(options, settings):
+    """Set the SERVER_OPTIONS of the parsed options of a report.
+
+    :param dict settings: Values of the SERVER_OPTIONS, by name. Every
+        report gets the projects_dir, whether or not its command line has
+        the option.
+    """
+    for name, value in settings.items():
+        if hasattr(options, name):
+            setattr(options, name, value)
+    options.projects_dir = settings.get('projects_dir', PROJECTS_DIR)
+
+
 def patch_set_approved(patch_set):
     """Return True if the patchset has been approved.
 
@@ -354,46 +1155,165 @@ def is_workinprogress(change):
     return False
 
 
-def get_age_of_patch(patch, now_ts):
-    """Compute the number of seconds since the patch submission and now.
-
-    :param dict patch: Deserialized JSON of a Gerrit patchset
-    :param int now_ts: Unix-like timestamp in seconds since EPOCH.
-    :return int: number of seconds between patch submission and now_ts
-
-    .. note::
-        The createdOn timestamp on the patch isn't what we want.
-        It's when the patch was written, not submitted for review.
-        The next best thing in the data we have is the time of the
-        first review.  When all is working well, jenkins or smokestack
-        will comment within the first hour or two, so that's better
-        than the other timestamp, which may reflect that the code
-        was written many weeks ago, even though it was just recently
-        submitted for review.
-    """
-    approvals = patch.get('approvals', [])
-    approvals.sort(key=lambda a: a['grantedOn'])
-    if approvals:
-        return now_ts - approvals[0]['grantedOn']
+def derive_change(change):
+    """Compute the facts about a change that the commands look up.
+
+    :param change: De-serialized dict of a gerrit change, or a
+        :class:`reviewstats.model.Change`.
+    :return: dict with the change's ``lastUpdated`` and:
+
+        * ``wip``: see :func:`is_workinprogress`.
+        * ``latest_nacked``: True if the latest patchset has a -1 or -2
+          Code-Review or Verified vote.
+        * ``approved``: per patchset, see :func:`patch_set_approved`.
+        * ``negative_feedback``: per patchset, True if it has a -1 or -2
+          vote of the legacy CRVW or VRIF types.
+        * ``first_vote``: per patchset, the timestamp of its first vote, or
+          of its creation if it has none. The first vote is the best
+          estimate of when the patchset was submitted for review: CI votes
+          within hours, while createdOn is when the patch was written.
+        * ``oldest_no_nack``: index of the oldest patchset of the latest run
+          of patchsets without any -1 or -2 vote, or None if the latest
+          patchset has one.
+    """
+    patch_sets = change.get('patchSets') or []
+    approved = []
+    negative_feedback = []
+    first_vote = []
+    nacked = []
+    nack_types = ('CRVW', 'VRIF', 'Code-Review', 'Verified')
+    latest_nacked = False
+    for patch_set in patch_sets:
+        approvals = patch_set.get('approvals', [])
+        approved.append(patch_set_approved(patch_set))
+        negative_feedback.append(False)
+        nacked.append(False)
+        latest_nacked = False
+        for review in approvals:
+            if review['value'] not in ('-1', '-2'):
+                continue
+            nacked[-1] = True
+            if review['type'] in ('CRVW', 'VRIF'):
+                negative_feedback[-1] = True
+            if review['type'] in nack_types:
+                latest_nacked = True
+        if approvals:
+            first_vote.append(min(a['grantedOn'] for a in approvals))
+        else:
+            first_vote.append(patch_set['createdOn'])
+    oldest_no_nack = None
+    for index in range(len(patch_sets) - 1, -1, -1):
+        if nacked[index]:
+            break
+        oldest_no_nack = index
+    if patch_sets:
+        wip = is_workinprogress(change)
     else:
-        return now_ts - patch['createdOn']
+        wip = change['status'] != 'NEW'
+    return {
+        'lastUpdated': change.get('lastUpdated'),
+        'wip': wip,
+        'latest_nacked': latest_nacked,
+        'approved': approved,
+        'negative_feedback': negative_feedback,
+        'first_vote': first_vote,
+        'oldest_no_nack': oldest_no_nack,
+    }
+
+
+def get_derived(change):
+    """Return the derived attributes of a change.
+
+    The attributes computed at ingest by :func:`get_changes` are returned
+    as is. They are computed and attached to the change under the
+    ``_derived`` key if missing, or if the change was updated since.
+
+    :return: dict as returned by :func:`derive_change`.
+    """
+    derived = change.get('_derived')
+    if derived is None or derived['lastUpdated'] != change.get('lastUpdated'):
+        derived = derive_change(change)
+        change['_derived'] = derived
+    return derived
+
+
+def _ingest(changes, cache=None, compact=False):
+    """Attach the derived attributes to freshly fetched changes.
+
+    :param changes: List of de-serialized Gerrit change dicts.
+    :param cache: :class:`reviewstats.store.ChangeStore` to load the
+        derived attributes from and save the recomputed ones to.
+    :param bool compact: If True, return
+        :class:`reviewstats.model.Change` objects.
+    :return: list of changes.
+    """
+    if cache is not None:
+        cache.load_derived([c for c in changes if '_derived' not in c])
+    missing = [change for change in changes if '_derived' not in change]
+    for change in missing:
+        change['_derived'] = derive_change(change)
+    if cache is not None and missing:
+        cache.save_derived(missing)
+    if not compact:
+        return changes
+    result = []
+    for change in changes:
+        compact_change = model.Change.from_json(change)
+        compact_change['_derived'] = change['_derived']
+        result.append(compact_change)
+    return result
 
 
 TEAM_MEMBERS = {}
+TEAM_MEMBERS_TTL = 24 * 60 * 60
 
+# When the members memoized in TEAM_MEMBERS were fetched from Gerrit
+_TEAM_MEMBERS_FETCHED = {}
 
-def get_team_members(team_name, server, user, pw):
-    global TEAM_MEMBERS
-    if team_name in TEAM_MEMBERS:
-        return TEAM_MEMBERS[team_name]
+# (time fetched, groups listing) by server
+_GERRIT_GROUPS = {}
+_GERRIT_GROUPS_LOCK = threading.Lock()
+
+
+def _get_gerrit_groups(server, auth):
+    """Return the Gerrit groups listing of a server.
+
+    The listing is fetched at most once per TEAM_MEMBERS_TTL seconds.
+    """
+    with _GERRIT_GROUPS_LOCK:
+        now = time.time()
+        if (server not in _GERRIT_GROUPS
+                or _GERRIT_GROUPS[server][0] < now - TEAM_MEMBERS_TTL):
+            status, headers, body = http_get('https://%s/a/groups/' % server,
+                                             auth=auth)
+            if status != 200:
+                raise Exception('Please provide your Gerrit HTTP Password.')
+            text = body.decode('utf-8')
+            _GERRIT_GROUPS[server] = (now,
+                                      json.loads(text[text.find('{'):]))
+        return _GERRIT_GROUPS[server][1]
+
+
+def _memoized_team_members(team_name):
+    """Return the memoized members of a group, or None if stale."""
+    fetched = _TEAM_MEMBERS_FETCHED.get(team_name, 0)
+    if fetched < time.time() - TEAM_MEMBERS_TTL:
+        return None
+    return TEAM_MEMBERS.get(team_name)
+
+
+def _memoize_team_members(team_name, members_list, fetched):
+    TEAM_MEMBERS[team_name] = members_list
+    _TEAM_MEMBERS_FETCHED[team_name] = fetched
+
+
+def _fetch_team_members(team_name, server, user, pw):
     auth = requests.auth.HTTPDigestAuth(user, pw)
-    groups_request = requests.get('https://%s/a/groups/' % server, auth=auth)
-    if groups_request.status_code != 200:
-        raise Exception('Please provide your Gerrit HTTP Password.')
-    text = groups_request.text
-    teams = json.loads(text[text.find('{'):])
-    text = requests.get('https://%s/a/groups/%s/detail' % (server,
-                        teams[team_name]['id']), auth=auth).text
+    teams = _get_gerrit_groups(server, auth)
+    status, headers, body = http_get(
+        'https://%s/a/groups/%s/detail' % (server, teams[team_name]['id']),
+        auth=auth)
+    text = body.decode('utf-8')
     team = json.loads(text[text.find('{'):])
     members_list = [n['username'] for n in team['members'] if 'username' in n]
     if 'hudson-openstack' in members_list:
@@ -401,10 +1321,71 @@ def get_team_members(team_name, server, user, pw):
         # automatically included in core teams, but we don't want to include it
         # in the stats.
         members_list.remove('hudson-openstack')
-    TEAM_MEMBERS[team_name] = members_list
     return members_list
 
 
+def get_team_members(team_name, server, user, pw):
+    """Return the usernames of the members of a Gerrit group.
+
+    Members are cached in the change store and memoized in TEAM_MEMBERS
+    for TEAM_MEMBERS_TTL seconds after they were fetched from Gerrit.
+    """
+    members_list = _memoized_team_members(team_name)
+    if members_list is not None:
+        return members_list
+    cache = store.ChangeStore()
+    try:
+        cached = cache.get_team_members(team_name, server, TEAM_MEMBERS_TTL)
+        if cached is None:
+            members_list = _fetch_team_members(team_name, server, user, pw)
+            fetched = cache.set_team_members(team_name, server, members_list)
+        else:
+            members_list, fetched = cached
+    finally:
+        cache.close()
+    _memoize_team_members(team_name, members_list, fetched)
+    return members_list
+
+
+def prefetch_core_teams(projects, server, user, pw, workers=1):
+    """Resolve the core team of every project up front.
+
+    Groups cached less than TEAM_MEMBERS_TTL seconds ago are read from the
+    change store. The others are fetched concurrently, sharing a single
+    groups listing, and cached.
+    """
+    teams = sorted(set(project['core-team-gerrit-group']
+                       for project in projects
+                       if 'core-team' not in project
+                       and 'core-team-gerrit-group' in project
+                       and _memoized_team_members(
+                           project['core-team-gerrit-group']) is None))
+    if not teams:
+        return
+    cache = store.ChangeStore()
+    try:
+        missing = []
+        for team_name in teams:
+            cached = cache.get_team_members(team_name, server,
+                                            TEAM_MEMBERS_TTL)
+            if cached is None:
+                missing.append(team_name)
+            else:
+                _memoize_team_members(team_name, *cached)
+        LOG.debug('Fetching %d core teams from %s', len(missing), server)
+
+        def fetch(team_name):
+            return team_name, _fetch_team_members(team_name, server, user, pw)
+
+        for team_name, members_list in ordered_map(fetch, missing,
+                                                   workers=workers):
+            fetched = cache.set_team_members(team_name, server,
+                                             members_list)
+            _memoize_team_members(team_name, members_list, fetched)
+    finally:
+        cache.close()
+
+
 def get_core_team(project, server, user, pw):
     if 'core-team' in project:
         return project['core-team']
@@ -412,3 +1393,37 @@ def get_core_team(project, server, user, pw):
         return get_team_members(project['core-team-gerrit-group'],
                                 server, user, pw)
     return []
+
+
+class CoreTeamIndex(object):
+    """Core team membership of a set of projects.
+
+    Built once per run so that membership tests are set lookups instead of
+    list scans over freshly resolved core teams.
+    """
+
+    def __init__(self, projects, server, user, pw):
+        self._teams = {}
+        core_projects = {}
+        for project in projects:
+            team = frozenset(sys.intern(member) for member in
+                             get_core_team(project, server, user, pw))
+            self._teams[project['name']] = team
+            for member in team:
+                core_projects.setdefault(member, set()).add(project['name'])
+        self._core_projects = dict((member, frozenset(names))
+                                   for member, names in core_projects.items())
+
+    def team(self, project):
+        """Return the frozenset of core reviewers of a project."""
+        return self._teams.get(project['name'], frozenset())
+
+    def core_projects(self, reviewer):
+        """Return the names of the projects reviewer is core on."""
+        return self._core_projects.get(reviewer, frozenset())
+
+    def is_core(self, reviewer, project=None):
+        """Return True if reviewer is core on project, or on any project."""
+        if project is None:
+            return reviewer in self._core_projects
+        return reviewer in self.team(project)